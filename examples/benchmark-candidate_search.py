@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark the approximate open search with the candidate index against the exact open search.
+
+The library is simulated as families of similar spectra, the query spectra are new members of the families.
+For each query, the recall is the fraction of the exact top-n matches (with similarity >= min_similarity) found by the approximate search.
+
+Usage: python benchmark-candidate_search.py [--spectra_num 200000] [--query_num 100] [--candidate_num 1000]
+"""
+import argparse
+import time
+import numpy as np
+
+from ms_entropy import FlashEntropySearch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spectra_num", type=int, default=200000)
+    parser.add_argument("--family_size", type=int, default=20)
+    parser.add_argument("--query_num", type=int, default=100)
+    parser.add_argument("--candidate_num", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--hash_num", type=int, default=96)
+    parser.add_argument("--band_num", type=int, default=32)
+    parser.add_argument("--topn", type=int, default=10)
+    parser.add_argument("--min_similarity", type=float, default=0.5)
+    args = parser.parse_args()
+
+    random_state = np.random.RandomState(0)
+    family_num = args.spectra_num // args.family_size
+    all_families = [_generate_family(random_state) for _ in range(family_num)]
+    spectral_library = [_generate_member(random_state, family) for family in all_families for _ in range(args.family_size)]
+    all_queries = [_generate_member(random_state, all_families[i]) for i in random_state.randint(0, family_num, args.query_num)]
+
+    entropy_search = FlashEntropySearch()
+    start = time.time()
+    entropy_search.build_index(spectral_library)
+    print(f"Built the index of {args.spectra_num} spectra in {time.time() - start:.2f} seconds.")
+    start = time.time()
+    entropy_search.build_candidate_index(hash_num=args.hash_num, band_num=args.band_num)
+    print(f"Built the candidate index in {time.time() - start:.2f} seconds.")
+    for query in all_queries:
+        query["peaks"] = entropy_search.clean_spectrum_for_search(precursor_mz=query["precursor_mz"], peaks=query["peaks"])
+
+    start = time.time()
+    all_exact_results = [entropy_search.open_search(peaks=query["peaks"], ms2_tolerance_in_da=0.02) for query in all_queries]
+    time_exact = (time.time() - start) / len(all_queries)
+    print(f"Exact open search: {time_exact * 1000:.2f} ms per query.")
+
+    for candidate_num in args.candidate_num:
+        start = time.time()
+        all_approximate_results = [
+            entropy_search.open_search_with_candidates(peaks=query["peaks"], ms2_tolerance_in_da=0.02, candidate_num=candidate_num) for query in all_queries
+        ]
+        time_approximate = (time.time() - start) / len(all_queries)
+
+        all_found, all_expected = 0, 0
+        for exact_result, approximate_result in zip(all_exact_results, all_approximate_results):
+            topn_expected = entropy_search.get_topn_results(exact_result, topn=args.topn, min_similarity=args.min_similarity)["spec_idx"]
+            topn_found = entropy_search.get_topn_results(approximate_result, topn=args.topn, min_similarity=args.min_similarity)["spec_idx"]
+            all_found += len(np.intersect1d(topn_expected, topn_found))
+            all_expected += len(topn_expected)
+        print(
+            f"Approximate open search with {candidate_num} candidates: {time_approximate * 1000:.2f} ms per query, "
+            f"{time_exact / time_approximate:.1f}x faster, recall of top {args.topn} is {all_found / max(all_expected, 1):.3f}."
+        )
+
+
+def _generate_family(random_state):
+    peaks_num = random_state.randint(10, 50)
+    precursor_mz = random_state.uniform(200, 1000)
+    peaks_mz = np.round(random_state.uniform(50, precursor_mz - 2, peaks_num), 3)
+    peaks_intensity = random_state.exponential(1, peaks_num)
+    return precursor_mz, np.stack([peaks_mz, peaks_intensity], axis=1)
+
+
+def _generate_member(random_state, family):
+    precursor_mz, peaks = family
+    # Drop some peaks, shift the m/z a little, and change the intensity.
+    peaks = peaks[random_state.uniform(0, 1, len(peaks)) > 0.2].copy()
+    peaks[:, 0] += random_state.normal(0, 0.003, len(peaks))
+    peaks[:, 1] *= random_state.lognormal(0, 0.3, len(peaks))
+    # Add some noise peaks.
+    noise_num = random_state.randint(0, 5)
+    noise_peaks = np.stack([random_state.uniform(50, precursor_mz - 2, noise_num), random_state.exponential(0.2, noise_num)], axis=1)
+    return {"precursor_mz": precursor_mz, "peaks": np.concatenate([peaks, noise_peaks]).astype(np.float32)}
+
+
+if __name__ == "__main__":
+    main()
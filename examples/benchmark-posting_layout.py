@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Benchmark the "separate" and the "packed" posting layouts of the Flash entropy search index on this machine.
+
+The same random library is built once, then searched with each layout. The similarity is identical in both layouts,
+only the time is different, so the faster layout can be chosen by `build_index(posting_layout=...)` or `set_posting_layout`.
+
+Usage: python benchmark-posting_layout.py [--spectra_num 1000000] [--query_num 200]
+"""
+import argparse
+import time
+import numpy as np
+
+from ms_entropy import FlashEntropySearch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spectra_num", type=int, default=1000000)
+    parser.add_argument("--query_num", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    random_state = np.random.RandomState(0)
+    spectral_library = [_generate_spectrum(random_state) for _ in range(args.spectra_num)]
+    all_queries = [_generate_spectrum(random_state) for _ in range(args.query_num)]
+
+    entropy_search = FlashEntropySearch()
+    start = time.time()
+    entropy_search.build_index(spectral_library)
+    print(f"Built the index of {args.spectra_num} spectra in {time.time() - start:.2f} seconds.")
+    for query in all_queries:
+        query["peaks"] = entropy_search.clean_spectrum_for_search(precursor_mz=query["precursor_mz"], peaks=query["peaks"])
+
+    all_results = {}
+    for posting_layout in ["separate", "packed"]:
+        entropy_search.entropy_search.set_posting_layout(posting_layout)
+        for method in ["open_search", "neutral_loss_search", "hybrid_search"]:
+            search_function = getattr(entropy_search, method)
+            all_time = []
+            for _ in range(args.repeat):
+                start = time.time()
+                all_results[(posting_layout, method)] = [
+                    search_function(precursor_mz=query["precursor_mz"], peaks=query["peaks"], ms2_tolerance_in_da=0.02) for query in all_queries
+                ]
+                all_time.append((time.time() - start) / len(all_queries))
+            print(f"{posting_layout} layout, {method}: {min(all_time) * 1000:.2f} ms per query.")
+
+    for method in ["open_search", "neutral_loss_search", "hybrid_search"]:
+        is_identical = all(np.array_equal(x, y) for x, y in zip(all_results[("separate", method)], all_results[("packed", method)]))
+        print(f"The results of {method} are {'identical' if is_identical else 'different'} in both layouts.")
+
+
+def _generate_spectrum(random_state):
+    peaks_num = random_state.randint(5, 50)
+    precursor_mz = random_state.uniform(100, 1000)
+    peaks = np.stack([random_state.uniform(50, precursor_mz - 2, peaks_num), random_state.exponential(1, peaks_num)], axis=1)
+    return {"precursor_mz": precursor_mz, "peaks": peaks.astype(np.float32)}
+
+
+if __name__ == "__main__":
+    main()
@@ -15,5 +15,7 @@ from .entropy_search import (
     DynamicEntropySearchCore,
     DynamicEntropySearch,
     DynamicWithFlash,
+    MetadataStore,
+    MinHashCandidateIndex,
 )
 from .version import __version__
@@ -5,4 +5,6 @@ from .flash_entropy_search_core_medium_memory import FlashEntropySearchCoreMediu
 from .flash_entropy_search_core_for_dynamic_indexing import FlashEntropySearchCoreForDynamicIndexing
 from .dynamic_entropy_search_core import DynamicEntropySearchCore
 from .dynamic_entropy_search import DynamicEntropySearch
-from .dynamic_with_flash import DynamicWithFlash
\ No newline at end of file
+from .dynamic_with_flash import DynamicWithFlash
+from .metadata_store import MetadataStore
+from .candidate_index import MinHashCandidateIndex
\ No newline at end of file
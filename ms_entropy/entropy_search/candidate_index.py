@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+import numpy as np
+import pickle
+from pathlib import Path
+
+# The prime used by the universal hash functions of MinHash.
+_HASH_PRIME = np.uint64((1 << 31) - 1)
+
+
+class MinHashCandidateIndex:
+    def __init__(self, hash_num=96, band_num=32, mz_bin_width=1.0, max_peak_num=20, seed=0):
+        """
+        The candidate index for the approximate search, the candidates are generated by MinHash with locality-sensitive hashing (LSH),
+        then scored exactly by the entropy similarity.
+
+        The fingerprint of a spectrum is the set of the m/z bins of its most intense peaks, and its MinHash signature is split into bands.
+        The spectra sharing at least one band with the query spectrum are the candidates, ranked by the number of the shared bands.
+        The candidates are scored by the fragment ion index of the Flash entropy search, so the peaks are not stored in this index.
+
+        :param hash_num:    The number of hash functions in the MinHash signature.
+        :param band_num:    The number of bands in LSH, hash_num should be divisible by band_num. More bands give higher recall with more candidates.
+        :param mz_bin_width:    The width of the m/z bins in Da.
+        :param max_peak_num:    The maximum number of the most intense peaks used in the fingerprint of a spectrum.
+        :param seed:    The random seed for the hash functions.
+        """
+        assert hash_num % band_num == 0, "The hash_num should be divisible by band_num."
+        self.hash_num = hash_num
+        self.band_num = band_num
+        self.mz_bin_width = mz_bin_width
+        self.max_peak_num = max_peak_num
+        random_state = np.random.RandomState(seed)
+        self.hash_a = random_state.randint(1, int(_HASH_PRIME), size=hash_num).astype(np.uint64)
+        self.hash_b = random_state.randint(0, int(_HASH_PRIME), size=hash_num).astype(np.uint64)
+
+        self.spectra_num = 0
+        # The sorted band keys of the MinHash signatures, with the spectrum index for each band.
+        self.band_keys = np.zeros((band_num, 0), dtype=np.uint64)
+        self.band_spec_idx = np.zeros((band_num, 0), dtype=np.uint32)
+
+    def build(self, all_ions_mz, all_ions_intensity, all_ions_spec_idx, spectra_num):
+        """
+        Build the candidate index from the fragment ion index of the Flash entropy search.
+
+        :param all_ions_mz: The m/z of all fragment ions, sorted by m/z.
+        :param all_ions_intensity:  The intensity of all fragment ions, preprocessed as in the Flash entropy search.
+        :param all_ions_spec_idx:   The spectrum index of all fragment ions.
+        :param spectra_num: The number of spectra.
+        :return:    None
+        """
+        # Group the peaks by spectrum, the peaks of each spectrum stay sorted by m/z.
+        order = np.argsort(all_ions_spec_idx, kind="stable")
+        peaks_loc = np.zeros(spectra_num + 1, dtype=np.uint64)
+        peaks_loc[1:] = np.cumsum(np.bincount(all_ions_spec_idx, minlength=spectra_num))
+        signatures = self._compute_signatures(all_ions_mz[order], all_ions_intensity[order], peaks_loc)
+        del order
+
+        self.spectra_num = spectra_num
+        all_band_keys = self._compute_band_keys(signatures)
+        self.band_spec_idx = np.argsort(all_band_keys, axis=1, kind="stable").astype(np.uint32)
+        self.band_keys = np.take_along_axis(all_band_keys, self.band_spec_idx.astype(np.int64), axis=1)
+
+    def add_spectra(self, all_peaks_mz, all_peaks_intensity, peaks_loc, all_spec_idx=None):
+        """
+        Add new spectra into the candidate index. Only the new spectra are hashed, their band keys are merged into the sorted bands.
+
+        :param all_peaks_mz:    The m/z of the peaks of the new spectra, the peaks of spectrum i are in [peaks_loc[i], peaks_loc[i + 1]).
+        :param all_peaks_intensity: The intensity of the peaks of the new spectra, preprocessed as in the Flash entropy search.
+        :param peaks_loc:   The location of the peaks of each new spectrum.
+        :param all_spec_idx:    The spectrum index of each new spectrum in the merged library, must be increasing.
+                                The existing spectra are renumbered in order to fill the remaining indexes.
+                                Default is None, which means the new spectra are placed after the existing spectra.
+        :return:    None
+        """
+        new_spectra_num = len(peaks_loc) - 1
+        spectra_num = self.spectra_num + new_spectra_num
+        if all_spec_idx is None:
+            all_spec_idx = np.arange(self.spectra_num, spectra_num)
+        all_spec_idx = np.asarray(all_spec_idx, dtype=np.uint32)
+        is_new_spectrum = np.zeros(spectra_num, dtype=bool)
+        is_new_spectrum[all_spec_idx] = True
+        old_spec_idx = np.flatnonzero(~is_new_spectrum).astype(np.uint32)
+
+        new_band_keys = self._compute_band_keys(self._compute_signatures(all_peaks_mz, all_peaks_intensity, peaks_loc))
+        band_keys = np.zeros((self.band_num, spectra_num), dtype=np.uint64)
+        band_spec_idx = np.zeros((self.band_num, spectra_num), dtype=np.uint32)
+        for band_idx in range(self.band_num):
+            order = np.argsort(new_band_keys[band_idx], kind="stable")
+            # The position of each new key in the merged band, the keys equal to an existing key are placed after it.
+            insert_loc = np.searchsorted(self.band_keys[band_idx], new_band_keys[band_idx][order], side="right") + np.arange(new_spectra_num)
+            is_new_key = np.zeros(spectra_num, dtype=bool)
+            is_new_key[insert_loc] = True
+            band_keys[band_idx][insert_loc] = new_band_keys[band_idx][order]
+            band_keys[band_idx][~is_new_key] = self.band_keys[band_idx]
+            band_spec_idx[band_idx][insert_loc] = all_spec_idx[order]
+            band_spec_idx[band_idx][~is_new_key] = old_spec_idx[self.band_spec_idx[band_idx]]
+        self.spectra_num = spectra_num
+        self.band_keys, self.band_spec_idx = band_keys, band_spec_idx
+
+    def remove_spectra(self, is_kept_spectrum):
+        """
+        Remove the spectra from the candidate index, the remaining spectra are renumbered in order.
+
+        :param is_kept_spectrum:    A boolean array with the length of the number of spectra, True for the spectra to keep.
+        :return:    None
+        """
+        new_spec_idx = (np.cumsum(is_kept_spectrum, dtype=np.int64) - 1).astype(np.uint32)
+        # Each band has one key for every spectrum, so the same number of keys is kept in each band.
+        is_kept_key = np.asarray(is_kept_spectrum, dtype=bool)[self.band_spec_idx]
+        self.spectra_num = int(np.count_nonzero(is_kept_spectrum))
+        self.band_keys = self.band_keys[is_kept_key].reshape(self.band_num, self.spectra_num)
+        self.band_spec_idx = new_spec_idx[self.band_spec_idx[is_kept_key]].reshape(self.band_num, self.spectra_num)
+
+    def get_candidates(self, peaks, candidate_num):
+        """
+        Get the candidates of the query spectrum.
+
+        :param peaks:   The peaks of the query spectrum, sorted by m/z.
+        :param candidate_num:   The maximum number of candidates.
+        :return:    The index of the candidates, from the most similar to the least similar.
+        """
+        if len(peaks) == 0 or self.spectra_num == 0:
+            return np.zeros(0, dtype=np.int64)
+        signature = self._compute_signatures(peaks[:, 0], peaks[:, 1], np.array([0, len(peaks)], dtype=np.uint64))
+        all_query_band_keys = self._compute_band_keys(signature)[:, 0]
+
+        # The spectra sharing at least one band with the query.
+        all_candidates = []
+        for band_keys, band_spec_idx, query_band_key in zip(self.band_keys, self.band_spec_idx, all_query_band_keys):
+            idx_min = np.searchsorted(band_keys, query_band_key, side="left")
+            idx_max = np.searchsorted(band_keys, query_band_key, side="right")
+            all_candidates.append(band_spec_idx[idx_min:idx_max])
+        candidate_idx, shared_band_num = np.unique(np.concatenate(all_candidates), return_counts=True)
+
+        # Rank the candidates by the number of the shared bands.
+        order = np.argsort(-shared_band_num, kind="stable")
+        return candidate_idx[order[:candidate_num]].astype(np.int64)
+
+    def write(self, path_data):
+        """
+        Write the candidate index to a directory.
+
+        :param path_data:   The path of the directory.
+        :return:    None
+        """
+        path_data = Path(path_data)
+        path_data.mkdir(parents=True, exist_ok=True)
+        with open(path_data / "parameters.pkl", "wb") as f:
+            pickle.dump(
+                {
+                    "hash_num": self.hash_num,
+                    "band_num": self.band_num,
+                    "mz_bin_width": self.mz_bin_width,
+                    "max_peak_num": self.max_peak_num,
+                    "hash_a": self.hash_a,
+                    "hash_b": self.hash_b,
+                    "spectra_num": self.spectra_num,
+                },
+                f,
+            )
+        for name in ["band_keys", "band_spec_idx"]:
+            getattr(self, name).tofile(str(path_data / f"{name}.npy"))
+
+    def read(self, path_data, use_memmap=False):
+        """
+        Read the candidate index from a directory.
+
+        :param path_data:   The path of the directory.
+        :param use_memmap:  If True, the arrays will be memory-mapped instead of loaded into memory.
+        :return:    None
+        """
+        path_data = Path(path_data)
+        with open(path_data / "parameters.pkl", "rb") as f:
+            self.__dict__.update(pickle.load(f))
+        for name, dtype, shape in [
+            ("band_keys", np.uint64, (self.band_num, self.spectra_num)),
+            ("band_spec_idx", np.uint32, (self.band_num, self.spectra_num)),
+        ]:
+            file_array = path_data / f"{name}.npy"
+            if use_memmap and file_array.stat().st_size > 0:
+                array = np.memmap(file_array, dtype=dtype, mode="r")
+            else:
+                array = np.fromfile(str(file_array), dtype=dtype)
+            setattr(self, name, array.reshape(shape))
+
+    def _compute_signatures(self, all_peaks_mz, all_peaks_intensity, peaks_loc, chunk_size=1 << 16):
+        """
+        Compute the MinHash signature of the m/z bins of the most intense peaks of each spectrum.
+        The spectra are hashed in chunks of about chunk_size peaks, the hashes of a chunk take chunk_size * hash_num * 8 bytes.
+        """
+        spectra_num = len(peaks_loc) - 1
+        peaks_loc = np.asarray(peaks_loc, dtype=np.int64)
+        all_peaks_num = np.diff(peaks_loc)
+        # Keep the most intense peaks of each spectrum.
+        all_peaks_spec_idx = np.repeat(np.arange(spectra_num), all_peaks_num)
+        order = np.lexsort((-np.asarray(all_peaks_intensity), all_peaks_spec_idx))
+        is_kept = np.arange(len(order)) - peaks_loc[all_peaks_spec_idx] < self.max_peak_num
+        all_bins = np.floor(np.asarray(all_peaks_mz)[order[is_kept]] / self.mz_bin_width).astype(np.uint64)
+        kept_loc = np.zeros(spectra_num + 1, dtype=np.int64)
+        kept_loc[1:] = np.cumsum(np.minimum(all_peaks_num, self.max_peak_num))
+
+        signatures = np.full((spectra_num, self.hash_num), np.iinfo(np.uint32).max, dtype=np.uint32)
+        spec_idx_start = 0
+        while spec_idx_start < spectra_num:
+            # Split the spectra into chunks with about chunk_size peaks.
+            spec_idx_end = max(spec_idx_start + 1, int(np.searchsorted(kept_loc, kept_loc[spec_idx_start] + chunk_size, side="right")) - 1)
+            spec_idx_end = min(spec_idx_end, spectra_num)
+            bins = all_bins[kept_loc[spec_idx_start] : kept_loc[spec_idx_end]]
+            hashes = ((bins[:, None] * self.hash_a[None, :] + self.hash_b[None, :]) % _HASH_PRIME).astype(np.uint32)
+            is_not_empty = kept_loc[spec_idx_start + 1 : spec_idx_end + 1] > kept_loc[spec_idx_start:spec_idx_end]
+            starts = kept_loc[spec_idx_start:spec_idx_end][is_not_empty] - kept_loc[spec_idx_start]
+            if len(starts) > 0:
+                signatures[spec_idx_start:spec_idx_end][is_not_empty] = np.minimum.reduceat(hashes, starts, axis=0)
+            spec_idx_start = spec_idx_end
+        return signatures
+
+    def _compute_band_keys(self, signatures):
+        """
+        Hash the rows of each band of the signatures into one key, the result is in shape (band_num, spectra_num).
+        """
+        rows_per_band = self.hash_num // self.band_num
+        band_signatures = signatures.reshape(len(signatures), self.band_num, rows_per_band).astype(np.uint64)
+        band_keys = np.full((len(signatures), self.band_num), 0xCBF29CE484222325, dtype=np.uint64)
+        for row in range(rows_per_band):
+            band_keys = (band_keys ^ band_signatures[:, :, row]) * np.uint64(0x100000001B3)
+        return np.ascontiguousarray(band_keys.T)
+
@@ -1,11 +1,28 @@
+import heapq
 import pickle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 from .dynamic_entropy_search_core import DynamicEntropySearchCore
 from .dynamic_with_flash import DynamicWithFlash
+from .flash_entropy_search_core import _get_n_jobs, _get_ms2_tolerance_array
 from ..spectra.tools import clean_spectrum
 
+# The opened search engines, sorted precursor m/z and maximum peak intensity of the groups, shared by all DynamicEntropySearch objects in this process.
+# The key of _group_engine_cache is (group path, intensity_weight, score_partition_size), the key of _group_precursor_mz_cache and _group_max_intensity_cache
+# is the group path, and the value is (generation, object). An object is reopened when its generation is older than the generation of the group in
+# _group_generation, which is increased every time the group is modified.
+_group_engine_cache = {}
+_group_precursor_mz_cache = {}
+_group_max_intensity_cache = {}
+_group_generation = {}
+
+# The m/z bins of max_intensity_ions.bin and max_intensity_nl.bin, the peaks above the last bin are counted in the last bin.
+_MAX_INTENSITY_BIN_WIDTH = 0.05
+_MAX_INTENSITY_BIN_NUM = 40000
+
 
 class DynamicEntropySearch:
     def __init__(
@@ -18,6 +35,7 @@ class DynamicEntropySearch:
         cache_list_threshold: int = 1_000_000,
         max_indexed_mz: float = 1500.00005,
         intensity_weight="entropy",  # "entropy" or None
+        score_partition_size: int = 0,
     ):
         """
         Initialize the :class:`DynamicEntropySearch` object.
@@ -57,6 +75,12 @@ class DynamicEntropySearch:
             If ``None``, intensities remain unweighted (equivalent to raw entropy similarity).  
             Default is ``"entropy"``.
 
+        score_partition_size : int, optional
+            Number of spectra in each partition of the similarity array of a group.  
+            If larger than 0, the matched peaks are accumulated partition by partition to avoid cache misses on large groups,
+            ``1 << 20`` is a good choice for groups with tens of millions of spectra.  
+            Default is ``0`` (disabled).
+
         Notes
         -----
         If the index directory already contains ``group_start.pkl`` and ``metadata_start_loc.bin``, they are loaded automatically.
@@ -74,6 +98,7 @@ class DynamicEntropySearch:
         self.mass_per_block = mass_per_block
         self.max_indexed_mz = max_indexed_mz
         self.intensity_weight = intensity_weight
+        self.score_partition_size = score_partition_size
 
         self.path_data.mkdir(parents=True, exist_ok=True)
         self.cache_list_threshold = cache_list_threshold
@@ -99,9 +124,13 @@ class DynamicEntropySearch:
             mass_per_block=self.mass_per_block,
             max_indexed_mz=self.max_indexed_mz,
             intensity_weight=self.intensity_weight,
+            score_partition_size=self.score_partition_size,
         )
 
         self.entropy_search.read()
+        # The files may have been changed since the groups were opened by another object, reopen them.
+        for group in range(len(self.group_start)):
+            self._update_group_generation(self.path_data / f"{group}")
 
     def add_new_spectra(
             self, 
@@ -279,6 +308,7 @@ class DynamicEntropySearch:
         else:
             if len(self.cache_list) == 0:
                 self.entropy_search.write()
+                self._update_group_generation(self.entropy_search.path_data)
                 return
             spectra_to_build = self.cache_list
             self.cache_list = []
@@ -312,6 +342,7 @@ class DynamicEntropySearch:
                 self.convert_current_index_to_flash()
             else:
                 self.entropy_search.write()
+            self._update_group_generation(self.entropy_search.path_data)
 
             # Update self.group_start
             self.group_start.append(self.group_start[-1] + self.entropy_search.total_spectra_num)
@@ -324,6 +355,7 @@ class DynamicEntropySearch:
                 mass_per_block=self.mass_per_block,
                 max_indexed_mz=self.max_indexed_mz,
                 intensity_weight=self.intensity_weight,
+                score_partition_size=self.score_partition_size,
             )
 
             self.entropy_search.build_index(all_spectra_list=spectra_to_build, index_for_neutral_loss=index_for_neutral_loss)
@@ -332,8 +364,14 @@ class DynamicEntropySearch:
         precursor_mz_array = np.array([spec["precursor_mz"] for spec in spectra_to_build], dtype=np.float32)
         max_group_number = len(self.group_start) - 1
         group_path = self.path_data / f"{max_group_number}"
+        # Close the memory maps of the sorted precursor m/z and the maximum intensity of the group before their files are replaced,
+        # a mapped file can not be replaced on Windows.
+        self._update_group_generation(group_path)
         with open(group_path / "precursor_mz_array.bin", "ab") as f:
             precursor_mz_array.tofile(f)
+        _add_sorted_precursor_mz(group_path=group_path, precursor_mz_array=precursor_mz_array)
+        _add_max_intensity(group_path=group_path, spectra_list=spectra_to_build, preprocess_peaks=self.entropy_search._preprocess_peaks)
+        self._update_group_generation(group_path)
 
         return
 
@@ -356,6 +394,7 @@ class DynamicEntropySearch:
         """
         # Write the information of self.entropy_search
         self.entropy_search.write()
+        self._update_group_generation(self.entropy_search.path_data)
 
         # Write the information of self.group_start
         with open(self.path_data / "group_start.pkl", "wb") as f:
@@ -471,6 +510,8 @@ class DynamicEntropySearch:
         peaks,
         ms1_tolerance_in_da,
         ms2_tolerance_in_da,
+        ms2_tolerance_in_ppm=None,
+        n_jobs=1,
     ):
         """
         Perform an identity search across all indexed spectra.
@@ -493,6 +534,17 @@ class DynamicEntropySearch:
         ms2_tolerance_in_da : float
             MS2 (fragment ion) tolerance in Daltons.
 
+        ms2_tolerance_in_ppm : float, optional
+            MS2 (fragment ion) tolerance in ppm.  
+            If positive, it is used instead of ``ms2_tolerance_in_da``; the tolerance of a query peak at m/z ``x`` is ``x * ms2_tolerance_in_ppm * 1e-6`` Da,
+            which must be less than or equal to ``max_ms2_tolerance_in_da``.  
+            Default is ``None``.
+
+        n_jobs : int, optional
+            Number of threads used to search the groups of the library at the same time.  
+            ``None`` or a value smaller than 1 uses all CPU cores.  
+            Default is ``1``.
+
         Returns
         -------
         numpy.ndarray
@@ -501,24 +553,19 @@ class DynamicEntropySearch:
 
         """
 
-        all_result = []
-        for group in range(len(self.group_start)):
-            group_path = self.path_data / f"{group}"
-            precursor_mz_file = group_path / "precursor_mz_array.bin"
-
-            if precursor_mz_file.exists():
-                precursor_mz_array = np.memmap(precursor_mz_file, mode="r", dtype=np.float32)
-                spec_idx = np.where(abs(precursor_mz_array - precursor_mz) <= ms1_tolerance_in_da)[0]
-            else:
-                raise RuntimeError("Precursor_mz_array not loaded. Call add_new_spectra(...) first. ")
-            
-            entropy_search=self._assign_entropy_search(group_path=group_path)
-                
-            cur_result=np.zeros(entropy_search.total_spectra_num, dtype=np.float32)
-            cur_result[spec_idx] = entropy_search.search(method="open", peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)[spec_idx]
-            all_result.append(cur_result)
-            
-        identity_result = np.concatenate(all_result)
+        all_result = self._map_groups(
+            lambda group: self._search_group(
+                group,
+                method="identity",
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms1_tolerance_in_da=ms1_tolerance_in_da,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+            ),
+            n_jobs=n_jobs,
+        )
+        identity_result = np.concatenate(list(all_result))
 
         return identity_result
 
@@ -526,6 +573,8 @@ class DynamicEntropySearch:
         self,
         peaks,
         ms2_tolerance_in_da,
+        ms2_tolerance_in_ppm=None,
+        n_jobs=1,
     ):
         """
         Perform an open search across the entire spectral library.
@@ -542,6 +591,17 @@ class DynamicEntropySearch:
         ms2_tolerance_in_da : float
             Fragment-ion (MS2) tolerance in Daltons.
 
+        ms2_tolerance_in_ppm : float, optional
+            MS2 (fragment ion) tolerance in ppm.  
+            If positive, it is used instead of ``ms2_tolerance_in_da``; the tolerance of a query peak at m/z ``x`` is ``x * ms2_tolerance_in_ppm * 1e-6`` Da,
+            which must be less than or equal to ``max_ms2_tolerance_in_da``.  
+            Default is ``None``.
+
+        n_jobs : int, optional
+            Number of threads used to search the groups of the library at the same time.  
+            ``None`` or a value smaller than 1 uses all CPU cores.  
+            Default is ``1``.
+
         Returns
         -------
         numpy.ndarray
@@ -549,20 +609,17 @@ class DynamicEntropySearch:
 
 
         """
-        result = []
         # Go through all groups in this library
-        for group in range(len(self.group_start)):
-            group_path = self.path_data / f"{group}"
-            
-            entropy_search=self._assign_entropy_search(group_path=group_path)
-            
-            cur_result = entropy_search.search(method="open", peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
-            result.append(cur_result)
-
-        open_result = np.concatenate(result)
+        result = self._map_groups(
+            lambda group: self._search_group(
+                group, method="open", peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm
+            ),
+            n_jobs=n_jobs,
+        )
+        open_result = np.concatenate(list(result))
         return open_result
 
-    def neutral_loss_search(self, precursor_mz, peaks, ms2_tolerance_in_da):
+    def neutral_loss_search(self, precursor_mz, peaks, ms2_tolerance_in_da, ms2_tolerance_in_ppm=None, n_jobs=1):
 
         """
         Perform a neutral-loss search across the spectral library.
@@ -581,6 +638,17 @@ class DynamicEntropySearch:
         ms2_tolerance_in_da : float
             Fragment-ion (MS2) tolerance in Daltons.
 
+        ms2_tolerance_in_ppm : float, optional
+            MS2 (fragment ion) tolerance in ppm.  
+            If positive, it is used instead of ``ms2_tolerance_in_da``; the tolerance of a query peak at m/z ``x`` is ``x * ms2_tolerance_in_ppm * 1e-6`` Da,
+            which must be less than or equal to ``max_ms2_tolerance_in_da``.  
+            Default is ``None``.
+
+        n_jobs : int, optional
+            Number of threads used to search the groups of the library at the same time.  
+            ``None`` or a value smaller than 1 uses all CPU cores.  
+            Default is ``1``.
+
         Returns
         -------
         numpy.ndarray
@@ -589,21 +657,23 @@ class DynamicEntropySearch:
 
         """
 
-        result = []
         # Go through all groups in this library
-        for group in range(len(self.group_start)):
-            group_path = self.path_data / f"{group}"
-
-            entropy_search=self._assign_entropy_search(group_path=group_path)
-                
-            cur_result = entropy_search.search(method="neutral_loss", precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
-            result.append(cur_result)
-
-        neutral_result = np.concatenate(result)
+        result = self._map_groups(
+            lambda group: self._search_group(
+                group,
+                method="neutral_loss",
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+            ),
+            n_jobs=n_jobs,
+        )
+        neutral_result = np.concatenate(list(result))
 
         return neutral_result
 
-    def hybrid_search(self, precursor_mz, peaks, ms2_tolerance_in_da):
+    def hybrid_search(self, precursor_mz, peaks, ms2_tolerance_in_da, ms2_tolerance_in_ppm=None, n_jobs=1):
 
         """
         Perform a hybrid search across the spectral library.
@@ -622,23 +692,36 @@ class DynamicEntropySearch:
         ms2_tolerance_in_da : float
             Fragment-ion (MS2) tolerance in Daltons.
 
+        ms2_tolerance_in_ppm : float, optional
+            MS2 (fragment ion) tolerance in ppm.  
+            If positive, it is used instead of ``ms2_tolerance_in_da``; the tolerance of a query peak at m/z ``x`` is ``x * ms2_tolerance_in_ppm * 1e-6`` Da,
+            which must be less than or equal to ``max_ms2_tolerance_in_da``.  
+            Default is ``None``.
+
+        n_jobs : int, optional
+            Number of threads used to search the groups of the library at the same time.  
+            ``None`` or a value smaller than 1 uses all CPU cores.  
+            Default is ``1``.
+
         Returns
         -------
         numpy.ndarray
             A 1D array of entropy-based hybrid similarity scores with shape ``(N,)``, where ``N`` is the total number of spectra in the library.
 
         """
-        result = []
         # Go through all groups in this library
-        for group in range(len(self.group_start)):
-            group_path = self.path_data / f"{group}"
-
-            entropy_search=self._assign_entropy_search(group_path=group_path)
-
-            cur_result = entropy_search.search_hybrid(precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
-            result.append(cur_result)
-
-        hybrid_result = np.concatenate(result)
+        result = self._map_groups(
+            lambda group: self._search_group(
+                group,
+                method="hybrid",
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+            ),
+            n_jobs=n_jobs,
+        )
+        hybrid_result = np.concatenate(list(result))
 
         return hybrid_result
 
@@ -654,6 +737,8 @@ class DynamicEntropySearch:
         noise_threshold=0.01,
         min_ms2_difference_in_da=0.05,
         max_peak_num=None,
+        ms2_tolerance_in_ppm=None,
+        n_jobs=1,
     ):
         
 
@@ -710,6 +795,15 @@ class DynamicEntropySearch:
             Maximum number of peaks to retain after cleaning.  
             ``None`` (default) keeps all peaks.
 
+        ms2_tolerance_in_ppm : float, optional
+            Fragment-ion tolerance in ppm used by all search modes instead of ``ms2_tolerance_in_da`` if positive.
+            Default is ``None``.
+
+        n_jobs : int, optional
+            Number of threads used to search the groups of the library at the same time.  
+            ``None`` or a value smaller than 1 uses all CPU cores.  
+            Default is ``1``.
+
         Returns
         -------
         dict
@@ -754,20 +848,27 @@ class DynamicEntropySearch:
         result = {}
         if "identity" in method:
             result["identity_search"] = self.identity_search(
-                precursor_mz=precursor_mz, peaks=peaks, ms1_tolerance_in_da=ms1_tolerance_in_da, ms2_tolerance_in_da=ms2_tolerance_in_da
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms1_tolerance_in_da=ms1_tolerance_in_da,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+                n_jobs=n_jobs,
             )
         
         if "open" in method:
-            result["open_search"] = self.open_search(peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
+            result["open_search"] = self.open_search(
+                peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm, n_jobs=n_jobs
+            )
         
         if "neutral_loss" in method:
             result["neutral_loss_search"] = self.neutral_loss_search(
-                precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da
+                precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm, n_jobs=n_jobs
             )
         
         if "hybrid" in method:
             result["hybrid_search"] = self.hybrid_search(
-                precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da
+                precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm, n_jobs=n_jobs
             )
 
         return result
@@ -786,6 +887,9 @@ class DynamicEntropySearch:
         max_peak_num=None,
         topn: int = 3,
         need_metadata: bool = True,
+        ms2_tolerance_in_ppm=None,
+        n_jobs=1,
+        min_similarity=0.1,
     ):
         
         """
@@ -847,6 +951,19 @@ class DynamicEntropySearch:
             If ``False``, return `(global_index, similarity)` tuples instead.
             Default is ``True``.
 
+        ms2_tolerance_in_ppm : float, optional
+            MS2 fragment tolerance in ppm, used instead of ``ms2_tolerance_in_da`` if positive.  
+            Default is ``None``.
+
+        n_jobs : int, optional
+            Number of threads used to search the groups of the library at the same time.  
+            ``None`` or a value smaller than 1 uses all CPU cores.  
+            Default is ``1``.
+
+        min_similarity : float, optional
+            Only the matches with the similarity not lower than this value are returned.  
+            Default is ``0.1``.
+
         Returns
         -------
         list or list of tuples
@@ -859,9 +976,6 @@ class DynamicEntropySearch:
 
         """
 
-        all_topn_result = []
-        all_topn_result_idx = []
-
         if method == "identity" or method=="neutral_loss" or method=="hybrid":
             assert precursor_mz is not None, f"Precursor_mz is necessary for {method} search. This parameter should not be None."
         
@@ -883,82 +997,219 @@ class DynamicEntropySearch:
                 normalize_intensity=True,
             )
             
-        for group in range(len(self.group_start)):
-            group_path = self.path_data / f"{group}"
+        if method not in {"identity", "open", "neutral_loss", "hybrid"}:
+            raise ValueError(f"Unknown method: {method}. Use 'identity', 'open', 'neutral_loss' or 'hybrid'.")
+        if topn is not None:
+            topn = int(topn)
+        if min_similarity is None:
+            min_similarity = 0.0
+
+        # Search the groups in the order of the upper bound of their similarity, and skip the groups which can not have a better match than the current topn.
+        # The groups written without the maximum intensity files have no bound and are always searched.
+        all_group_bound = self._get_similarity_upper_bound(
+            method=method, precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm
+        )
+        all_group = sorted([group for group in range(len(self.group_start)) if all_group_bound[group] >= min_similarity], key=lambda group: -all_group_bound[group])
+        if topn == 0:
+            all_group = []
+        topn_heap = []
+
+        def search_group_topn(group):
+            if topn is not None and len(topn_heap) >= topn and all_group_bound[group] < topn_heap[0][0]:
+                return None
+
+            # Only the topn matches of each group are kept, the similarity array of the group is released after that.
+            result = self._search_group(
+                group,
+                method=method,
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms1_tolerance_in_da=ms1_tolerance_in_da,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+            )
+            entropy_search = self._assign_entropy_search(group_path=self.path_data / f"{group}")
+            topn_result_idx, topn_result = entropy_search.get_topn_spec_idx_and_similarity(similarity_array=result, topn=topn, min_similarity=min_similarity)
+            # Get the global spec_idx
+            return [self.group_start[group] + idx for idx in topn_result_idx], topn_result
+
+        # Merge the topn matches of the groups in a min-heap of (similarity, -global_spec_idx), the worst match is on the top.
+        for group_result in self._map_groups(search_group_topn, n_jobs=n_jobs, all_group=all_group):
+            if group_result is None:
+                # The bound of this group is lower than the topn, so are the bounds of the following groups.
+                break
+            topn_result_idx, topn_result = group_result
+            for spec_idx, similarity in zip(topn_result_idx, topn_result):
+                match = (similarity, -spec_idx)
+                if topn is None or len(topn_heap) < topn:
+                    heapq.heappush(topn_heap, match)
+                elif topn_heap and match > topn_heap[0]:
+                    heapq.heapreplace(topn_heap, match)
+                else:
+                    # The matches of a group are sorted, the rest of them are worse.
+                    break
 
-            # Perform search
-            if method == "identity":
+        # Sort and collect topn results
+        topn_heap.sort(reverse=True)
+        collected_result = [similarity for similarity, _ in topn_heap]
+        collected_result_idx = np.array([-spec_idx for _, spec_idx in topn_heap], dtype=np.uint64)
 
-                precursor_mz_file = group_path / "precursor_mz_array.bin"
-                if precursor_mz_file.exists():
-                    precursor_mz_array = np.memmap(precursor_mz_file, mode="r", dtype=np.float32)
-                    spec_idx = np.where(abs(precursor_mz_array - precursor_mz) <= ms1_tolerance_in_da)[0]
-                    
-                    entropy_search=self._assign_entropy_search(group_path=group_path)
+        output_result = []
+        # Fetch metadata
+        if need_metadata == True:
+            for i, spec_idx in enumerate(collected_result_idx):
+                spec_metadata = self[spec_idx]
+                spec_metadata[f"{method}_search_entropy_similarity"] = collected_result[i]
+                output_result.append(spec_metadata)
 
-                    result = np.zeros(entropy_search.total_spectra_num, dtype=np.float32)
-                    result[spec_idx] = entropy_search.search(method="open", peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)[spec_idx]
+            return output_result
 
-                else:
-                    raise RuntimeError("Precursor_mz_array not loaded. Call add_new_spectra(...) first. ")
+        else:
+            # If need_metadata is False, return will be (global_spec_idx, final_result). There will be a consistent one-to-one match between these two elements.
+            return list(zip(collected_result_idx, collected_result))
 
-            elif method == "open":
+    def _search_group(self, group: int, method, peaks, ms2_tolerance_in_da, ms2_tolerance_in_ppm=None, precursor_mz=None, ms1_tolerance_in_da=None):
+        """
+        Search one group of the library.
 
-                entropy_search=self._assign_entropy_search(group_path=group_path)
+        Parameters
+        ----------
+        group : int
+            The index of the group.
 
-                result = entropy_search.search(method="open", peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
+        method : {"identity", "open", "neutral_loss", "hybrid"}
+            The search mode.
 
-            elif method == "neutral_loss":
-                
-                entropy_search=self._assign_entropy_search(group_path=group_path)
+        The other parameters are the same as in :meth:`identity_search`.
 
-                result = entropy_search.search(method="neutral_loss", precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
+        Returns
+        -------
+        numpy.ndarray
+            A 1D array of entropy similarity scores of the spectra in the group.
+        """
+        group_path = self.path_data / f"{group}"
+        entropy_search = self._assign_entropy_search(group_path=group_path)
+
+        if method == "identity":
+            spectra_mask = self._get_identity_spectra_mask(group_path=group_path, precursor_mz=precursor_mz, ms1_tolerance_in_da=ms1_tolerance_in_da)
+            if spectra_mask is None:
+                return np.zeros(entropy_search.total_spectra_num, dtype=np.float32)
+            # Only the spectra with a matched precursor m/z are scored.
+            return entropy_search.search(
+                method="open", peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm, spectra_mask=spectra_mask
+            )
+        elif method == "open" or method == "neutral_loss":
+            return entropy_search.search(
+                method=method, precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm
+            )
+        elif method == "hybrid":
+            return entropy_search.search_hybrid(precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm)
+        else:
+            raise ValueError(f"Unknown method: {method}. Use 'identity', 'open', 'neutral_loss' or 'hybrid'.")
 
-            elif method == "hybrid":
+    def _map_groups(self, function, n_jobs=1, all_group=None):
+        """
+        Call ``function(group)`` for the groups in ``all_group``, all groups of the library by default, and yield the results in the same order.
 
-                entropy_search=self._assign_entropy_search(group_path=group_path)
-                                
-                result = entropy_search.search_hybrid(precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
-            
-            else:
-                raise ValueError(f"Unknown method: {method}. Use 'identity', 'open', 'neutral_loss' or 'hybrid'.")
+        When ``n_jobs`` is larger than 1, the groups are searched by a thread pool. The search kernels release the GIL, so the groups are searched in parallel.
+        A group is only submitted after the result of an earlier group is taken, so the caller can stop early without searching all groups.
+        """
+        all_group = list(range(len(self.group_start)) if all_group is None else all_group)
+        n_jobs = min(_get_n_jobs(n_jobs), len(all_group))
+        if n_jobs <= 1:
+            yield from map(function, all_group)
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                all_future = deque(executor.submit(function, group) for group in all_group[:n_jobs])
+                for group in all_group[n_jobs:]:
+                    result = all_future.popleft().result()
+                    all_future.append(executor.submit(function, group))
+                    yield result
+                while all_future:
+                    yield all_future.popleft().result()
+
+    def _get_similarity_upper_bound(self, method, peaks, ms2_tolerance_in_da, ms2_tolerance_in_ppm=None, precursor_mz=None):
+        """
+        Get an upper bound of the similarity between the query spectrum and any spectrum in each group.
 
-            # Collect the results
-            if topn is None:
-                topn=len(result)
-            else:
-                topn=int(topn)
-            topn = min(topn, len(result))
-            topn_result_idx, topn_result = entropy_search.get_topn_spec_idx_and_similarity(similarity_array=result, topn=topn)
+        A query peak is matched to at most one peak of a library spectrum, as the peaks are more than ``2 * max_ms2_tolerance_in_da`` apart,
+        and its score increases with the intensity of the library peak. So the score of each query peak is bounded by the maximum intensity of
+        the library peaks in its m/z window, read from ``max_intensity_ions.bin`` and ``max_intensity_nl.bin`` of the group.
 
-            # Get the global spec_idx
-            topn_result_idx = [self.group_start[group] + idx for idx in topn_result_idx]
+        Parameters
+        ----------
+        method : {"identity", "open", "neutral_loss", "hybrid"}
+            The search mode.
 
-            # Combine the results
-            all_topn_result.append(topn_result)
-            all_topn_result_idx.append(topn_result_idx)
+        The other parameters are the same as in :meth:`identity_search`, ``peaks`` are the cleaned query peaks.
 
-        # Sort and collect topn results
-        all_result = np.concatenate(all_topn_result)
-        all_result_idx = np.concatenate(all_topn_result_idx)
+        Returns
+        -------
+        list of float
+            The upper bound of the similarity for each group, ``numpy.inf`` for the groups without the maximum intensity files.
+        """
+        peaks = np.asarray(peaks, dtype=np.float32)
+        if len(peaks) == 0:
+            return [0.0] * len(self.group_start)
+
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
+        # Widen the windows a little, so the rounding of float32 m/z never drops a matched peak.
+        all_ms2_tolerance = all_ms2_tolerance + 1e-3
+        peaks = self.entropy_search._preprocess_peaks(peaks)
+        query_intensity = peaks[:, 1].astype(np.float64)
+        all_window = []
+        if method != "neutral_loss":
+            all_window.append((0, peaks[:, 0].astype(np.float64)))
+        if method == "neutral_loss" or method == "hybrid":
+            all_window.append((1, float(precursor_mz) - peaks[:, 0].astype(np.float64)))
+        all_window = [(i, _get_max_intensity_bin(all_mz - all_ms2_tolerance), _get_max_intensity_bin(all_mz + all_ms2_tolerance)) for i, all_mz in all_window]
+
+        all_bound = []
+        for group in range(len(self.group_start)):
+            max_intensity = self._get_max_intensity(self.path_data / f"{group}")
+            if max_intensity is None:
+                all_bound.append(np.inf)
+                continue
+
+            library_intensity = np.zeros(len(peaks), dtype=np.float64)
+            for i, all_bin_min, all_bin_max in all_window:
+                library_intensity = np.maximum(library_intensity, _get_window_max_intensity(max_intensity[i], all_bin_min, all_bin_max))
+
+            intensity_mix = query_intensity + library_intensity
+            with np.errstate(divide="ignore", invalid="ignore"):
+                score = intensity_mix * np.log2(intensity_mix) - query_intensity * np.log2(query_intensity) - library_intensity * np.log2(library_intensity)
+            score = np.where((query_intensity > 0) & (library_intensity > 0), score, 0)
+            # Leave a margin for the float32 rounding of the similarity.
+            all_bound.append(float(np.sum(score)) + 1e-4)
+        return all_bound
+
+    def _get_max_intensity(self, group_path: Path):
+        """
+        Get the maximum intensity of the product ions and neutral losses of a group in each m/z bin, cached in the same way as the search engine in :meth:`_assign_entropy_search`.
 
-        collected_idx = np.argsort(all_result)[::-1][:topn]
-        collected_result = all_result[collected_idx]
-        collected_result_idx = all_result_idx[collected_idx].astype(np.uint64)
+        Parameters
+        ----------
+        group_path : Path
+            The path to the directory containing the index files for a specific group of spectra.
 
-        output_result = []
-        # Fetch metadata
-        if need_metadata == True:
-            for i, spec_idx in enumerate(collected_result_idx):
-                spec_metadata = self[spec_idx]
-                spec_metadata[f"{method}_search_entropy_similarity"] = collected_result[i]
-                output_result.append(spec_metadata)
+        Returns
+        -------
+        tuple of numpy.ndarray or None
+            The maximum intensity of the product ions and the neutral losses, ``None`` if the group was written without ``max_intensity_ions.bin`` and ``max_intensity_nl.bin``.
+        """
+        group_key = str(group_path.absolute())
+        generation = _group_generation.get(group_key, 0)
+        cached_max_intensity = _group_max_intensity_cache.get(group_key)
+        if cached_max_intensity is not None and cached_max_intensity[0] == generation:
+            return cached_max_intensity[1]
 
-            return output_result
+        file_ions, file_nl = group_path / "max_intensity_ions.bin", group_path / "max_intensity_nl.bin"
+        max_intensity = None
+        if file_ions.exists() and file_nl.exists():
+            max_intensity = tuple(np.memmap(file, mode="r", dtype=np.float32) if file.stat().st_size > 0 else np.zeros(0, dtype=np.float32) for file in [file_ions, file_nl])
 
-        else:
-            # If need_metadata is False, return will be (global_spec_idx, final_result). There will be a consistent one-to-one match between these two elements.
-            return list(zip(collected_result_idx, collected_result))
+        _group_max_intensity_cache[group_key] = (generation, max_intensity)
+        return max_intensity
 
     def _assign_entropy_search(
             self,
@@ -971,6 +1222,8 @@ class DynamicEntropySearch:
         This method inspects the index directory for the specified group and determines whether the group uses the dynamic index format (``information_dynamic.json``) or 
         the Flash Entropy Search format (``information.json``). It then loads and returns an initialized search engine instance corresponding to the detected format.
 
+        The engine is opened once and cached, so the following searches do not read the index files again. It is reopened after the group is modified.
+
         Parameters
         ----------
         group_path : Path
@@ -983,21 +1236,133 @@ class DynamicEntropySearch:
 
 
         """
-        
+        engine_key = (str(group_path.absolute()), self.intensity_weight, self.score_partition_size)
+        generation = _group_generation.get(engine_key[0], 0)
+        cached_engine = _group_engine_cache.get(engine_key)
+        if cached_engine is not None and cached_engine[0] == generation:
+            return cached_engine[1]
+
         if (group_path/"information_dynamic.json").exists():
-            entropy_search=self.entropy_search
-            entropy_search.path_data=group_path
+            entropy_search = DynamicEntropySearchCore(
+                path_data=group_path,
+                max_ms2_tolerance_in_da=self.max_ms2_tolerance_in_da,
+                extend_fold=self.extend_fold,
+                mass_per_block=self.mass_per_block,
+                max_indexed_mz=self.max_indexed_mz,
+                intensity_weight=self.intensity_weight,
+                score_partition_size=self.score_partition_size,
+            )
         elif (group_path/"information.json").exists():
             entropy_search = DynamicWithFlash(
-                path_data=group_path, max_ms2_tolerance_in_da=self.max_ms2_tolerance_in_da, intensity_weight=self.intensity_weight
+                path_data=group_path,
+                max_ms2_tolerance_in_da=self.max_ms2_tolerance_in_da,
+                intensity_weight=self.intensity_weight,
+                score_partition_size=self.score_partition_size,
             )
         else:
             raise FileNotFoundError("Neither information.json nor information_dynamic.json exists. Failed to assign entropy search.")
         
         entropy_search.read()
+        _group_engine_cache[engine_key] = (generation, entropy_search)
 
         return entropy_search
+
+    def _get_identity_spectra_mask(self, group_path: Path, precursor_mz, ms1_tolerance_in_da):
+        """
+        Find the spectra in a group with the precursor m/z within ``ms1_tolerance_in_da`` of ``precursor_mz``.
+
+        The range of the matched spectra is located in the sorted precursor m/z of the group by binary search,
+        then only the spectra in the range are checked by ``abs(precursor_mz_array - precursor_mz) <= ms1_tolerance_in_da``.
+
+        Parameters
+        ----------
+        group_path : Path
+            The path to the directory containing the index files for a specific group of spectra.
+
+        precursor_mz : float
+            The precursor m/z value of the query spectrum.
+
+        ms1_tolerance_in_da : float
+            MS1 (precursor m/z) tolerance in Daltons.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            A boolean array over the spectra of the group, ``True`` for the matched spectra.  
+            ``None`` if no spectrum is matched.
+        """
+        precursor_mz_sorted, precursor_mz_order = self._get_sorted_precursor_mz(group_path=group_path)
+
+        # Widen the range by a few float32 steps, so the rounding of the bounds never drops a matched spectrum.
+        margin = 4 * float(np.spacing(np.float32(abs(precursor_mz) + ms1_tolerance_in_da)))
+        idx_min = np.searchsorted(precursor_mz_sorted, np.float32(precursor_mz - ms1_tolerance_in_da - margin), side="left")
+        idx_max = np.searchsorted(precursor_mz_sorted, np.float32(precursor_mz + ms1_tolerance_in_da + margin), side="right")
+        is_matched = abs(precursor_mz_sorted[idx_min:idx_max] - precursor_mz) <= ms1_tolerance_in_da
+        if not is_matched.any():
+            return None
+
+        spectra_mask = np.zeros(len(precursor_mz_order), dtype=bool)
+        spectra_mask[precursor_mz_order[idx_min:idx_max][is_matched]] = True
+        return spectra_mask
+
+    def _get_sorted_precursor_mz(self, group_path: Path):
+        """
+        Get the sorted precursor m/z of the spectra in a group, and the index of the spectra in this order.
+
+        They are read from ``precursor_mz_sorted.bin`` and ``precursor_mz_order.bin``, and cached in the same way as the search engine in :meth:`_assign_entropy_search`.
+        For the groups written without these files, they are computed from ``precursor_mz_array.bin``.
+
+        Parameters
+        ----------
+        group_path : Path
+            The path to the directory containing the index files for a specific group of spectra.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The sorted precursor m/z (``float32``) and the index of the spectra in this order (``uint32``).
+        """
+        group_key = str(group_path.absolute())
+        generation = _group_generation.get(group_key, 0)
+        cached_precursor_mz = _group_precursor_mz_cache.get(group_key)
+        if cached_precursor_mz is not None and cached_precursor_mz[0] == generation:
+            return cached_precursor_mz[1]
+
+        precursor_mz_file = group_path / "precursor_mz_array.bin"
+        if not precursor_mz_file.exists():
+            raise RuntimeError("Precursor_mz_array not loaded. Call add_new_spectra(...) first. ")
+        precursor_mz_array = np.memmap(precursor_mz_file, mode="r", dtype=np.float32)
+
+        file_sorted, file_order = group_path / "precursor_mz_sorted.bin", group_path / "precursor_mz_order.bin"
+        precursor_mz_sorted = None
+        if file_sorted.exists() and file_order.exists():
+            precursor_mz_sorted = np.memmap(file_sorted, mode="r", dtype=np.float32)
+            precursor_mz_order = np.memmap(file_order, mode="r", dtype=np.uint32)
+        if precursor_mz_sorted is None or len(precursor_mz_sorted) != len(precursor_mz_array):
+            precursor_mz_order = np.argsort(precursor_mz_array, kind="stable").astype(np.uint32)
+            precursor_mz_sorted = precursor_mz_array[precursor_mz_order]
+
+        _group_precursor_mz_cache[group_key] = (generation, (precursor_mz_sorted, precursor_mz_order))
+        return precursor_mz_sorted, precursor_mz_order
+
+    def _update_group_generation(self, group_path: Path):
+        """
+        Increase the generation of a group after its files are modified, so the cached search engine, precursor m/z and maximum intensity of the group are reopened.
+
+        Parameters
+        ----------
+        group_path : Path
+            The path to the directory containing the index files of the modified group.
+        """
+        group_key = str(group_path.absolute())
+        _group_generation[group_key] = _group_generation.get(group_key, 0) + 1
+        # Drop the outdated objects now, so the memory maps of the old files are closed.
+        _group_precursor_mz_cache.pop(group_key, None)
+        _group_max_intensity_cache.pop(group_key, None)
+        for engine_key in [x for x in _group_engine_cache if x[0] == group_key]:
+            del _group_engine_cache[engine_key]
         
+
     def convert_to_fast_search(
         self,
     ):
@@ -1024,6 +1389,7 @@ class DynamicEntropySearch:
                 self.entropy_search.read()
                 self.entropy_search.convert_to_fast_search()
                 self.entropy_search.write()
+                self._update_group_generation(self.path_data / f"{group}")
 
         return
 
@@ -1043,9 +1409,13 @@ class DynamicEntropySearch:
 
         """
         # Use this function after using `convert_to_fast_search()`
+        self._update_group_generation(self.entropy_search.path_data)
         flash_ions, flash_nl = self.entropy_search._extract_data_for_flash()
         dynamic_with_flash = DynamicWithFlash(
-            path_data=self.entropy_search.path_data, max_ms2_tolerance_in_da=self.max_ms2_tolerance_in_da, intensity_weight=self.intensity_weight
+            path_data=self.entropy_search.path_data,
+            max_ms2_tolerance_in_da=self.max_ms2_tolerance_in_da,
+            intensity_weight=self.intensity_weight,
+            score_partition_size=self.score_partition_size,
         )
 
         dynamic_with_flash.total_peaks_num = self.entropy_search.total_peaks_num
@@ -1056,3 +1426,97 @@ class DynamicEntropySearch:
         self.entropy_search.remove_index()
         dynamic_with_flash.write()
         return
+
+
+def _add_sorted_precursor_mz(group_path: Path, precursor_mz_array):
+    """
+    Add the precursor m/z of the new spectra of a group to ``precursor_mz_sorted.bin`` and ``precursor_mz_order.bin``, which are used by the identity search.
+
+    The new spectra are sorted, then merged into the sorted run of the existing spectra; the spectra with the same precursor m/z stay in the order they were added.
+    The precursor m/z of the new spectra must be already appended to ``precursor_mz_array.bin``.
+    """
+    file_sorted, file_order = group_path / "precursor_mz_sorted.bin", group_path / "precursor_mz_order.bin"
+    total_spectra_num = (group_path / "precursor_mz_array.bin").stat().st_size // 4
+    start_idx = total_spectra_num - len(precursor_mz_array)
+
+    if file_sorted.exists() and file_order.exists():
+        precursor_mz_sorted = np.fromfile(file_sorted, dtype=np.float32)
+        precursor_mz_order = np.fromfile(file_order, dtype=np.uint32)
+    else:
+        precursor_mz_sorted, precursor_mz_order = np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.uint32)
+
+    if len(precursor_mz_sorted) == start_idx:
+        new_order = np.argsort(precursor_mz_array, kind="stable")
+        new_sorted = precursor_mz_array[new_order]
+        insert_loc = np.searchsorted(precursor_mz_sorted, new_sorted, side="right")
+        precursor_mz_sorted = np.insert(precursor_mz_sorted, insert_loc, new_sorted)
+        precursor_mz_order = np.insert(precursor_mz_order, insert_loc, (new_order + start_idx).astype(np.uint32))
+    else:
+        # The files are missing or out of date, sort all the spectra of the group.
+        all_precursor_mz = np.fromfile(group_path / "precursor_mz_array.bin", dtype=np.float32)
+        precursor_mz_order = np.argsort(all_precursor_mz, kind="stable").astype(np.uint32)
+        precursor_mz_sorted = all_precursor_mz[precursor_mz_order]
+
+    # Write to new files and replace the old files, the cached memory maps of the old files should be closed before.
+    for array, file in [(precursor_mz_sorted, file_sorted), (precursor_mz_order, file_order)]:
+        file_tmp = file.with_suffix(".tmp")
+        array.tofile(file_tmp)
+        file_tmp.replace(file)
+
+
+def _add_max_intensity(group_path: Path, spectra_list, preprocess_peaks):
+    """
+    Add the peaks of the new spectra of a group to ``max_intensity_ions.bin`` and ``max_intensity_nl.bin``, which are used to bound the similarity of the group.
+
+    The files store the maximum intensity of the product ions and the neutral losses in each m/z bin of ``_MAX_INTENSITY_BIN_WIDTH`` Da,
+    with the intensity weighted by ``preprocess_peaks`` in the same way as in the index.
+    The precursor m/z of the new spectra must be already appended to ``precursor_mz_array.bin``. For a group written without these files,
+    they are not created, as they would miss the existing spectra, and the similarity of the group is not bounded.
+    """
+    file_ions, file_nl = group_path / "max_intensity_ions.bin", group_path / "max_intensity_nl.bin"
+    total_spectra_num = (group_path / "precursor_mz_array.bin").stat().st_size // 4
+    if total_spectra_num > len(spectra_list) and not (file_ions.exists() and file_nl.exists()):
+        return
+
+    all_ions_mz, all_nl_mass, all_intensity = [], [], []
+    for spectrum in spectra_list:
+        peaks = preprocess_peaks(np.array(spectrum["peaks"]))
+        all_ions_mz.append(peaks[:, 0].astype(np.float32))
+        all_nl_mass.append((float(spectrum["precursor_mz"]) - peaks[:, 0]).astype(np.float32))
+        all_intensity.append(peaks[:, 1].astype(np.float32))
+    if not all_intensity:
+        return
+    all_intensity = np.concatenate(all_intensity)
+
+    for all_mz, file in [(all_ions_mz, file_ions), (all_nl_mass, file_nl)]:
+        bin_idx = _get_max_intensity_bin(np.concatenate(all_mz))
+        max_intensity = np.fromfile(file, dtype=np.float32) if file.exists() else np.zeros(0, dtype=np.float32)
+        if len(bin_idx) > 0 and bin_idx.max() >= len(max_intensity):
+            max_intensity = np.concatenate([max_intensity, np.zeros(bin_idx.max() + 1 - len(max_intensity), dtype=np.float32)])
+        np.maximum.at(max_intensity, bin_idx, all_intensity)
+
+        # Write to a new file and replace the old file, the cached memory map of the old file should be closed before.
+        file_tmp = file.with_suffix(".tmp")
+        max_intensity.tofile(file_tmp)
+        file_tmp.replace(file)
+
+
+def _get_max_intensity_bin(all_mz):
+    """
+    Get the bin of ``max_intensity_ions.bin`` and ``max_intensity_nl.bin`` for each m/z.
+    """
+    return np.clip(np.floor(np.asarray(all_mz, dtype=np.float64) / _MAX_INTENSITY_BIN_WIDTH), 0, _MAX_INTENSITY_BIN_NUM - 1).astype(np.int64)
+
+
+def _get_window_max_intensity(max_intensity, all_bin_min, all_bin_max):
+    """
+    Get the maximum intensity of the bins from ``all_bin_min`` to ``all_bin_max`` for each query peak, the bins out of ``max_intensity`` are 0.
+    """
+    window_max_intensity = np.zeros(len(all_bin_min), dtype=np.float64)
+    if len(max_intensity) == 0:
+        return window_max_intensity
+    for offset in range(int(np.max(all_bin_max - all_bin_min)) + 1):
+        all_bin = np.minimum(all_bin_min + offset, all_bin_max)
+        is_in_file = all_bin < len(max_intensity)
+        window_max_intensity = np.maximum(window_max_intensity, np.where(is_in_file, max_intensity[np.minimum(all_bin, len(max_intensity) - 1)], 0))
+    return window_max_intensity
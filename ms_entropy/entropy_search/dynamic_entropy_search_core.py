@@ -1,5 +1,11 @@
 import numpy as np
 from ..spectra import apply_weight_to_intensity
+from .flash_entropy_search_core import _radix_sort_peak_data, _generate_idx_start, _get_ms2_tolerance_array
+from .fast_flash_entropy_search import (
+    entropy_similarity_accumulate_partitioned,
+    entropy_similarity_search_blocks,
+    entropy_similarity_search_hybrid_blocks,
+)
 from pathlib import Path
 import json
 
@@ -13,6 +19,7 @@ class DynamicEntropySearchCore(object):
         mass_per_block: float = 0.05,
         max_indexed_mz: float = 1500.00005,
         intensity_weight="entropy",  # "entropy" or None
+        score_partition_size: int = 0,
     ) -> None:
         
         
@@ -47,6 +54,12 @@ class DynamicEntropySearchCore(object):
             If ``None``, raw intensity values are used.  
             Default is ``"entropy"``.
 
+        score_partition_size : int, optional
+            Number of spectra in each partition of the similarity array, rounded down to a power of 2.  
+            If larger than 0, the matched peaks of a query are bucketed by partition and accumulated partition by partition,
+            which avoids the cache misses of scattering into a large similarity array. The result is identical.  
+            Default is ``0`` (disabled).
+
 
         Returns
         -------
@@ -59,6 +72,7 @@ class DynamicEntropySearchCore(object):
         assert extend_fold > 1, "The extend_fold should be larger than 1."
         self.extend_fold = extend_fold
         self.intensity_weight = intensity_weight
+        self.score_partition_size = score_partition_size
 
         self.total_spectra_num = 0
         self.total_peaks_num = 0
@@ -67,6 +81,8 @@ class DynamicEntropySearchCore(object):
         self.path_data.mkdir(parents=True, exist_ok=True)
 
         self.index = []
+        # The memory maps of "ions_data.bin" and "nl_data.bin", opened by the first search and dropped when the index is read or modified.
+        self._block_data = {}
 
         self.dtype_block_data = np.dtype(
             [
@@ -92,7 +108,7 @@ class DynamicEntropySearchCore(object):
                 ("start_idx", np.uint64),  # The start index of the block.
                 ("data_len", np.uint32),  # The length of data in the block.
                 ("reserved_len", np.uint32),  # The reserved length of the block.
-                ("is_sorted", bool),  # Whether the block is sorted or not
+                ("sorted_len", np.uint32),  # The length of the sorted part at the beginning of the block, the rest of the block is unsorted.
             ]
         )
         self.index_names = [
@@ -111,6 +127,8 @@ class DynamicEntropySearchCore(object):
         precursor_mz=None,
         peaks=None,
         ms2_tolerance_in_da=0.02,
+        ms2_tolerance_in_ppm=None,
+        spectra_mask=None,
     ):
         
         """
@@ -139,6 +157,19 @@ class DynamicEntropySearchCore(object):
             Must be less than or equal to ``max_ms2_tolerance_in_da``.  
             Default is ``0.02``.
 
+        ms2_tolerance_in_ppm : float, optional
+            Fragment mass tolerance (ppm) used for peak matching.  
+            If positive, it is used instead of ``ms2_tolerance_in_da``, the tolerance of a query peak at m/z ``x``
+            is ``x * ms2_tolerance_in_ppm * 1e-6`` Da and must be less than or equal to ``max_ms2_tolerance_in_da``.  
+            For neutral-loss search, the m/z of the fragment ion is used.  
+            Default is ``None``.
+
+        spectra_mask : numpy.ndarray, optional
+            A boolean array with the length of the number of spectra in the library. Only the spectra with ``True`` are searched,
+            the matched peaks of the other spectra are skipped before they are scored and their similarity is 0.  
+            The identity search uses it to only score the spectra with a matched precursor m/z.  
+            Default is ``None`` (search all spectra).
+
         Returns
         -------
         numpy.ndarray
@@ -154,7 +185,7 @@ class DynamicEntropySearchCore(object):
             return np.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Check peaks
-        assert ms2_tolerance_in_da <= self.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
         assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
         assert (
             peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
@@ -172,14 +203,14 @@ class DynamicEntropySearchCore(object):
         # Prepare the library
         if method == "open":
             # open search library
-            block_ions_data = np.memmap(self.path_data / "ions_data.bin", dtype=self.dtype_block_data, mode="r")
+            block_ions_data = self._get_block_data("ions_data.bin")
             block_ions_info = block_product_info
 
         elif method == "neutral_loss":
             if precursor_mz is None:
                 raise ValueError("precursor_mz should not be None in 'neutral_loss' method.")
             # neutral loss search library
-            block_ions_data = np.memmap(self.path_data / "nl_data.bin", dtype=self.dtype_block_data_nl, mode="r")
+            block_ions_data = self._get_block_data("nl_data.bin")
             block_ions_info = block_nl_info
             # generate the nl_mass of the query spectrum
             peaks[:, 0] = float(precursor_mz) - peaks[:, 0]
@@ -190,43 +221,44 @@ class DynamicEntropySearchCore(object):
         entropy_similarity = np.zeros(self.total_spectra_num, dtype=np.float32)
 
         # find the block location of query peaks; same process for both open search and neutral loss search
-        min_block_query_idx, max_block_query_idx = self._locate_query_peaks(peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
-        # Go through all the peaks in the spectrum
-        for i, (mz_query, intensity_query) in enumerate(peaks):
-            # Determine the mz index range
-            wanted_block_left = min_block_query_idx[i]
-            wanted_block_right = max_block_query_idx[i]
-
-            for block in range(wanted_block_left, (wanted_block_right + 1)):
-                block_start_idx = block_ions_info["start_idx"][block]
-                block_length = block_ions_info["data_len"][block]
-                block_is_sorted = block_ions_info["is_sorted"][block]
-                selected_block_data = block_ions_data[block_start_idx : (block_start_idx + block_length)]
-                selected_block_data_mass = selected_block_data["mass"]
-                if block_is_sorted == False:
-                    select_filter = np.bitwise_and(
-                        (mz_query - ms2_tolerance_in_da <= selected_block_data_mass), (selected_block_data_mass <= mz_query + ms2_tolerance_in_da)
-                    )
-                    block_spec_idx = selected_block_data["spec_idx"][select_filter]
-                    block_intensity = selected_block_data["intensity"][select_filter]
-
-                    if np.all(select_filter == 0):
-                        continue
-
-                elif block_is_sorted == True:
-                    left_idx = np.searchsorted(selected_block_data_mass, mz_query - ms2_tolerance_in_da, side="left")
-                    right_idx = np.searchsorted(selected_block_data_mass, mz_query + ms2_tolerance_in_da, side="right")
-
-                    if left_idx == right_idx:
-                        continue
-                    block_spec_idx = selected_block_data["spec_idx"][left_idx:right_idx]
-                    block_intensity = selected_block_data["intensity"][left_idx:right_idx]
-
-                entropy_similarity[block_spec_idx] += self._score_peaks_with_cpu(intensity_query, block_intensity)
-
+        min_block_query_idx, max_block_query_idx = self._locate_query_peaks(peaks=peaks, all_ms2_tolerance=all_ms2_tolerance)
+        visit_loc, visit_start, visit_len, visit_sorted_len = _get_block_visit(block_ions_info, min_block_query_idx, max_block_query_idx)
+        if spectra_mask is not None:
+            spectra_mask = np.ascontiguousarray(spectra_mask, dtype=bool)
+            assert spectra_mask.shape == (self.total_spectra_num,), "The length of the spectra mask should be the same as the number of spectra."
+            spectra_mask = spectra_mask.view(np.uint8)
+
+        # Go through all the peaks in the spectrum, the blocks are scanned by a compiled kernel.
+        search_parameters = dict(
+            visit_loc=visit_loc,
+            visit_start=visit_start,
+            visit_len=visit_len,
+            visit_sorted_len=visit_sorted_len,
+            all_mass_min=peaks[:, 0] - all_ms2_tolerance,
+            all_mass_max=peaks[:, 0] + all_ms2_tolerance,
+            all_intensity=np.ascontiguousarray(peaks[:, 1]),
+            data_spec_idx=block_ions_data["spec_idx"],
+            data_mass=block_ions_data["mass"],
+            data_intensity=block_ions_data["intensity"],
+            entropy_similarity=entropy_similarity,
+            spectra_mask=spectra_mask,
+        )
+        if self.score_partition_size > 0:
+            posting_spec_idx = np.empty(int(np.sum(visit_len)), dtype=np.uint32)
+            posting_value = np.empty(len(posting_spec_idx), dtype=np.float32)
+            posting_num = entropy_similarity_search_blocks(**search_parameters, posting_spec_idx=posting_spec_idx, posting_value=posting_value)
+            if posting_num > 0:
+                entropy_similarity_accumulate_partitioned(
+                    posting_spec_idx[:posting_num],
+                    posting_value[:posting_num],
+                    entropy_similarity,
+                    max(int(self.score_partition_size).bit_length() - 1, 0),
+                )
+        else:
+            entropy_similarity_search_blocks(**search_parameters, posting_spec_idx=None, posting_value=None)
         return entropy_similarity
 
-    def search_hybrid(self, precursor_mz, peaks, ms2_tolerance_in_da=0.02):
+    def search_hybrid(self, precursor_mz, peaks, ms2_tolerance_in_da=0.02, ms2_tolerance_in_ppm=None):
 
         """
         Perform hybrid search against the MS/MS spectral index.
@@ -249,6 +281,11 @@ class DynamicEntropySearchCore(object):
             Must be ≤ ``max_ms2_tolerance_in_da``.  
             Default is ``0.02``.
 
+        ms2_tolerance_in_ppm : float, optional
+            Mass tolerance (ppm) for fragment matching, used instead of ``ms2_tolerance_in_da`` if positive.  
+            The tolerance of both the fragment ion and the neutral loss of a query peak is computed from its m/z.  
+            Default is ``None``.
+
         Returns
         -------
         numpy.ndarray
@@ -265,7 +302,7 @@ class DynamicEntropySearchCore(object):
             return np.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Check peaks
-        assert ms2_tolerance_in_da <= self.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
         assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
         assert (
             peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
@@ -277,170 +314,79 @@ class DynamicEntropySearchCore(object):
 
         [block_ions_info, block_nl_info] = self.index
 
-        ###############################################################
-        # Match the original product ion
-        # find the block location of query peaks for open search
-        min_block_query_idx, max_block_query_idx = self._locate_query_peaks(peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
-
-        block_ions_data = np.memmap(self.path_data / "ions_data.bin", dtype=self.dtype_block_data, mode="r")
+        # Find the blocks visited by the query peaks for the product ions and the neutral losses
+        min_block_query_idx, max_block_query_idx = self._locate_query_peaks(peaks=peaks, all_ms2_tolerance=all_ms2_tolerance)
+        visit_loc, visit_start, visit_len, visit_sorted_len = _get_block_visit(block_ions_info, min_block_query_idx, max_block_query_idx)
 
-        ###############################################################
-        # Match the neutral loss ions
-        # find the block location of query peaks for neutral loss search
         nl_peaks = np.copy(peaks)
         nl_peaks[:, 0] = float(precursor_mz) - peaks[:, 0]
-        nl_min_block_query_idx, nl_max_block_query_idx = self._locate_query_peaks(peaks=nl_peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
+        nl_min_block_query_idx, nl_max_block_query_idx = self._locate_query_peaks(peaks=nl_peaks, all_ms2_tolerance=all_ms2_tolerance)
+        nl_visit_loc, nl_visit_start, nl_visit_len, nl_visit_sorted_len = _get_block_visit(block_nl_info, nl_min_block_query_idx, nl_max_block_query_idx)
 
-        block_nl_data = np.memmap(self.path_data / "nl_data.bin", dtype=self.dtype_block_data_nl, mode="r")
-
-        # collect the ions information based on the block_query_idx
+        block_ions_data = self._get_block_data("ions_data.bin")
+        block_nl_data = self._get_block_data("nl_data.bin")
 
         entropy_similarity = np.zeros(self.total_spectra_num, dtype=np.float32)
+        all_ions_mz_left = peaks[:, 0] - all_ms2_tolerance
+        all_ions_mz_right = peaks[:, 0] + all_ms2_tolerance
+        entropy_similarity_search_hybrid_blocks(
+            visit_loc=visit_loc,
+            visit_start=visit_start,
+            visit_len=visit_len,
+            visit_sorted_len=visit_sorted_len,
+            all_mass_min=all_ions_mz_left,
+            all_mass_max=all_ions_mz_right,
+            nl_visit_loc=nl_visit_loc,
+            nl_visit_start=nl_visit_start,
+            nl_visit_len=nl_visit_len,
+            nl_visit_sorted_len=nl_visit_sorted_len,
+            all_nl_mass_min=nl_peaks[:, 0] - all_ms2_tolerance,
+            all_nl_mass_max=nl_peaks[:, 0] + all_ms2_tolerance,
+            all_intensity=np.ascontiguousarray(peaks[:, 1]),
+            all_ions_mz_left=all_ions_mz_left,
+            all_ions_mz_right=all_ions_mz_right,
+            data_spec_idx=block_ions_data["spec_idx"],
+            data_mass=block_ions_data["mass"],
+            data_intensity=block_ions_data["intensity"],
+            nl_data_fragment_mz=block_nl_data["fragment_mz"],
+            nl_data_spec_idx=block_nl_data["spec_idx"],
+            nl_data_mass=block_nl_data["mass"],
+            nl_data_intensity=block_nl_data["intensity"],
+            entropy_similarity=entropy_similarity,
+            matched_peak=np.zeros(self.total_spectra_num, dtype=np.uint32),
+        )
 
-        all_ions_mz_left = np.array(peaks[:, 0] - ms2_tolerance_in_da, dtype=np.float32)
-        all_ions_mz_right = np.array(peaks[:, 0] + ms2_tolerance_in_da, dtype=np.float32)
-
-        for i, (mz_query, intensity_query) in enumerate(peaks):
-            wanted_block_left = min_block_query_idx[i]
-            wanted_block_right = max_block_query_idx[i]
-
-            matched_spec_idx = []
-            for block in range(wanted_block_left, (wanted_block_right + 1)):
-
-                block_start_idx = block_ions_info["start_idx"][block]
-                block_length = block_ions_info["data_len"][block]
-                block_is_sorted = block_ions_info["is_sorted"][block]
-                selected_block_data = block_ions_data[block_start_idx : (block_start_idx + block_length)]
-                selected_block_data_mass = selected_block_data["mass"]
-
-                if block_is_sorted == False:
-                    select_filter = np.bitwise_and(
-                        (mz_query - ms2_tolerance_in_da <= selected_block_data_mass), (selected_block_data_mass <= mz_query + ms2_tolerance_in_da)
-                    )
-
-                    if np.all(select_filter == 0):
-                        continue
-
-                    block_spec_idx = selected_block_data["spec_idx"][select_filter]
-                    block_intensity = selected_block_data["intensity"][select_filter]
-
-                elif block_is_sorted == True:
-
-                    left_idx = np.searchsorted(selected_block_data_mass, mz_query - ms2_tolerance_in_da, side="left")
-                    right_idx = np.searchsorted(selected_block_data_mass, mz_query + ms2_tolerance_in_da, side="right")
-
-                    if left_idx == right_idx:
-                        continue
-                    block_spec_idx = selected_block_data["spec_idx"][left_idx:right_idx]
-                    block_intensity = selected_block_data["intensity"][left_idx:right_idx]
-                entropy_similarity[block_spec_idx] += self._score_peaks_with_cpu(intensity_query, block_intensity)
-
-                matched_spec_idx.append(block_spec_idx)
-
-            if matched_spec_idx:
-                matched_spectra_idx = np.concatenate(matched_spec_idx, dtype=np.uint32)
-            else:
-                matched_spectra_idx = np.zeros(shape=(0,), dtype=np.uint32)
-
-            nl_mass = float(precursor_mz) - mz_query
-            nl_wanted_block_left = nl_min_block_query_idx[i]
-            nl_wanted_block_right = nl_max_block_query_idx[i]
-
-            nl_spec_idx = []
-            nl_intensity = []
-            nl_fragment_mz = []
-            for nl_block in range(nl_wanted_block_left, (nl_wanted_block_right + 1)):
-                nl_block_start_idx = block_nl_info["start_idx"][nl_block]
-                nl_block_length = block_nl_info["data_len"][nl_block]
-                nl_block_is_sorted = block_nl_info["is_sorted"][nl_block]
-                selected_nl_data = block_nl_data[nl_block_start_idx : (nl_block_start_idx + nl_block_length)]
-                selected_nl_data_mass = selected_nl_data["mass"]
-
-                if nl_block_is_sorted == False:
-                    select_nl_filter = np.bitwise_and(
-                        (nl_mass - ms2_tolerance_in_da <= selected_nl_data_mass), (selected_nl_data_mass <= nl_mass + ms2_tolerance_in_da)
-                    )
-
-                    if np.all(select_nl_filter == 0):
-                        continue
-
-                    nl_block_spec_idx = selected_nl_data["spec_idx"][select_nl_filter]
-                    nl_block_intensity = selected_nl_data["intensity"][select_nl_filter]
-                    nl_block_fragment_mz = selected_nl_data["fragment_mz"][select_nl_filter]
-
-                elif nl_block_is_sorted == True:
-
-                    left_nl_idx = np.searchsorted(selected_nl_data_mass, nl_mass - ms2_tolerance_in_da, side="left")
-                    right_nl_idx = np.searchsorted(selected_nl_data_mass, nl_mass + ms2_tolerance_in_da, side="right")
-
-                    if left_nl_idx == right_nl_idx:
-                        continue
-
-                    nl_block_spec_idx = selected_nl_data["spec_idx"][left_nl_idx:right_nl_idx]
-                    nl_block_intensity = selected_nl_data["intensity"][left_nl_idx:right_nl_idx]
-                    nl_block_fragment_mz = selected_nl_data["fragment_mz"][left_nl_idx:right_nl_idx]
-
-                nl_spec_idx.append(nl_block_spec_idx)
-                nl_intensity.append(nl_block_intensity)
-                nl_fragment_mz.append(nl_block_fragment_mz)
-
-            if nl_spec_idx:
-                nl_all_spectra_idx = np.concatenate(nl_spec_idx)
-                nl_all_fragment_mz = np.concatenate(nl_fragment_mz)
-                nl_all_intensity = np.concatenate(nl_intensity)
-
-                # Check if the neutral loss ion is already matched to other query peak as a product ion
-                modified_value_nl = self._score_peaks_with_cpu(intensity_query, nl_all_intensity)
-                f1 = np.searchsorted(all_ions_mz_left, nl_all_fragment_mz, side="right")
-                f2 = np.searchsorted(all_ions_mz_right, nl_all_fragment_mz, side="left")
-                modified_value_nl[f1 > f2] = 0
-
-                # Check if this query peak is already matched to a product ion in the same library spectrum
-                duplicate_idx_in_nl = self._remove_duplicate_with_cpu(matched_spectra_idx, nl_all_spectra_idx, self.total_spectra_num)
+        return entropy_similarity
 
-                modified_value_nl[duplicate_idx_in_nl] = 0
-                entropy_similarity[nl_all_spectra_idx] += modified_value_nl
+    def _get_block_data(self, name):
+        """
+        Get the memory map of the block data file ``name``, "ions_data.bin" or "nl_data.bin".
 
-        return entropy_similarity
+        The file is mapped once and reused by the following searches. The maps are dropped when the index is read, built or modified,
+        as the blocks can be moved and the file can grow.
+        """
+        block_data = self._block_data.get(name)
+        if block_data is None:
+            dtype = self.dtype_block_data if name == "ions_data.bin" else self.dtype_block_data_nl
+            block_data = np.memmap(self.path_data / name, dtype=dtype, mode="r")
+            self._block_data[name] = block_data
+        return block_data
 
-    def _locate_query_peaks(self, peaks: np.ndarray, ms2_tolerance_in_da: np.float32):
-        # Find the block location of query peaks
+    def _locate_query_peaks(self, peaks: np.ndarray, all_ms2_tolerance: np.ndarray):
+        # Find the block location of query peaks, the tolerance is given for each query peak
 
         search_array = np.arange(0.0, self.max_indexed_mz, self.mass_per_block)
         blocks_num = len(search_array)
         last_idx = blocks_num - 1
 
-        min_block_query_idx = np.zeros(peaks.shape[0], dtype=np.int64)
-        max_block_query_idx = np.zeros(peaks.shape[0], dtype=np.int64)
-
-        for peak_idx, (mz_query, _) in enumerate(peaks):
-            left = int((mz_query - ms2_tolerance_in_da) / self.mass_per_block)
-            right = int((mz_query + ms2_tolerance_in_da) / self.mass_per_block)
+        min_block_query_idx = ((peaks[:, 0] - all_ms2_tolerance) / self.mass_per_block).astype(np.int64)
+        max_block_query_idx = ((peaks[:, 0] + all_ms2_tolerance) / self.mass_per_block).astype(np.int64)
 
-            left = max(0, min(left, last_idx))
-            right = max(0, min(right, last_idx))
-
-            min_block_query_idx[peak_idx] = left
-            max_block_query_idx[peak_idx] = right
+        np.clip(min_block_query_idx, 0, last_idx, out=min_block_query_idx)
+        np.clip(max_block_query_idx, 0, last_idx, out=max_block_query_idx)
 
         return min_block_query_idx, max_block_query_idx
 
-    def _remove_duplicate_with_cpu(self, array_1, array_2, max_element):
-        if len(array_1) + len(array_2) < 4_000_000:
-            # When len(array_1) + len(array_2) < 4_000_000, this method is faster than array method
-            aux = np.concatenate((array_1, array_2))
-            aux_sort_indices = np.argsort(aux, kind="mergesort")
-            aux = aux[aux_sort_indices]
-            mask = aux[1:] == aux[:-1]
-            array2_indices = aux_sort_indices[1:][mask] - array_1.size
-            return array2_indices
-        else:
-            # When len(array_1) + len(array_2) > 4_000_000, this method is faster than sort method
-            note = np.zeros(max_element, dtype=np.int8)
-            note[array_1] = 1
-            duplicate_idx = np.where(note[array_2] == 1)[0]
-            return duplicate_idx
-
     def build_index(self, all_spectra_list: list, index_for_neutral_loss: bool = True):
 
         """
@@ -475,6 +421,7 @@ class DynamicEntropySearchCore(object):
             The method updates internal index structures in-place.
 
         """
+        self._block_data = {}
 
         # Get the total number of spectra and peaks
         total_peaks_num = int(np.sum([np.array(spectrum["peaks"]).shape[0] for spectrum in all_spectra_list]))
@@ -554,7 +501,7 @@ class DynamicEntropySearchCore(object):
         extend_fold = self.extend_fold
         ### Open Search ###
         # Sort with precursor m/z
-        peak_data.sort(order="ion_mz")
+        _radix_sort_peak_data(peak_data, "ion_mz")
         # Assign the index of the product ions.
 
         search_array = np.arange(0.0, self.max_indexed_mz, self.mass_per_block)
@@ -564,10 +511,9 @@ class DynamicEntropySearchCore(object):
         with open(self.path_data / "ions_data.bin", "wb") as f_block_ions_data:
             # Assign the open search block
             block_ions_info = np.empty(blocks_num, dtype=self.dtype_block_info)
-            block_ions_info["is_sorted"] = True * blocks_num
 
             block_data_cur_idx = 0
-            block_start_loc_array = np.searchsorted(peak_data["ion_mz"], search_array, side="left")
+            block_start_loc_array = _generate_idx_start(peak_data["ion_mz"], search_array)
 
             for block_idx in range(blocks_num):
                 block_start_loc = block_start_loc_array[block_idx]
@@ -582,6 +528,7 @@ class DynamicEntropySearchCore(object):
                 block_ions_info[block_idx]["start_idx"] = block_data_cur_idx
                 block_ions_info[block_idx]["data_len"] = data_len
                 block_ions_info[block_idx]["reserved_len"] = reserved_len
+                block_ions_info[block_idx]["sorted_len"] = data_len
 
                 if block_end_loc == block_start_loc:
                     # If there are no peaks in this block, skip it.
@@ -603,16 +550,14 @@ class DynamicEntropySearchCore(object):
         ### Neutral Loss Search ###
         if index_for_neutral_loss:
             # Sort with the neutral loss mass.
-            peak_data.sort(order="nl_mass")
+            _radix_sort_peak_data(peak_data, "nl_mass")
             # Record the nl_mass, intensity, spectrum index, and product ions index information for neutral loss ions.
             with open(self.path_data / "nl_data.bin", "wb") as f_block_nl_data:
                 # Assign the neutral_loss search block
                 block_nl_info = np.empty(blocks_num, dtype=self.dtype_block_info)
 
-                block_nl_info["is_sorted"] = True * blocks_num
-
                 block_data_cur_idx = 0
-                block_start_loc_array = np.searchsorted(peak_data["nl_mass"], search_array, side="left")
+                block_start_loc_array = _generate_idx_start(peak_data["nl_mass"], search_array)
 
                 for block_idx in range(blocks_num):
                     block_start_loc = block_start_loc_array[block_idx]
@@ -627,6 +572,7 @@ class DynamicEntropySearchCore(object):
                     block_nl_info[block_idx]["start_idx"] = block_data_cur_idx
                     block_nl_info[block_idx]["data_len"] = data_len
                     block_nl_info[block_idx]["reserved_len"] = reserved_len
+                    block_nl_info[block_idx]["sorted_len"] = data_len
 
                     if block_end_loc == block_start_loc:
                         # If there are no peaks in this block, skip it.
@@ -668,11 +614,6 @@ class DynamicEntropySearchCore(object):
 
         return peaks_clean
 
-    def _score_peaks_with_cpu(self, intensity_query, intensity_library):
-        intensity_mix = intensity_library + intensity_query
-        modified_value = intensity_mix * np.log2(intensity_mix) - intensity_library * np.log2(intensity_library) - intensity_query * np.log2(intensity_query)
-        return modified_value
-
     def read(self, path_data=None):
 
         """
@@ -699,6 +640,7 @@ class DynamicEntropySearchCore(object):
         """
         
 
+        self._block_data = {}
         try:
             if path_data is None:
                 path_data = self.path_data
@@ -716,18 +658,18 @@ class DynamicEntropySearchCore(object):
             self.max_indexed_mz = information["max_indexed_mz"]
 
             is_nl_indexed = information["neutral_loss_indexed"]
+            # The index written before the sorted length was tracked only has a flag for whether the block is sorted.
+            is_sorted_len_indexed = information.get("sorted_len_indexed", False)
 
             self.index = []
             for name in self.index_names:
-                if name == "block_ions_info":
+                if name == "block_nl_info" and not is_nl_indexed:
+                    self.index.append(None)
+                elif is_sorted_len_indexed:
                     self.index.append(np.fromfile(path_data / f"{name}.bin", dtype=self.index_dtypes[name]))
-
-                elif name == "block_nl_info":
-
-                    if is_nl_indexed:
-                        self.index.append(np.fromfile(path_data / f"{name}.bin", dtype=self.index_dtypes[name]))
-                    else:
-                        self.index.append(None)
+                else:
+                    block_info = np.fromfile(path_data / f"{name}.bin", dtype=_dtype_block_info_with_sorted_flag)
+                    self.index.append(_convert_block_info_with_sorted_flag(block_info, self.index_dtypes[name]))
 
             return True
         except:
@@ -772,6 +714,7 @@ class DynamicEntropySearchCore(object):
             "extend_fold": float(self.extend_fold),
             "max_indexed_mz": float(self.max_indexed_mz),
             "neutral_loss_indexed": self.index[1] is not None,
+            "sorted_len_indexed": True,
         }
         with open(path_data / "information_dynamic.json", "w") as f:
             json.dump(information, f)
@@ -803,6 +746,7 @@ class DynamicEntropySearchCore(object):
             path_data = self.path_data
 
         path_data = Path(path_data)
+        self._block_data = {}
 
         # Remove the block info
         (path_data / "information_dynamic.json").unlink(missing_ok=True)
@@ -826,6 +770,7 @@ class DynamicEntropySearchCore(object):
 
         This method appends new spectra to the current on-disk index structure by inserting their fragment ions (and, if available, neutral-loss mass) into existing blocks. 
         Blocks whose reserved capacity is exceeded are moved and expanded, but no global re-sorting of the full index is performed.
+        The new peaks are appended after the sorted part of each block, which is still searched by binary search, only the appended peaks are scanned.
 
         Parameters
         ----------
@@ -838,6 +783,7 @@ class DynamicEntropySearchCore(object):
             The method updates the on-disk index and in-memory block information in-place.
         
         '''
+        self._block_data = {}
 
         # Fast_update mode
         extend_fold = self.extend_fold
@@ -880,7 +826,6 @@ class DynamicEntropySearchCore(object):
                 block_data_insert["intensity"] = add_peak_data["intensity"][add_block_start_loc:add_block_end_loc]
 
                 block_ions_info["data_len"][block_idx] = block_data_new_len
-                block_ions_info["is_sorted"][block_idx] = False
                 if block_data_new_len <= reserved_len:
                     insert_location = (block_start_loc + original_part_len) * self.dtype_block_data.itemsize
                     f_block_ions_data.seek(insert_location)
@@ -934,7 +879,6 @@ class DynamicEntropySearchCore(object):
                     block_data_insert["fragment_mz"] = add_peak_data["ion_mz"][add_block_start_loc:add_block_end_loc]
 
                     block_nl_info["data_len"][block_idx] = original_part_len + insert_part_len
-                    block_nl_info["is_sorted"][block_idx] = False
 
                     block_data_new_len = original_part_len + insert_part_len
                     if block_data_new_len <= reserved_len:
@@ -972,7 +916,8 @@ class DynamicEntropySearchCore(object):
         """
         Convert the current index into fast search mode.
 
-        In fast search mode, all peaks stored in the index are sorted by their corresponding mass key:
+        In fast search mode, all peaks stored in the index are sorted by their corresponding mass key,
+        the unsorted peaks at the end of each block are sorted and merged into the sorted part:
 
         - Product-ion index is sorted by fragment m/z.
         - Neutral-loss index (if present) is sorted by neutral-loss mass.
@@ -995,19 +940,17 @@ class DynamicEntropySearchCore(object):
         original_block_ions_data = np.memmap(block_ions_data_path, dtype=self.dtype_block_data, mode="r+")
         for idx, block_info in enumerate(block_ions_info):
 
-            block_is_sorted = block_info["is_sorted"]
+            block_start_loc = block_info["start_idx"]
+            original_part_len = block_info["data_len"]
+            sorted_len = block_info["sorted_len"]
 
-            if block_is_sorted == True:
+            if sorted_len == original_part_len:
                 continue
-            elif block_is_sorted == False:
-
-                block_start_loc = block_info["start_idx"]
-                original_part_len = block_info["data_len"]
 
-                block_data = original_block_ions_data[block_start_loc : (block_start_loc + original_part_len)]
-                block_data.sort(order="mass")
+            block_data = original_block_ions_data[block_start_loc : (block_start_loc + original_part_len)]
+            block_data[:] = _merge_into_sorted_part(block_data, sorted_len)
 
-                block_ions_info[idx]["is_sorted"] = True
+            block_ions_info[idx]["sorted_len"] = original_part_len
         original_block_ions_data.flush()
 
         if block_nl_info is not None:
@@ -1016,19 +959,17 @@ class DynamicEntropySearchCore(object):
             original_block_nl_data = np.memmap(block_nl_data_path, dtype=self.dtype_block_data_nl, mode="r+")
             for idx, block_info in enumerate(block_nl_info):
 
-                block_is_sorted = block_info["is_sorted"]
+                block_start_loc = block_info["start_idx"]
+                original_part_len = block_info["data_len"]
+                sorted_len = block_info["sorted_len"]
 
-                if block_is_sorted == True:
+                if sorted_len == original_part_len:
                     continue
-                elif block_is_sorted == False:
 
-                    block_start_loc = block_info["start_idx"]
-                    original_part_len = block_info["data_len"]
+                block_data = original_block_nl_data[block_start_loc : (block_start_loc + original_part_len)]
+                block_data[:] = _merge_into_sorted_part(block_data, sorted_len)
 
-                    block_data = original_block_nl_data[block_start_loc : (block_start_loc + original_part_len)]
-                    block_data.sort(order="mass")
-
-                    block_nl_info[idx]["is_sorted"] = True
+                block_nl_info[idx]["sorted_len"] = original_part_len
             original_block_nl_data.flush()
 
         self.index = [block_ions_info, block_nl_info]
@@ -1057,6 +998,7 @@ class DynamicEntropySearchCore(object):
 
 
         """
+        self._block_data = {}
 
         extend_fold = self.extend_fold
         # collect the information of add_spectrum_list
@@ -1101,7 +1043,7 @@ class DynamicEntropySearchCore(object):
                 block_data_new["spec_idx"][original_part_len:] = add_peak_data["spec_idx"][add_block_start_loc:add_block_end_loc]
                 block_data_new["mass"][original_part_len:] = add_peak_data["ion_mz"][add_block_start_loc:add_block_end_loc]
                 block_data_new["intensity"][original_part_len:] = add_peak_data["intensity"][add_block_start_loc:add_block_end_loc]
-                block_data_new.sort(order="mass")
+                block_data_new = _merge_into_sorted_part(block_data_new, block_ions_info["sorted_len"][block_idx])
                 # if block_data_new_len <= reserved_len, insert directly
                 if block_data_new_len <= reserved_len:
                     # insert the new ion
@@ -1125,7 +1067,7 @@ class DynamicEntropySearchCore(object):
                     block_ions_info["start_idx"][block_idx] = new_start_idx
                     block_ions_info["data_len"][block_idx] = block_data_new_len
                     block_ions_info["reserved_len"][block_idx] = new_reserved_len
-                block_ions_info["is_sorted"][block_idx] = True
+                block_ions_info["sorted_len"][block_idx] = block_data_new_len
 
         if block_nl_info is not None:
             add_peak_data.sort(order="nl_mass")
@@ -1157,7 +1099,7 @@ class DynamicEntropySearchCore(object):
                     block_data_new["mass"][original_part_len:] = add_peak_data["nl_mass"][add_block_start_loc:add_block_end_loc]
                     block_data_new["intensity"][original_part_len:] = add_peak_data["intensity"][add_block_start_loc:add_block_end_loc]
                     block_data_new["fragment_mz"][original_part_len:] = add_peak_data["ion_mz"][add_block_start_loc:add_block_end_loc]
-                    block_data_new.sort(order="mass")
+                    block_data_new = _merge_into_sorted_part(block_data_new, block_nl_info["sorted_len"][block_idx])
                     # if block_data_new_len <= reserved_len, insert directly
                     if block_data_new_len <= reserved_len:
                         # insert the new ion
@@ -1181,7 +1123,7 @@ class DynamicEntropySearchCore(object):
                         block_nl_info["start_idx"][block_idx] = new_start_idx
                         block_nl_info["data_len"][block_idx] = block_data_new_len
                         block_nl_info["reserved_len"][block_idx] = new_reserved_len
-                    block_nl_info["is_sorted"][block_idx] = True
+                    block_nl_info["sorted_len"][block_idx] = block_data_new_len
 
         self.index = [block_ions_info, block_nl_info]
 
@@ -1196,7 +1138,7 @@ class DynamicEntropySearchCore(object):
         '''
         Get the indices and similarity scores of the top-N most similar items.
 
-        This function sorts the similarity array in descending order, selects the top-N indices, and filters out those below the provided minimum similarity threshold.
+        This function selects the scores not below the minimum similarity threshold, and returns the top-N of them in descending order.
         
         Parameters
         ----------
@@ -1222,20 +1164,16 @@ class DynamicEntropySearchCore(object):
         if min_similarity == None:
             min_similarity = 0.0
 
-        # Get topn indices
-        topn_indices = np.argsort(similarity_array)[::-1][:topn]
-
-        result = []
-        result_idx = []
-        for index in topn_indices:
-            if similarity_array[index] < min_similarity:
-                break
-
-            selected_similarity = similarity_array[index]
-            result.append(selected_similarity)
-            result_idx.append(index)
+        # Only the spectra above min_similarity are candidates, and only the topn of them are sorted.
+        topn_indices = np.flatnonzero(similarity_array >= min_similarity)
+        if topn < len(topn_indices):
+            if topn > 0:
+                topn_indices = np.sort(topn_indices[np.argpartition(similarity_array[topn_indices], -topn)[-topn:]])
+            else:
+                topn_indices = topn_indices[:0]
+        topn_indices = topn_indices[np.argsort(-similarity_array[topn_indices], kind="stable")]
 
-        return result_idx, result
+        return list(topn_indices), list(similarity_array[topn_indices])
 
     def _extract_data_for_flash(
         self,
@@ -1308,3 +1246,49 @@ class DynamicEntropySearchCore(object):
             flash_nl = None
 
         return flash_ions, flash_nl
+
+
+def _get_block_visit(block_info, min_block_query_idx, max_block_query_idx):
+    """
+    Get the blocks visited by the query peaks, query peak i visits the blocks from min_block_query_idx[i] to max_block_query_idx[i].
+
+    Returns visit_loc, and the start index, data length and sorted length of each visit. The visits of query peak i are visit_loc[i]:visit_loc[i + 1].
+    """
+    visit_num = max_block_query_idx - min_block_query_idx + 1
+    visit_loc = np.zeros(len(visit_num) + 1, dtype=np.int64)
+    np.cumsum(visit_num, out=visit_loc[1:])
+    visit_block = np.repeat(min_block_query_idx - visit_loc[:-1], visit_num) + np.arange(visit_loc[-1])
+    visit_info = block_info[visit_block]
+    return visit_loc, visit_info["start_idx"].astype(np.int64), visit_info["data_len"].astype(np.int64), visit_info["sorted_len"].astype(np.int64)
+
+
+def _merge_into_sorted_part(block_data, sorted_len):
+    """
+    Sort the block data by mass, block_data[:sorted_len] should be sorted. Only the unsorted part is sorted, then it is merged into the sorted part.
+    """
+    unsorted_data = block_data[sorted_len:]
+    unsorted_data = unsorted_data[np.argsort(unsorted_data["mass"], kind="stable")]
+    insert_loc = np.searchsorted(block_data["mass"][:sorted_len], unsorted_data["mass"], side="right")
+    return np.insert(block_data[:sorted_len], insert_loc, unsorted_data)
+
+
+# The block information written before the length of the sorted part was tracked.
+_dtype_block_info_with_sorted_flag = np.dtype(
+    [
+        ("start_idx", np.uint64),
+        ("data_len", np.uint32),
+        ("reserved_len", np.uint32),
+        ("is_sorted", bool),
+    ]
+)
+
+
+def _convert_block_info_with_sorted_flag(block_info_with_sorted_flag, dtype_block_info):
+    """
+    Convert the block information with a flag for whether the block is sorted to the block information with the length of the sorted part.
+    """
+    block_info = np.empty(len(block_info_with_sorted_flag), dtype=dtype_block_info)
+    for name in ["start_idx", "data_len", "reserved_len"]:
+        block_info[name] = block_info_with_sorted_flag[name]
+    block_info["sorted_len"] = np.where(block_info_with_sorted_flag["is_sorted"], block_info_with_sorted_flag["data_len"], 0)
+    return block_info
@@ -110,17 +110,13 @@ class DynamicWithFlash(FlashEntropySearchCoreForDynamicIndexing):
         if min_similarity == None:
             min_similarity = 0.0
 
-        # Get topn indices
-        topn_indices = np.argsort(similarity_array)[::-1][:topn]
-
-        result = []
-        result_idx = []
-        for index in topn_indices:
-            if similarity_array[index] < min_similarity:
-                break
-
-            selected_similarity = similarity_array[index]
-            result.append(selected_similarity)
-            result_idx.append(index)
-
-        return result_idx, result
+        # Only the spectra above min_similarity are candidates, and only the topn of them are sorted.
+        topn_indices = np.flatnonzero(similarity_array >= min_similarity)
+        if topn < len(topn_indices):
+            if topn > 0:
+                topn_indices = np.sort(topn_indices[np.argpartition(similarity_array[topn_indices], -topn)[-topn:]])
+            else:
+                topn_indices = topn_indices[:0]
+        topn_indices = topn_indices[np.argsort(-similarity_array[topn_indices], kind="stable")]
+
+        return list(topn_indices), list(similarity_array[topn_indices])
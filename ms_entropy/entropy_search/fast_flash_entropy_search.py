@@ -2,6 +2,30 @@ import numpy as np
 
 try:
     from .fast_flash_entropy_search_cpython import  cy_entropy_similarity_identity_search as entropy_similarity_search_identity
+    from .fast_flash_entropy_search_cpython import  cy_entropy_similarity_search_with_mask as entropy_similarity_search_with_mask
+    from .fast_flash_entropy_search_cpython import  cy_entropy_similarity_accumulate_partitioned
+    from .fast_flash_entropy_search_cpython import  cy_entropy_similarity_search_blocks as entropy_similarity_search_blocks
+    from .fast_flash_entropy_search_cpython import  cy_entropy_similarity_search_hybrid_blocks as entropy_similarity_search_hybrid_blocks
+
+    def entropy_similarity_accumulate_partitioned(all_spec_idx, all_value, entropy_similarity, partition_bits):
+        """
+        The entropy_similarity will be modified in this function.
+        all_value is added to entropy_similarity at all_spec_idx, the postings are bucketed by spec_idx >> partition_bits first,
+        then each bucket is accumulated into its own slice of entropy_similarity. The order of the postings of each spectrum is kept,
+        so the result is identical to adding the postings one by one.
+        """
+        partition_loc = np.zeros((entropy_similarity.shape[0] >> partition_bits) + 2, dtype=np.int64)
+        bucket_spec_idx = np.empty(all_spec_idx.shape[0], dtype=np.uint32)
+        bucket_value = np.empty(all_spec_idx.shape[0], dtype=np.float32)
+        cy_entropy_similarity_accumulate_partitioned(
+            np.ascontiguousarray(all_spec_idx, dtype=np.uint32),
+            np.ascontiguousarray(all_value, dtype=np.float32),
+            entropy_similarity,
+            partition_bits,
+            partition_loc,
+            bucket_spec_idx,
+            bucket_value,
+        )
 
 except ImportError:
     def entropy_similarity_search_identity(
@@ -32,3 +56,183 @@ except ImportError:
         entropy_similarity[array_library_spec_idx] += (
             array_library_ab * np.log2(array_library_ab) - intensity * np.log2(intensity) - array_library_peak_intensity * np.log2(array_library_peak_intensity)
         )
+
+    def entropy_similarity_search_with_mask(
+        product_mz_idx_min,
+        product_mz_idx_max,
+        intensity,
+        entropy_similarity,
+        library_peaks_intensity,
+        library_spec_idx_array,
+        search_spectra_idx_min,
+        search_spectra_idx_max,
+        spectra_mask,
+    ):
+        """
+        The entropy_similarity will be modified in this function.
+        Only the spectra in the range [search_spectra_idx_min, search_spectra_idx_max) with spectra_mask[spec_idx] != 0 are scored,
+        the other spectra are skipped before the accumulation.
+
+        Note: the intensity here should be half of the original intensity.
+        """
+        all_library_spec_idx = library_spec_idx_array[product_mz_idx_min:product_mz_idx_max]
+        idx_list = product_mz_idx_min + np.where(np.bitwise_and(np.bitwise_and(all_library_spec_idx >= search_spectra_idx_min,
+                                                                               all_library_spec_idx < search_spectra_idx_max),
+                                                                spectra_mask[all_library_spec_idx] != 0))[0]
+
+        array_library_spec_idx = library_spec_idx_array[idx_list]
+        array_library_peak_intensity = library_peaks_intensity[idx_list]
+
+        array_library_ab = intensity + array_library_peak_intensity
+        entropy_similarity[array_library_spec_idx] += (
+            array_library_ab * np.log2(array_library_ab) - intensity * np.log2(intensity) - array_library_peak_intensity * np.log2(array_library_peak_intensity)
+        )
+
+    def entropy_similarity_accumulate_partitioned(all_spec_idx, all_value, entropy_similarity, partition_bits):
+        """
+        The entropy_similarity will be modified in this function.
+        all_value is added to entropy_similarity at all_spec_idx, the postings are bucketed by spec_idx >> partition_bits first,
+        then each bucket is accumulated into its own slice of entropy_similarity. The order of the postings of each spectrum is kept,
+        so the result is identical to adding the postings one by one.
+        """
+        order = np.argsort(np.right_shift(all_spec_idx, partition_bits), kind="stable")
+        np.add.at(entropy_similarity, all_spec_idx[order], all_value[order])
+
+    def entropy_similarity_search_blocks(
+        visit_loc,
+        visit_start,
+        visit_len,
+        visit_sorted_len,
+        all_mass_min,
+        all_mass_max,
+        all_intensity,
+        data_spec_idx,
+        data_mass,
+        data_intensity,
+        entropy_similarity,
+        spectra_mask,
+        posting_spec_idx,
+        posting_value,
+    ):
+        """
+        Score the query peaks against the blocks of a dynamic index.
+
+        The blocks visited by query peak i are visit_loc[i]:visit_loc[i + 1] of visit_start, visit_len and visit_sorted_len,
+        the library peaks with data_mass in [all_mass_min[i], all_mass_max[i]] are matched. The first visit_sorted_len peaks of a block are sorted
+        and searched by binary search, the rest of the block is scanned. When spectra_mask is not None, only the spectra with spectra_mask[spec_idx] != 0
+        are scored. When posting_spec_idx is None, the scores are added to entropy_similarity, otherwise they are written to posting_spec_idx and
+        posting_value, which should be as long as the sum of visit_len. Returns the number of the matched peaks.
+
+        Note: the intensity here should be half of the original intensity.
+        """
+        posting_num = 0
+        for peak in range(len(visit_loc) - 1):
+            intensity = all_intensity[peak]
+            for visit in range(visit_loc[peak], visit_loc[peak + 1]):
+                block_spec_idx, block_intensity = _match_block(
+                    visit_start[visit], visit_len[visit], visit_sorted_len[visit], all_mass_min[peak], all_mass_max[peak], data_mass, data_spec_idx, data_intensity
+                )
+                if spectra_mask is not None:
+                    is_searched = spectra_mask[block_spec_idx] != 0
+                    block_spec_idx, block_intensity = block_spec_idx[is_searched], block_intensity[is_searched]
+                if len(block_spec_idx) == 0:
+                    continue
+
+                intensity_ab = intensity + block_intensity
+                value = intensity_ab * np.log2(intensity_ab) - block_intensity * np.log2(block_intensity) - intensity * np.log2(intensity)
+                if posting_spec_idx is None:
+                    entropy_similarity[block_spec_idx] += value
+                else:
+                    posting_spec_idx[posting_num : posting_num + len(value)] = block_spec_idx
+                    posting_value[posting_num : posting_num + len(value)] = value
+                posting_num += len(value)
+        return posting_num
+
+    def entropy_similarity_search_hybrid_blocks(
+        visit_loc,
+        visit_start,
+        visit_len,
+        visit_sorted_len,
+        all_mass_min,
+        all_mass_max,
+        nl_visit_loc,
+        nl_visit_start,
+        nl_visit_len,
+        nl_visit_sorted_len,
+        all_nl_mass_min,
+        all_nl_mass_max,
+        all_intensity,
+        all_ions_mz_left,
+        all_ions_mz_right,
+        data_spec_idx,
+        data_mass,
+        data_intensity,
+        nl_data_fragment_mz,
+        nl_data_spec_idx,
+        nl_data_mass,
+        nl_data_intensity,
+        entropy_similarity,
+        matched_peak,
+    ):
+        """
+        Hybrid search of the query peaks against the blocks of a dynamic index, the visits of the product ion blocks and the neutral loss blocks
+        are given in the same way as entropy_similarity_search_blocks.
+
+        A neutral loss is not scored when its fragment ion is matched to any query peak as a product ion, or when the library spectrum is
+        already matched to the same query peak as a product ion. matched_peak should have the same length as entropy_similarity and be filled with 0,
+        it records the last query peak (counted from 1) matched to each library spectrum as a product ion.
+
+        Note: the intensity here should be half of the original intensity.
+        """
+        for peak in range(len(all_intensity)):
+            intensity = all_intensity[peak]
+
+            # Match the product ions
+            for visit in range(visit_loc[peak], visit_loc[peak + 1]):
+                block_spec_idx, block_intensity = _match_block(
+                    visit_start[visit], visit_len[visit], visit_sorted_len[visit], all_mass_min[peak], all_mass_max[peak], data_mass, data_spec_idx, data_intensity
+                )
+                intensity_ab = intensity + block_intensity
+                entropy_similarity[block_spec_idx] += (
+                    intensity_ab * np.log2(intensity_ab) - block_intensity * np.log2(block_intensity) - intensity * np.log2(intensity)
+                )
+                matched_peak[block_spec_idx] = peak + 1
+
+            # Match the neutral losses
+            for visit in range(nl_visit_loc[peak], nl_visit_loc[peak + 1]):
+                block_spec_idx, block_intensity, block_fragment_mz = _match_block(
+                    nl_visit_start[visit],
+                    nl_visit_len[visit],
+                    nl_visit_sorted_len[visit],
+                    all_nl_mass_min[peak],
+                    all_nl_mass_max[peak],
+                    nl_data_mass,
+                    nl_data_spec_idx,
+                    nl_data_intensity,
+                    nl_data_fragment_mz,
+                )
+                # Skip the neutral losses with the fragment ion matched to any query peak, or the library spectrum matched to this query peak as a product ion.
+                is_fragment_matched = np.searchsorted(all_ions_mz_left, block_fragment_mz, side="right") > np.searchsorted(
+                    all_ions_mz_right, block_fragment_mz, side="left"
+                )
+                is_scored = (~is_fragment_matched) & (matched_peak[block_spec_idx] != peak + 1)
+                block_spec_idx, block_intensity = block_spec_idx[is_scored], block_intensity[is_scored]
+                intensity_ab = intensity + block_intensity
+                entropy_similarity[block_spec_idx] += (
+                    intensity_ab * np.log2(intensity_ab) - block_intensity * np.log2(block_intensity) - intensity * np.log2(intensity)
+                )
+
+    def _match_block(start, length, sorted_len, mass_min, mass_max, data_mass, *all_data):
+        """
+        Get all_data of the library peaks in the block data[start:start + length] with data_mass in [mass_min, mass_max],
+        data_mass[start:start + sorted_len] should be sorted.
+        """
+        sorted_mass = data_mass[start : start + sorted_len]
+        left = start + np.searchsorted(sorted_mass, mass_min, side="left")
+        right = start + np.searchsorted(sorted_mass, mass_max, side="right")
+        if sorted_len == length:
+            return tuple(data[left:right] for data in all_data)
+        unsorted_mass = data_mass[start + sorted_len : start + length]
+        is_unsorted_matched = np.flatnonzero((mass_min <= unsorted_mass) & (unsorted_mass <= mass_max))
+        is_matched = np.concatenate((np.arange(left, right), start + sorted_len + is_unsorted_matched))
+        return tuple(data[is_matched] for data in all_data)
@@ -5,8 +5,11 @@ ctypedef np.float32_t float32
 ctypedef np.int64_t int_64
 ctypedef np.int8_t int_8
 ctypedef np.uint32_t uint_32
+ctypedef np.uint8_t uint_8
 from libc.math cimport log2
 
+# The kernels release the GIL when they are called from Python, so several searches can run in threads at the same time.
+
 
 cpdef void cy_entropy_similarity_identity_search(int_64 product_mz_idx_min, int_64 product_mz_idx_max,
                                                     float32 intensity, float32[:] entropy_similarity,
@@ -21,14 +24,232 @@ cpdef void cy_entropy_similarity_identity_search(int_64 product_mz_idx_min, int_
     cdef float32 library_peak_intensity, intensity_ab
     cdef float32 intensity_xlog2x = intensity * log2(intensity)
 
-    for idx in range(product_mz_idx_min, product_mz_idx_max):
-        library_spec_idx = library_spec_idx_array[idx]
-        if  search_spectra_idx_min <= library_spec_idx and library_spec_idx < search_spectra_idx_max:
-            # Match this peak
-            library_peak_intensity = library_peaks_intensity[idx]
-            intensity_ab = intensity + library_peak_intensity
-
-            entropy_similarity[library_spec_idx] += \
-                intensity_ab * log2(intensity_ab) - \
-                intensity_xlog2x - \
-                library_peak_intensity * log2(library_peak_intensity)
+    with nogil:
+        for idx in range(product_mz_idx_min, product_mz_idx_max):
+            library_spec_idx = library_spec_idx_array[idx]
+            if  search_spectra_idx_min <= library_spec_idx and library_spec_idx < search_spectra_idx_max:
+                # Match this peak
+                library_peak_intensity = library_peaks_intensity[idx]
+                intensity_ab = intensity + library_peak_intensity
+
+                entropy_similarity[library_spec_idx] += \
+                    intensity_ab * log2(intensity_ab) - \
+                    intensity_xlog2x - \
+                    library_peak_intensity * log2(library_peak_intensity)
+
+
+cpdef void cy_entropy_similarity_search_with_mask(int_64 product_mz_idx_min, int_64 product_mz_idx_max,
+                                                  float32 intensity, float32[:] entropy_similarity,
+                                                  const float32[:] library_peaks_intensity, const uint_32[:] library_spec_idx_array,
+                                                  int_64 search_spectra_idx_min, int_64 search_spectra_idx_max,
+                                                  const uint_8[:] spectra_mask) noexcept nogil:
+    """
+    The entropy_similarity will be modified in this function.
+    Only the spectra in the range [search_spectra_idx_min, search_spectra_idx_max) with spectra_mask[spec_idx] != 0 are scored,
+    the other spectra are skipped before the accumulation.
+
+    Note: the intensity here should be half of the original intensity.
+    """
+    cdef uint_32 library_spec_idx
+    cdef float32 library_peak_intensity, intensity_ab
+    cdef float32 intensity_xlog2x = intensity * log2(intensity)
+
+    with nogil:
+        for idx in range(product_mz_idx_min, product_mz_idx_max):
+            library_spec_idx = library_spec_idx_array[idx]
+            if  search_spectra_idx_min <= library_spec_idx and library_spec_idx < search_spectra_idx_max and spectra_mask[library_spec_idx]:
+                # Match this peak
+                library_peak_intensity = library_peaks_intensity[idx]
+                intensity_ab = intensity + library_peak_intensity
+
+                entropy_similarity[library_spec_idx] += \
+                    intensity_ab * log2(intensity_ab) - \
+                    intensity_xlog2x - \
+                    library_peak_intensity * log2(library_peak_intensity)
+
+
+cpdef void cy_entropy_similarity_accumulate_partitioned(const uint_32[:] all_spec_idx, const float32[:] all_value,
+                                                        float32[:] entropy_similarity, int partition_bits,
+                                                        int_64[:] partition_loc, uint_32[:] bucket_spec_idx,
+                                                        float32[:] bucket_value) noexcept nogil:
+    """
+    Add all_value to entropy_similarity at all_spec_idx, partition by partition.
+
+    The postings are first bucketed by spec_idx >> partition_bits, the order of the postings in each bucket is kept,
+    then each bucket is accumulated into its own cache-sized slice of entropy_similarity.
+    partition_loc should have a length of (the number of partitions + 1) and be filled with 0,
+    bucket_spec_idx and bucket_value should have the same length as all_spec_idx.
+    """
+    cdef int_64 idx, partition, posting_num = all_spec_idx.shape[0], partition_num = partition_loc.shape[0] - 1
+
+    with nogil:
+        # Count the postings in each partition.
+        for idx in range(posting_num):
+            partition_loc[(all_spec_idx[idx] >> partition_bits) + 1] += 1
+        for partition in range(partition_num):
+            partition_loc[partition + 1] += partition_loc[partition]
+
+        # Scatter the postings into the buckets, partition_loc[partition] moves to the end of the bucket.
+        for idx in range(posting_num):
+            partition = all_spec_idx[idx] >> partition_bits
+            bucket_spec_idx[partition_loc[partition]] = all_spec_idx[idx]
+            bucket_value[partition_loc[partition]] = all_value[idx]
+            partition_loc[partition] += 1
+
+        # The buckets are stored one after another, so they can be accumulated in one pass.
+        for idx in range(posting_num):
+            entropy_similarity[bucket_spec_idx[idx]] += bucket_value[idx]
+
+
+cdef inline int_64 _lower_bound(const float32[:] data_mass, int_64 left, int_64 right, float32 mass) noexcept nogil:
+    # The first index in [left, right) with data_mass[index] >= mass, data_mass[left:right] should be sorted.
+    cdef int_64 middle
+    while left < right:
+        middle = (left + right) >> 1
+        if data_mass[middle] < mass:
+            left = middle + 1
+        else:
+            right = middle
+    return left
+
+
+cpdef int_64 cy_entropy_similarity_search_blocks(const int_64[:] visit_loc, const int_64[:] visit_start, const int_64[:] visit_len,
+                                                 const int_64[:] visit_sorted_len, const float32[:] all_mass_min, const float32[:] all_mass_max,
+                                                 const float32[:] all_intensity, const uint_32[:] data_spec_idx, const float32[:] data_mass,
+                                                 const float32[:] data_intensity, float32[:] entropy_similarity, const uint_8[:] spectra_mask,
+                                                 uint_32[:] posting_spec_idx, float32[:] posting_value) noexcept nogil:
+    """
+    Score the query peaks against the blocks of a dynamic index.
+
+    The blocks visited by query peak i are visit_loc[i]:visit_loc[i + 1] of visit_start, visit_len and visit_sorted_len,
+    the library peaks with data_mass in [all_mass_min[i], all_mass_max[i]] are matched. The first visit_sorted_len peaks of a block are sorted
+    and searched by binary search, the rest of the block is scanned. When spectra_mask is not None, only the spectra with spectra_mask[spec_idx] != 0
+    are scored. When posting_spec_idx is None, the scores are added to entropy_similarity, otherwise they are written to posting_spec_idx and
+    posting_value, which should be as long as the sum of visit_len. Returns the number of the matched peaks.
+
+    Note: the intensity here should be half of the original intensity.
+    """
+    cdef int_64 peak, visit, idx, idx_end, sorted_end, posting_num = 0
+    cdef uint_32 library_spec_idx
+    cdef float32 intensity, intensity_xlog2x, library_peak_intensity, intensity_ab, value
+    cdef float32 mass_min, mass_max
+    cdef bint use_mask = spectra_mask is not None, output_posting = posting_spec_idx is not None
+
+    with nogil:
+        for peak in range(visit_loc.shape[0] - 1):
+            intensity = all_intensity[peak]
+            intensity_xlog2x = intensity * log2(intensity)
+            mass_min, mass_max = all_mass_min[peak], all_mass_max[peak]
+            for visit in range(visit_loc[peak], visit_loc[peak + 1]):
+                idx, idx_end = visit_start[visit], visit_start[visit] + visit_len[visit]
+                sorted_end = idx + visit_sorted_len[visit]
+                idx = _lower_bound(data_mass, idx, sorted_end, mass_min)
+                while idx < idx_end:
+                    if data_mass[idx] > mass_max:
+                        if idx < sorted_end:
+                            # Skip the rest of the sorted part, then scan the unsorted part.
+                            idx = sorted_end
+                            continue
+                    elif data_mass[idx] >= mass_min:
+                        library_spec_idx = data_spec_idx[idx]
+                        if not use_mask or spectra_mask[library_spec_idx]:
+                            # Match this peak
+                            library_peak_intensity = data_intensity[idx]
+                            intensity_ab = intensity + library_peak_intensity
+                            value = intensity_ab * log2(intensity_ab) - intensity_xlog2x - library_peak_intensity * log2(library_peak_intensity)
+                            if output_posting:
+                                posting_spec_idx[posting_num] = library_spec_idx
+                                posting_value[posting_num] = value
+                            else:
+                                entropy_similarity[library_spec_idx] += value
+                            posting_num += 1
+                    idx += 1
+    return posting_num
+
+
+cpdef void cy_entropy_similarity_search_hybrid_blocks(const int_64[:] visit_loc, const int_64[:] visit_start, const int_64[:] visit_len,
+                                                      const int_64[:] visit_sorted_len, const float32[:] all_mass_min, const float32[:] all_mass_max,
+                                                      const int_64[:] nl_visit_loc, const int_64[:] nl_visit_start, const int_64[:] nl_visit_len,
+                                                      const int_64[:] nl_visit_sorted_len, const float32[:] all_nl_mass_min, const float32[:] all_nl_mass_max,
+                                                      const float32[:] all_intensity, const float32[:] all_ions_mz_left, const float32[:] all_ions_mz_right,
+                                                      const uint_32[:] data_spec_idx, const float32[:] data_mass, const float32[:] data_intensity,
+                                                      const float32[:] nl_data_fragment_mz, const uint_32[:] nl_data_spec_idx,
+                                                      const float32[:] nl_data_mass, const float32[:] nl_data_intensity,
+                                                      float32[:] entropy_similarity, uint_32[:] matched_peak) noexcept nogil:
+    """
+    Hybrid search of the query peaks against the blocks of a dynamic index, the visits of the product ion blocks and the neutral loss blocks
+    are given in the same way as cy_entropy_similarity_search_blocks.
+
+    A neutral loss is not scored when its fragment ion is matched to any query peak as a product ion, or when the library spectrum is
+    already matched to the same query peak as a product ion. matched_peak should have the same length as entropy_similarity and be filled with 0,
+    it records the last query peak (counted from 1) matched to each library spectrum as a product ion.
+
+    Note: the intensity here should be half of the original intensity.
+    """
+    cdef int_64 peak, visit, idx, idx_end, sorted_end, left, right, middle, fragment_matched, fragment_matched_right
+    cdef int_64 peak_num = all_intensity.shape[0]
+    cdef uint_32 library_spec_idx
+    cdef float32 intensity, intensity_xlog2x, library_peak_intensity, intensity_ab, fragment_mz
+
+    with nogil:
+        for peak in range(peak_num):
+            intensity = all_intensity[peak]
+            intensity_xlog2x = intensity * log2(intensity)
+
+            # Match the product ions
+            for visit in range(visit_loc[peak], visit_loc[peak + 1]):
+                idx, idx_end = visit_start[visit], visit_start[visit] + visit_len[visit]
+                sorted_end = idx + visit_sorted_len[visit]
+                idx = _lower_bound(data_mass, idx, sorted_end, all_mass_min[peak])
+                while idx < idx_end:
+                    if data_mass[idx] > all_mass_max[peak]:
+                        if idx < sorted_end:
+                            idx = sorted_end
+                            continue
+                    elif data_mass[idx] >= all_mass_min[peak]:
+                        library_spec_idx = data_spec_idx[idx]
+                        library_peak_intensity = data_intensity[idx]
+                        intensity_ab = intensity + library_peak_intensity
+                        entropy_similarity[library_spec_idx] += \
+                            intensity_ab * log2(intensity_ab) - intensity_xlog2x - library_peak_intensity * log2(library_peak_intensity)
+                        matched_peak[library_spec_idx] = peak + 1
+                    idx += 1
+
+            # Match the neutral losses
+            for visit in range(nl_visit_loc[peak], nl_visit_loc[peak + 1]):
+                idx, idx_end = nl_visit_start[visit], nl_visit_start[visit] + nl_visit_len[visit]
+                sorted_end = idx + nl_visit_sorted_len[visit]
+                idx = _lower_bound(nl_data_mass, idx, sorted_end, all_nl_mass_min[peak])
+                while idx < idx_end:
+                    if nl_data_mass[idx] > all_nl_mass_max[peak]:
+                        if idx < sorted_end:
+                            idx = sorted_end
+                            continue
+                    elif nl_data_mass[idx] >= all_nl_mass_min[peak]:
+                        library_spec_idx = nl_data_spec_idx[idx]
+                        if matched_peak[library_spec_idx] != peak + 1:
+                            # Check if the fragment ion is matched to any query peak as a product ion:
+                            # the number of all_ions_mz_left <= fragment_mz is larger than the number of all_ions_mz_right < fragment_mz.
+                            fragment_mz = nl_data_fragment_mz[idx]
+                            left, right = 0, peak_num
+                            while left < right:
+                                middle = (left + right) >> 1
+                                if all_ions_mz_left[middle] <= fragment_mz:
+                                    left = middle + 1
+                                else:
+                                    right = middle
+                            fragment_matched = left
+                            left, right = 0, peak_num
+                            while left < right:
+                                middle = (left + right) >> 1
+                                if all_ions_mz_right[middle] < fragment_mz:
+                                    left = middle + 1
+                                else:
+                                    right = middle
+                            fragment_matched_right = left
+                            if fragment_matched <= fragment_matched_right:
+                                library_peak_intensity = nl_data_intensity[idx]
+                                intensity_ab = intensity + library_peak_intensity
+                                entropy_similarity[library_spec_idx] += \
+                                    intensity_ab * log2(intensity_ab) - intensity_xlog2x - library_peak_intensity * log2(library_peak_intensity)
+                    idx += 1
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 import numpy as np
 import pickle
+import multiprocessing
+import shutil
 from pathlib import Path
-from .flash_entropy_search_core import FlashEntropySearchCore
+from .flash_entropy_search_core import FlashEntropySearchCore, _get_n_jobs
 from .flash_entropy_search_core_low_memory import FlashEntropySearchCoreLowMemory
 from .flash_entropy_search_core_medium_memory import FlashEntropySearchCoreMediumMemory
+from .metadata_store import MetadataStore
+from .candidate_index import MinHashCandidateIndex
 from ..spectra import clean_spectrum
 
 
@@ -16,6 +20,7 @@ class FlashEntropySearch:
         low_memory=False,
         path_data=None,
         intensity_weight="entropy",
+        score_partition_size=0,
         **kwargs,
     ):
         """
@@ -28,120 +33,447 @@ class FlashEntropySearch:
         :param intensity_weight:    The weight for the intensity in the entropy calculation, can be "entropy" or None. Default is "entropy".
             - None: The intensity will not be weighted, then the unweighted similarity will be calculated.
             - "entropy": The intensity will be weighted by the entropy, then the entropy similarity will be calculated.
+        :param score_partition_size:    The number of spectra in each partition of the similarity array. Default is 0.
+                                        If set, the matched peaks are accumulated partition by partition to avoid cache misses on large libraries,
+                                        1 << 20 is a good choice for libraries with tens of millions of spectra. Set it to 0 to disable it.
         :param kwargs:  Those parameters will be ignored.
         """
         self.precursor_mz_array = np.zeros(0, dtype=np.float32)
+        self.metadata = None
         self.low_memory = low_memory
+        # The saved filters, the name of the filter to the packed bitset of the spectra.
+        self.filters = {}
+        # The candidate index for the approximate open search, built by `build_candidate_index`.
+        self.candidate_index = None
+        # The spectrum index sorted by the precursor m/z, only used when the spectra are not ordered by the precursor m/z.
+        self.precursor_order = None
         if low_memory == 1:
             self.entropy_search = FlashEntropySearchCoreLowMemory(
-                path_data=path_data, max_ms2_tolerance_in_da=max_ms2_tolerance_in_da, mz_index_step=mz_index_step, intensity_weight=intensity_weight
+                path_data=path_data,
+                max_ms2_tolerance_in_da=max_ms2_tolerance_in_da,
+                mz_index_step=mz_index_step,
+                intensity_weight=intensity_weight,
+                score_partition_size=score_partition_size,
             )
         elif low_memory == 2:
             self.entropy_search = FlashEntropySearchCoreMediumMemory(
-                path_data=path_data, max_ms2_tolerance_in_da=max_ms2_tolerance_in_da, mz_index_step=mz_index_step, intensity_weight=intensity_weight
+                path_data=path_data,
+                max_ms2_tolerance_in_da=max_ms2_tolerance_in_da,
+                mz_index_step=mz_index_step,
+                intensity_weight=intensity_weight,
+                score_partition_size=score_partition_size,
             )
         else:
             self.entropy_search = FlashEntropySearchCore(
-                path_data=path_data, max_ms2_tolerance_in_da=max_ms2_tolerance_in_da, mz_index_step=mz_index_step, intensity_weight=intensity_weight
+                path_data=path_data,
+                max_ms2_tolerance_in_da=max_ms2_tolerance_in_da,
+                mz_index_step=mz_index_step,
+                intensity_weight=intensity_weight,
+                score_partition_size=score_partition_size,
             )
 
-    def identity_search(self, precursor_mz, peaks, ms1_tolerance_in_da, ms2_tolerance_in_da, target="cpu", output_matched_peak_number=False, **kwargs):
+    def identity_search(
+        self,
+        precursor_mz,
+        peaks,
+        ms1_tolerance_in_da,
+        ms2_tolerance_in_da,
+        target="cpu",
+        output_matched_peak_number=False,
+        spectra_mask=None,
+        ms2_tolerance_in_ppm=None,
+        **kwargs,
+    ):
         """
         Run the identity search, the query spectrum should be preprocessed by `clean_spectrum()` function before calling this function.
 
         For super large spectral library, directly identity search is not recommended. To do the identity search on super large spectral library,
         divide the spectral library into several parts, build the index for each part, and then do the identity search on each part will be much faster.
 
-        :param precursor_mz:    The precursor m/z of the query spectrum.
+        :param precursor_mz:    The precursor m/z of the query spectrum. It can also be an array of precursor hypotheses (e.g. different adducts,
+                                or the precursors of a chimeric spectrum), then the product ions are matched once for all hypotheses, and the result
+                                is a 2D array with one row for each hypothesis. Only supported on the CPU.
         :param peaks:           The peaks of the query spectrum, should be the output of `clean_spectrum()` function.
         :param ms1_tolerance_in_da:  The MS1 tolerance in Da.
-        :param ms2_tolerance_in_da:  The MS2 tolerance in Da.
+        :param ms2_tolerance_in_da:  The MS2 tolerance in Da. It can also be a list of tolerances, then the query is searched with all of them
+                                     in one pass, and the result is a 2D array with one row for each tolerance.
         :param target:  The target device for the search, can be "cpu" or "gpu".
         :param output_matched_peak_number:  If True, the number of matched peaks will be returned with the entropy similarity score.
+        :param spectra_mask:    Only search the spectra in the mask, the other spectra are skipped by the search kernel and their similarity is 0.
+                                Can be a boolean array with the length of the number of spectra, a bitset packed by `np.packbits`,
+                                or the name of a filter saved by `add_filter`. Default is None, search all spectra.
+        :param ms2_tolerance_in_ppm:    The MS2 tolerance in ppm. If set to a positive value, it is used instead of ms2_tolerance_in_da, the tolerance
+                                        of a query peak at m/z x is x * ms2_tolerance_in_ppm * 1e-6 Da, which can not be larger than max_ms2_tolerance_in_da.
+                                        Default is None.
 
         :return:    The entropy similarity score for each spectrum in the library, a numpy array with shape (N,), N is the number of spectra in the library.
                     If `output_matched_peak_number` is True, the number of matched peaks will be returned with the entropy similarity score, i.e. the return
                     will be a tuple of two numpy arrays, the first one is the entropy similarity score, and the second one is the number of matched peaks.
         """
-        precursor_mz_min = precursor_mz - ms1_tolerance_in_da
-        precursor_mz_max = precursor_mz + ms1_tolerance_in_da
-        spectra_idx_min = np.searchsorted(self.precursor_mz_array, precursor_mz_min, side="left")
-        spectra_idx_max = np.searchsorted(self.precursor_mz_array, precursor_mz_max, side="right")
+        if np.ndim(precursor_mz) > 0:
+            return self._search_precursor_hypotheses(
+                "identity",
+                precursor_mz,
+                peaks,
+                ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm,
+                target,
+                output_matched_peak_number,
+                spectra_mask,
+                ms1_tolerance_in_da,
+            )
+        spectra_idx_min, spectra_idx_max, spectra_mask = self._limit_precursor_range(
+            precursor_mz, ms1_tolerance_in_da, self._get_spectra_mask(spectra_mask)
+        )
+        if self.precursor_order is not None:
+            # The library is not ordered by the precursor m/z, the spectra in the precursor m/z range are searched as a spectra mask.
+            return self.entropy_search.search(
+                method="open",
+                target=target,
+                peaks=peaks,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+                output_matched_peak_number=output_matched_peak_number,
+                spectra_mask=spectra_mask,
+            )
         if spectra_idx_min >= spectra_idx_max:
+            result_shape = np.shape(ms2_tolerance_in_da) + (self.entropy_search.total_spectra_num,)
             if output_matched_peak_number:
-                return np.zeros(self.entropy_search.total_spectra_num, dtype=np.float32), np.zeros(self.entropy_search.total_spectra_num, dtype=np.uint16)
+                return np.zeros(result_shape, dtype=np.float32), np.zeros(result_shape, dtype=np.uint16)
             else:
-                return np.zeros(self.entropy_search.total_spectra_num, dtype=np.float32)
+                return np.zeros(result_shape, dtype=np.float32)
         else:
             return self.entropy_search.search(
                 method="open",
                 target=target,
                 peaks=peaks,
                 ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
                 search_type=1,
                 search_spectra_idx_min=spectra_idx_min,
                 search_spectra_idx_max=spectra_idx_max,
                 output_matched_peak_number=output_matched_peak_number,
+                spectra_mask=spectra_mask,
             )
 
-    def open_search(self, peaks, ms2_tolerance_in_da, target="cpu", output_matched_peak_number=False, **kwargs):
+    def _get_precursor_range(self, precursor_mz, ms1_tolerance_in_da):
+        """
+        Get the range [spectra_idx_min, spectra_idx_max) of the spectra with the precursor m/z within ms1_tolerance_in_da of the query
+        precursor m/z. The range is in the library order, or in the precursor order when the library is not ordered by the precursor m/z.
+        """
+        precursor_mz_min = precursor_mz - ms1_tolerance_in_da
+        precursor_mz_max = precursor_mz + ms1_tolerance_in_da
+        if self.precursor_order is not None:
+            spectra_idx_min = _searchsorted_with_order(self.precursor_mz_array, self.precursor_order, precursor_mz_min, side="left")
+            spectra_idx_max = _searchsorted_with_order(self.precursor_mz_array, self.precursor_order, precursor_mz_max, side="right")
+        else:
+            # Search the float32 bounds, otherwise the whole precursor m/z array is converted to float64 by np.searchsorted.
+            spectra_idx_min = np.searchsorted(self.precursor_mz_array, _get_float32_bound(precursor_mz_min, side="left"), side="left")
+            spectra_idx_max = np.searchsorted(self.precursor_mz_array, _get_float32_bound(precursor_mz_max, side="right"), side="right")
+        return int(spectra_idx_min), int(spectra_idx_max)
+
+    def _get_identity_spec_idx(self, precursor_mz, ms1_tolerance_in_da):
+        """
+        Get the index of the spectra with the precursor m/z within ms1_tolerance_in_da of the query precursor m/z.
+        """
+        spectra_idx_min, spectra_idx_max = self._get_precursor_range(precursor_mz, ms1_tolerance_in_da)
+        if self.precursor_order is not None:
+            return self.precursor_order[spectra_idx_min:spectra_idx_max]
+        else:
+            return np.arange(spectra_idx_min, spectra_idx_max)
+
+    def _limit_precursor_range(self, precursor_mz, ms1_tolerance_in_da, spectra_mask, use_range=True):
+        """
+        Limit the search to the spectra with the precursor m/z within ms1_tolerance_in_da of the query precursor m/z.
+
+        :return:    A tuple of (spectra_idx_min, spectra_idx_max, spectra_mask). When the library is ordered by the precursor m/z and
+                    use_range is True, the spectra are limited by the range of the spectra index, the spectra out of the range are skipped.
+                    Otherwise, the range is the whole library, and the spectra are limited by the spectra mask.
+        """
+        assert precursor_mz is not None, "The precursor m/z is required to limit the precursor m/z range."
+        spectra_num = len(self.precursor_mz_array)
+        spectra_idx_min, spectra_idx_max = self._get_precursor_range(precursor_mz, ms1_tolerance_in_da)
+        if self.precursor_order is None and use_range:
+            return spectra_idx_min, spectra_idx_max, spectra_mask
+        is_in_range = np.zeros(spectra_num, dtype=bool)
+        if self.precursor_order is not None:
+            is_in_range[self.precursor_order[spectra_idx_min:spectra_idx_max]] = True
+        else:
+            is_in_range[spectra_idx_min:spectra_idx_max] = True
+        if spectra_mask is not None:
+            is_in_range &= spectra_mask
+        return 0, spectra_num, is_in_range
+
+    def _search_precursor_hypotheses(
+        self,
+        method,
+        all_precursor_mz,
+        peaks,
+        ms2_tolerance_in_da,
+        ms2_tolerance_in_ppm,
+        target,
+        output_matched_peak_number,
+        spectra_mask,
+        ms1_tolerance_in_da=None,
+    ):
+        """
+        Search the query spectrum with several precursor hypotheses in one traversal, the product ions are matched and scored once,
+        only the neutral losses and the precursor m/z range of the identity search are different for each hypothesis.
+        """
+        assert target == "cpu", "Searching several precursor hypotheses is only supported on the CPU."
+        assert not output_matched_peak_number, "Searching several precursor hypotheses does not support output_matched_peak_number."
+        assert np.ndim(ms2_tolerance_in_da) == 0, "Searching several precursor hypotheses does not support several MS2 tolerances."
+        all_precursor_mz = np.asarray(all_precursor_mz, dtype=np.float64)
+        identity_spec_idx = None
+        if method == "identity":
+            identity_spec_idx = [self._get_identity_spec_idx(precursor_mz, ms1_tolerance_in_da) for precursor_mz in all_precursor_mz.tolist()]
+        return self.entropy_search.search_all(
+            precursor_mz=all_precursor_mz,
+            peaks=peaks,
+            ms2_tolerance_in_da=ms2_tolerance_in_da,
+            methods=(method,),
+            identity_spec_idx=identity_spec_idx,
+            spectra_mask=self._get_spectra_mask(spectra_mask),
+            ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+        )[method]
+
+    def open_search(
+        self,
+        peaks,
+        ms2_tolerance_in_da,
+        target="cpu",
+        output_matched_peak_number=False,
+        spectra_mask=None,
+        min_similarity=None,
+        topn=None,
+        ms2_tolerance_in_ppm=None,
+        precursor_mz=None,
+        max_precursor_delta=None,
+        **kwargs,
+    ):
         """
         Run the open search, the query spectrum should be preprocessed by `clean_spectrum()` function before calling this function.
 
         :param peaks:           The peaks of the query spectrum, should be the output of `clean_spectrum()` function.
-        :param ms2_tolerance_in_da:  The MS2 tolerance in Da.
+        :param ms2_tolerance_in_da:  The MS2 tolerance in Da. It can also be a list of tolerances, then the query is searched with all of them
+                                     in one pass, and the result is a 2D array with one row for each tolerance.
         :param target:  The target device for the search, can be "cpu" or "gpu".
         :param output_matched_peak_number:  If True, the number of matched peaks will be returned with the entropy similarity score.
+        :param spectra_mask:    Only search the spectra in the mask, the other spectra are skipped by the search kernel and their similarity is 0.
+                                Can be a boolean array with the length of the number of spectra, a bitset packed by `np.packbits`,
+                                or the name of a filter saved by `add_filter`. Default is None, search all spectra.
+        :param min_similarity:  If set, only the spectra with similarity no less than this value are needed, the search will be faster
+                                by skipping the spectra which can not reach this value. Their similarity is set to 0. Default is None.
+        :param topn:    If set, only the topn spectra with the highest similarity are needed, the search will be faster by skipping the spectra
+                        which can not be in the topn. Their similarity is set to 0. Default is None.
+        :param ms2_tolerance_in_ppm:    The MS2 tolerance in ppm. If set to a positive value, it is used instead of ms2_tolerance_in_da, the tolerance
+                                        of a query peak at m/z x is x * ms2_tolerance_in_ppm * 1e-6 Da, which can not be larger than max_ms2_tolerance_in_da.
+                                        Default is None.
+        :param precursor_mz:    The precursor m/z of the query spectrum, only required when max_precursor_delta is set.
+        :param max_precursor_delta: If set, only the spectra with the precursor m/z within max_precursor_delta Da of the query precursor m/z
+                                    are searched, e.g. 200 for an analog search. The other spectra are skipped and their similarity is 0.
+                                    Default is None, search all spectra.
 
         :return:    The entropy similarity score for each spectrum in the library, a numpy array with shape (N,), N is the number of spectra in the library.
                     If `output_matched_peak_number` is True, the number of matched peaks will be returned with the entropy similarity score, i.e. the return
                     will be a tuple of two numpy arrays, the first one is the entropy similarity score, and the second one is the number of matched peaks.
         """
+        search_type, spectra_idx_min, spectra_idx_max, spectra_mask = 0, 0, 0, self._get_spectra_mask(spectra_mask)
+        if max_precursor_delta is not None:
+            # The pruning by min_similarity or topn needs the whole library, so the precursor range is searched as a spectra mask.
+            spectra_idx_min, spectra_idx_max, spectra_mask = self._limit_precursor_range(
+                precursor_mz, max_precursor_delta, spectra_mask, use_range=not (min_similarity or topn)
+            )
+            search_type = 0 if spectra_idx_max - spectra_idx_min == len(self.precursor_mz_array) else 2
         return self.entropy_search.search(
             method="open",
             target=target,
             peaks=peaks,
             ms2_tolerance_in_da=ms2_tolerance_in_da,
-            search_type=0,
+            ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+            search_type=search_type,
+            search_spectra_idx_min=spectra_idx_min,
+            search_spectra_idx_max=spectra_idx_max,
             output_matched_peak_number=output_matched_peak_number,
+            spectra_mask=spectra_mask,
+            min_similarity=min_similarity,
+            topn=topn,
         )
 
-    def neutral_loss_search(self, precursor_mz, peaks, ms2_tolerance_in_da, target="cpu", output_matched_peak_number=False, **kwargs):
+    def neutral_loss_search(
+        self,
+        precursor_mz,
+        peaks,
+        ms2_tolerance_in_da,
+        target="cpu",
+        output_matched_peak_number=False,
+        spectra_mask=None,
+        min_similarity=None,
+        topn=None,
+        ms2_tolerance_in_ppm=None,
+        **kwargs,
+    ):
         """
         Run the neutral loss search, the query spectrum should be preprocessed by `clean_spectrum()` function before calling this function.
 
-        :param precursor_mz:    The precursor m/z of the query spectrum.
+        :param precursor_mz:    The precursor m/z of the query spectrum. It can also be an array of precursor hypotheses (e.g. different adducts,
+                                or the precursors of a chimeric spectrum), then the product ions are matched once for all hypotheses, and the result
+                                is a 2D array with one row for each hypothesis. Only supported on the CPU.
         :param peaks:           The peaks of the query spectrum, should be the output of `clean_spectrum()` function.
-        :param ms2_tolerance_in_da:  The MS2 tolerance in Da.
+        :param ms2_tolerance_in_da:  The MS2 tolerance in Da. It can also be a list of tolerances, then the query is searched with all of them
+                                     in one pass, and the result is a 2D array with one row for each tolerance.
         :param target:  The target device for the search, can be "cpu" or "gpu".
         :param output_matched_peak_number:  If True, the number of matched peaks will be returned with the entropy similarity score.
+        :param spectra_mask:    Only search the spectra in the mask, the other spectra are skipped by the search kernel and their similarity is 0.
+                                Can be a boolean array with the length of the number of spectra, a bitset packed by `np.packbits`,
+                                or the name of a filter saved by `add_filter`. Default is None, search all spectra.
+        :param min_similarity:  If set, only the spectra with similarity no less than this value are needed, the search will be faster
+                                by skipping the spectra which can not reach this value. Their similarity is set to 0. Default is None.
+        :param topn:    If set, only the topn spectra with the highest similarity are needed, the search will be faster by skipping the spectra
+                        which can not be in the topn. Their similarity is set to 0. Default is None.
+        :param ms2_tolerance_in_ppm:    The MS2 tolerance in ppm. If set to a positive value, it is used instead of ms2_tolerance_in_da, the tolerance
+                                        of a query peak at m/z x is x * ms2_tolerance_in_ppm * 1e-6 Da, which can not be larger than max_ms2_tolerance_in_da.
+                                        Default is None.
 
         :return:    The entropy similarity score for each spectrum in the library, a numpy array with shape (N,), N is the number of spectra in the library.
                     If `output_matched_peak_number` is True, the number of matched peaks will be returned with the entropy similarity score, i.e. the return
                     will be a tuple of two numpy arrays, the first one is the entropy similarity score, and the second one is the number of matched peaks.
         """
+        if np.ndim(precursor_mz) > 0:
+            return self._search_precursor_hypotheses(
+                "neutral_loss", precursor_mz, peaks, ms2_tolerance_in_da, ms2_tolerance_in_ppm, target, output_matched_peak_number, spectra_mask
+            )
         return self.entropy_search.search(
             method="neutral_loss",
             target=target,
             precursor_mz=precursor_mz,
             peaks=peaks,
             ms2_tolerance_in_da=ms2_tolerance_in_da,
+            ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
             search_type=0,
             output_matched_peak_number=output_matched_peak_number,
+            spectra_mask=self._get_spectra_mask(spectra_mask),
+            min_similarity=min_similarity,
+            topn=topn,
         )
 
-    def hybrid_search(self, precursor_mz, peaks, ms2_tolerance_in_da, target="cpu", **kwargs):
+    def hybrid_search(
+        self, precursor_mz, peaks, ms2_tolerance_in_da, target="cpu", spectra_mask=None, ms2_tolerance_in_ppm=None, max_precursor_delta=None, **kwargs
+    ):
         """
         Run the hybrid search, the query spectrum should be preprocessed by `clean_spectrum()` function before calling this function.
 
-        :param precursor_mz:    The precursor m/z of the query spectrum.
+        :param precursor_mz:    The precursor m/z of the query spectrum. It can also be an array of precursor hypotheses (e.g. different adducts,
+                                or the precursors of a chimeric spectrum), then the product ions are matched once for all hypotheses, and the result
+                                is a 2D array with one row for each hypothesis. Only supported on the CPU.
         :param peaks:           The peaks of the query spectrum, should be the output of `clean_spectrum()` function.
-        :param ms2_tolerance_in_da:  The MS2 tolerance in Da.
+        :param ms2_tolerance_in_da:  The MS2 tolerance in Da. It can also be a list of tolerances, then the query is searched with each of them,
+                                     and the result is a 2D array with one row for each tolerance.
         :param target:  The target device for the search, can be "cpu" or "gpu".
+        :param spectra_mask:    Only search the spectra in the mask, the other spectra are skipped by the search kernel and their similarity is 0.
+                                Can be a boolean array with the length of the number of spectra, a bitset packed by `np.packbits`,
+                                or the name of a filter saved by `add_filter`. Default is None, search all spectra.
+        :param ms2_tolerance_in_ppm:    The MS2 tolerance in ppm. If set to a positive value, it is used instead of ms2_tolerance_in_da, the tolerance
+                                        of a query peak at m/z x is x * ms2_tolerance_in_ppm * 1e-6 Da, which can not be larger than max_ms2_tolerance_in_da.
+                                        Default is None.
+        :param max_precursor_delta: If set, only the spectra with the precursor m/z within max_precursor_delta Da of the query precursor m/z
+                                    are searched, e.g. 200 for an analog search. The other spectra are skipped and their similarity is 0.
+                                    Default is None, search all spectra.
 
         :return:    The entropy similarity score for each spectrum in the library, a numpy array with shape (N,), N is the number of spectra in the library.
         """
-        return self.entropy_search.search_hybrid(target=target, precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da)
+        if np.ndim(precursor_mz) > 0:
+            assert max_precursor_delta is None, "Searching several precursor hypotheses does not support max_precursor_delta."
+            return self._search_precursor_hypotheses(
+                "hybrid", precursor_mz, peaks, ms2_tolerance_in_da, ms2_tolerance_in_ppm, target, False, spectra_mask
+            )
+        if np.ndim(ms2_tolerance_in_da) > 0:
+            # The neutral loss matches removed by the hybrid search depend on the product ion windows, so each tolerance is searched separately.
+            return np.stack(
+                [
+                    self.hybrid_search(precursor_mz, peaks, ms2_tolerance, target, spectra_mask, ms2_tolerance_in_ppm, max_precursor_delta, **kwargs)
+                    for ms2_tolerance in ms2_tolerance_in_da
+                ]
+            )
+        spectra_idx_min, spectra_idx_max, spectra_mask = 0, None, self._get_spectra_mask(spectra_mask)
+        if max_precursor_delta is not None:
+            spectra_idx_min, spectra_idx_max, spectra_mask = self._limit_precursor_range(precursor_mz, max_precursor_delta, spectra_mask)
+        return self.entropy_search.search_hybrid(
+            target=target,
+            precursor_mz=precursor_mz,
+            peaks=peaks,
+            ms2_tolerance_in_da=ms2_tolerance_in_da,
+            spectra_mask=spectra_mask,
+            ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+            search_spectra_idx_min=spectra_idx_min,
+            search_spectra_idx_max=spectra_idx_max,
+        )
+
+    def open_search_with_candidates(self, peaks, ms2_tolerance_in_da, candidate_num=1000, spectra_mask=None, **kwargs):
+        """
+        Run the approximate open search, the query spectrum should be preprocessed by `clean_spectrum()` function before calling this function.
+
+        The candidates are generated by the candidate index built by `build_candidate_index`, then scored exactly by the open search
+        with the candidates as the spectra mask, the result of each candidate is the same as the `open_search`.
+        The spectra not in the candidates may be missed, their similarity is 0.
+
+        :param peaks:           The peaks of the query spectrum, should be the output of `clean_spectrum()` function.
+        :param ms2_tolerance_in_da:  The MS2 tolerance in Da.
+        :param candidate_num:   The maximum number of candidates to score. Default is 1000.
+        :param spectra_mask:    Only search the spectra in the mask, same as the `spectra_mask` in `open_search`. Default is None.
+
+        :return:    The entropy similarity score for each spectrum in the library, a numpy array with shape (N,), N is the number of spectra in the library.
+        """
+        if self.candidate_index is None:
+            raise ValueError("The candidate index is not built, please call build_candidate_index() first.")
+        if len(peaks) == 0:
+            return np.zeros(self.entropy_search.total_spectra_num, dtype=np.float32)
+        assert ms2_tolerance_in_da <= self.entropy_search.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+
+        search_mask = self.entropy_search._get_search_mask(self._get_spectra_mask(spectra_mask))
+        if search_mask is None:
+            candidate_idx = self.candidate_index.get_candidates(self.entropy_search._preprocess_peaks(peaks), candidate_num)
+        else:
+            # Skip the deleted and the masked spectra before taking the candidates.
+            candidate_idx = self.candidate_index.get_candidates(self.entropy_search._preprocess_peaks(peaks), self.entropy_search.total_spectra_num)
+            candidate_idx = candidate_idx[search_mask[candidate_idx] != 0][:candidate_num]
+
+        # Only the candidates are scored by the search kernel, the other matched peaks are skipped.
+        is_candidate = np.zeros(self.entropy_search.total_spectra_num, dtype=bool)
+        is_candidate[candidate_idx] = True
+        return self.entropy_search.search(method="open", peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, spectra_mask=is_candidate)
+
+    def build_candidate_index(self, hash_num=96, band_num=32, mz_bin_width=1.0, max_peak_num=20):
+        """
+        Build the candidate index for the approximate open search `open_search_with_candidates`, which is much faster than `open_search`
+        on large libraries but may miss some matches. Once built, the candidate index is updated by `build_index` and `compact`,
+        and saved by `write`.
+
+        :param hash_num:    The number of hash functions in the MinHash signature. Default is 96.
+        :param band_num:    The number of bands in the locality-sensitive hashing, more bands give higher recall with more candidates. Default is 32.
+        :param mz_bin_width:    The width of the m/z bins for the fingerprint of the spectra, in Da. Default is 1.0.
+        :param max_peak_num:    The number of the most intense peaks in the fingerprint of each spectrum. Default is 20.
+        :return:    None
+        """
+        self.candidate_index = MinHashCandidateIndex(hash_num=hash_num, band_num=band_num, mz_bin_width=mz_bin_width, max_peak_num=max_peak_num)
+        self._update_candidate_index()
+
+    def _update_candidate_index(self, all_new_spectra_list=None, append_spec_idx=None):
+        """
+        Update the candidate index after the library is changed. When the new spectra are appended, only they are added into the candidate index,
+        otherwise the candidate index is rebuilt from the fragment ion index.
+        """
+        if self.candidate_index is None:
+            return
+        if append_spec_idx is None:
+            _, all_ions_mz, all_ions_intensity, all_ions_spec_idx = self.entropy_search.index[:4]
+            self.candidate_index.build(all_ions_mz, all_ions_intensity, all_ions_spec_idx, self.entropy_search.total_spectra_num)
+        else:
+            all_peaks = [self.entropy_search._preprocess_peaks(spec["peaks"]) for spec in all_new_spectra_list]
+            peaks_loc = np.zeros(len(all_peaks) + 1, dtype=np.uint64)
+            peaks_loc[1:] = np.cumsum([len(peaks) for peaks in all_peaks])
+            all_peaks = np.concatenate(all_peaks, axis=0).astype(np.float32) if all_peaks else np.zeros((0, 2), dtype=np.float32)
+            self.candidate_index.add_spectra(all_peaks[:, 0], all_peaks[:, 1], peaks_loc, append_spec_idx)
 
     def clean_spectrum_for_search(
         self, precursor_mz, peaks, precursor_ions_removal_da: float = 1.6, noise_threshold=0.01, min_ms2_difference_in_da: float = 0.05, max_peak_num: int = 0
@@ -184,6 +516,8 @@ class FlashEntropySearch:
         noise_threshold=0.01,
         min_ms2_difference_in_da: float = 0.05,
         max_peak_num: int = None,
+        spectra_mask=None,
+        ms2_tolerance_in_ppm=None,
     ):
         """
         Run the Flash entropy search for the query spectrum.
@@ -191,8 +525,11 @@ class FlashEntropySearch:
         :param precursor_mz:    The precursor m/z of the query spectrum.
         :param peaks:           The peaks of the query spectrum, should be a list or numpy array with shape (N, 2), N is the number of peaks. The format of the peaks is [[mz1, intensity1], [mz2, intensity2], ...].
         :param ms1_tolerance_in_da:  The MS1 tolerance in Da. Default is 0.01.
-        :param ms2_tolerance_in_da:  The MS2 tolerance in Da. Default is 0.02.
+        :param ms2_tolerance_in_da:  The MS2 tolerance in Da. Default is 0.02. It can also be a list of tolerances, then each search result
+                                     is a 2D array with one row for each tolerance. The identity, open and neutral loss searches are done in one pass.
         :param method:  The search method, can be "identity", "open", "neutral_loss", "hybrid", "all", or list of the above.
+                        When several methods are run on the cpu with one MS2 tolerance, they share the preprocessing, the peak matching and
+                        the scoring in one traversal of the query peaks.
         :param target:  The target device for the search, can be "cpu" or "gpu".
         :param precursor_ions_removal_da:   The ions with m/z larger than precursor_mz - precursor_ions_removal_da will be removed.
                                             Default is 1.6.
@@ -200,6 +537,10 @@ class FlashEntropySearch:
                                 will be removed. Default is 0.01.
         :param min_ms2_difference_in_da:    The minimum difference between two peaks in the MS/MS spectrum. Default is 0.05.
         :param max_peak_num:    The maximum number of peaks in the MS/MS spectrum. Default is None, which means no limit.
+        :param spectra_mask:    Only search the spectra in the mask, the other spectra are skipped by the search kernel and their similarity is 0.
+                                Can be a boolean array with the length of the number of spectra, a bitset packed by `np.packbits`,
+                                or the name of a filter saved by `add_filter`. Default is None, search all spectra.
+        :param ms2_tolerance_in_ppm:    The MS2 tolerance in ppm. If set to a positive value, it is used instead of ms2_tolerance_in_da. Default is None.
 
         :return:    A dictionary with the search results. The keys are "identity_search", "open_search", "neutral_loss_search", "hybrid_search", and the values are the search results for each method.
         """
@@ -220,20 +561,54 @@ class FlashEntropySearch:
             method = {"identity", "open", "neutral_loss", "hybrid"}
         elif isinstance(method, str):
             method = {method}
+        spectra_mask = self._get_spectra_mask(spectra_mask)
+
+        if target == "cpu" and len(method) > 1 and np.ndim(ms2_tolerance_in_da) == 0:
+            # Run all the methods in one traversal of the query peaks.
+            all_similarity = self.entropy_search.search_all(
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                methods=method,
+                identity_spec_idx=self._get_identity_spec_idx(precursor_mz, ms1_tolerance_in_da) if "identity" in method else None,
+                spectra_mask=spectra_mask,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+            )
+            return {f"{x}_search": all_similarity[x] for x in ["identity", "open", "neutral_loss", "hybrid"] if x in method}
 
         result = {}
         if "identity" in method:
             result["identity_search"] = self.identity_search(
-                precursor_mz=precursor_mz, peaks=peaks, ms1_tolerance_in_da=ms1_tolerance_in_da, ms2_tolerance_in_da=ms2_tolerance_in_da, target=target
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms1_tolerance_in_da=ms1_tolerance_in_da,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+                target=target,
+                spectra_mask=spectra_mask,
             )
         if "open" in method:
-            result["open_search"] = self.open_search(peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, target=target)
+            result["open_search"] = self.open_search(
+                peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, ms2_tolerance_in_ppm=ms2_tolerance_in_ppm, target=target, spectra_mask=spectra_mask
+            )
         if "neutral_loss" in method:
             result["neutral_loss_search"] = self.neutral_loss_search(
-                precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, target=target
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+                target=target,
+                spectra_mask=spectra_mask,
             )
         if "hybrid" in method:
-            result["hybrid_search"] = self.hybrid_search(precursor_mz=precursor_mz, peaks=peaks, ms2_tolerance_in_da=ms2_tolerance_in_da, target=target)
+            result["hybrid_search"] = self.hybrid_search(
+                precursor_mz=precursor_mz,
+                peaks=peaks,
+                ms2_tolerance_in_da=ms2_tolerance_in_da,
+                ms2_tolerance_in_ppm=ms2_tolerance_in_ppm,
+                target=target,
+                spectra_mask=spectra_mask,
+            )
         return result
 
     def build_index(
@@ -245,6 +620,10 @@ class FlashEntropySearch:
         min_ms2_difference_in_da: float = 0.05,
         max_peak_num: int = 0,
         clean_spectra: bool = True,
+        n_jobs: int = 1,
+        append: bool = False,
+        spectra_order: str = "precursor_mz",
+        posting_layout: str = None,
     ):
         """
         Set the library spectra for entropy search.
@@ -252,7 +631,8 @@ class FlashEntropySearch:
         The `all_spectra_list` must be a list of dictionaries, with each dictionary containing at least two keys: "precursor_mz" and "peaks".
         The dictionary should be in the format of {"precursor_mz": precursor_mz, "peaks": peaks, ...}, All keys in the dictionary, except "peaks,"
         will be saved as the metadata and can be accessed using the  __getitem__ function (e.g. entropy_search[0] returns the metadata for the
-        first spectrum in the library).
+        first spectrum in the library). The metadata is saved in a columnar `MetadataStore` as `entropy_search.metadata`, which can be used
+        to select the spectra by their metadata, e.g. `entropy_search.metadata.select("ion_mode", "==", "P")`.
 
             - The precursor_mz is the precursor m/z value of the MS/MS spectrum;
 
@@ -272,81 +652,323 @@ class FlashEntropySearch:
         :param clean_spectra:   If True, the spectra will be cleaned before indexing. Default is True. If ALL spectra in the library are pre-cleaned with the
                                 function `clean_spectrum` or `clean_spectrum_for_search`, set this parameter to False. ALWAYS set this parameter to true if
                                 the spectra are not pre-prepossessed with the function `clean_spectrum` or `clean_spectrum_for_search`.
+        :param n_jobs:  The number of worker processes used to clean the spectra and build the index. Default is 1.
+                        Set it to None or -1 to use all CPU cores. The index built is identical to the one built with n_jobs=1.
+        :param append:  If True, the spectra will be added to the existing library instead of replacing it. The new spectra are merged
+                        into the existing index without rebuilding it, and are inserted after the existing spectra with the same precursor m/z,
+                        so the spectrum index of the existing spectra may change. The index is identical to the one built from all spectra at once.
+                        The saved filters are kept, the new spectra are not included in any saved filter.
+                        If the library is ordered by "fragment", the new spectra are added after the existing spectra.
+        :param spectra_order:   The order of the spectra in the library, can be "precursor_mz" or "fragment". Default is "precursor_mz".
+                                If set to "fragment", the spectra are ordered by the m/z of their most intense fragment ions, so the spectra matched
+                                by the same query peak are close in the similarity array, which reduces the cache misses when searching large libraries.
+                                The order of the spectra by the precursor m/z is kept as `precursor_order` for the identity search.
+                                Ignored when `append` is True, the order of the existing library is used.
+        :param posting_layout:  The in-memory layout of the postings, can be "separate" or "packed". Default is None, keep the current layout,
+                                which is "separate" for a new library. "packed" interleaves the intensity and the spectrum index of each posting into
+                                one 8-byte record, which may be faster on some machines, see `examples/benchmark-posting_layout.py`.
+                                Only used when low_memory is 0. The layout can also be changed later by `entropy_search.set_posting_layout`.
 
         :return:    If the all_spectra_list is provided, this function will return the sorted spectra list.
         """
+        n_jobs = _get_n_jobs(n_jobs)
 
         # Sort the spectra by the precursor m/z.
         all_sorted_spectra_list = sorted(all_spectra_list, key=lambda x: x["precursor_mz"])
 
         # Clean the spectra, and collect the non-empty spectra
+        clean_parameters = {
+            "precursor_ions_removal_da": precursor_ions_removal_da,
+            "noise_threshold": noise_threshold,
+            "min_ms2_difference_in_da": min_ms2_difference_in_da,
+            "max_peak_num": max_peak_num,
+        }
         all_spectra_list = []
         all_metadata_list = []
-        for spec in all_sorted_spectra_list:
-            # Clean the peaks
-            if clean_spectra:
-                spec["peaks"] = self.clean_spectrum_for_search(
-                    peaks=spec["peaks"],
-                    precursor_mz=spec["precursor_mz"],
-                    precursor_ions_removal_da=precursor_ions_removal_da,
-                    noise_threshold=noise_threshold,
-                    min_ms2_difference_in_da=min_ms2_difference_in_da,
-                    max_peak_num=max_peak_num,
+        if n_jobs > 1 and len(all_sorted_spectra_list) > n_jobs:
+            shard_num = n_jobs * 4
+            shard_loc = np.linspace(0, len(all_sorted_spectra_list), shard_num + 1).astype(np.int64)
+            with multiprocessing.Pool(n_jobs) as pool:
+                all_shards = pool.map(
+                    _clean_spectra_shard,
+                    [(all_sorted_spectra_list[shard_loc[i] : shard_loc[i + 1]], clean_spectra, clean_parameters) for i in range(shard_num)],
                 )
-            if len(spec["peaks"]) > 0:
-                all_spectra_list.append(spec)
-                all_metadata_list.append(pickle.dumps(spec))
+            # The spectra are cleaned in the worker processes, put the cleaned peaks back to the original spectra.
+            for spec_idx_start, (all_peaks, all_metadata) in zip(shard_loc, all_shards):
+                for spec, peaks in zip(all_sorted_spectra_list[spec_idx_start : spec_idx_start + len(all_peaks)], all_peaks):
+                    spec["peaks"] = peaks
+                    if len(peaks) > 0:
+                        all_spectra_list.append(spec)
+                all_metadata_list.extend(all_metadata)
+        else:
+            for spec in all_sorted_spectra_list:
+                # Clean the peaks
+                if clean_spectra:
+                    spec["peaks"] = self.clean_spectrum_for_search(peaks=spec["peaks"], precursor_mz=spec["precursor_mz"], **clean_parameters)
+                if len(spec["peaks"]) > 0:
+                    all_spectra_list.append(spec)
+                    all_metadata_list.append(_get_metadata(spec))
+
+        if append and len(self.precursor_mz_array) > 0:
+            spectra_order = "precursor_mz" if self.precursor_order is None else "fragment"
+        if spectra_order == "fragment":
+            order = _get_fragment_order(all_spectra_list)
+            all_spectra_list = [all_spectra_list[i] for i in order]
+            all_metadata_list = [all_metadata_list[i] for i in order]
+        elif spectra_order != "precursor_mz":
+            raise ValueError(f"Unknown spectra order: {spectra_order}. Use 'precursor_mz' or 'fragment'.")
 
         # Extract precursor m/z array
-        self.precursor_mz_array = np.array([spec["precursor_mz"] for spec in all_spectra_list], dtype=np.float32)
+        precursor_mz_array = np.array([spec["precursor_mz"] for spec in all_spectra_list], dtype=np.float32)
 
-        # Extract metadata array
-        all_metadata_len = np.array([0] + [len(metadata) for metadata in all_metadata_list], dtype=np.uint64)
-        self.metadata_loc = np.cumsum(all_metadata_len).astype(np.uint64)
-        self.metadata = np.frombuffer(b"".join(all_metadata_list), dtype=np.uint8)
+        if append and len(self.precursor_mz_array) > 0:
+            if self.precursor_order is None:
+                append_spec_idx = self._merge_precursor_mz_and_metadata(precursor_mz_array, MetadataStore(all_metadata_list))
+            else:
+                append_spec_idx = self._append_precursor_mz_and_metadata(precursor_mz_array, MetadataStore(all_metadata_list))
+            is_old_spectrum = np.ones(len(self.precursor_mz_array), dtype=bool)
+            is_old_spectrum[append_spec_idx] = False
+            for name in self.filters:
+                is_in_filter = np.zeros(len(self.precursor_mz_array), dtype=bool)
+                is_in_filter[is_old_spectrum] = self._get_filter(name, int(np.sum(is_old_spectrum)))
+                self.filters[name] = np.packbits(is_in_filter)
+        else:
+            append_spec_idx = None
+            self.precursor_mz_array = precursor_mz_array
+            self.metadata = MetadataStore(all_metadata_list)
+            self.filters = {}
+            self.precursor_order = None
+            if spectra_order == "fragment":
+                self.precursor_order = np.argsort(precursor_mz_array, kind="stable").astype(np.uint32)
 
         # Call father class to build the index.
-        self.entropy_search.build_index(all_spectra_list, max_indexed_mz)
+        self.entropy_search.build_index(
+            all_spectra_list, max_indexed_mz, append=append, n_jobs=n_jobs, append_spec_idx=append_spec_idx, posting_layout=posting_layout
+        )
+        self._update_candidate_index(all_spectra_list, append_spec_idx)
         return all_spectra_list
 
+    def _merge_precursor_mz_and_metadata(self, precursor_mz_array, metadata):
+        """
+        Insert the precursor m/z and the metadata of the new spectra into the existing library, the library is kept sorted by the precursor m/z.
+
+        :param precursor_mz_array:  The precursor m/z of the new spectra, sorted.
+        :param metadata:    The MetadataStore of the new spectra.
+        :return:    The spectrum index of each new spectrum in the merged library.
+        """
+        # The number of existing spectra before each new spectrum.
+        insert_loc = np.searchsorted(self.precursor_mz_array, precursor_mz_array, side="right")
+        append_spec_idx = insert_loc + np.arange(len(precursor_mz_array))
+        total_spectra_num = len(self.precursor_mz_array) + len(precursor_mz_array)
+        is_old_spectrum = np.ones(total_spectra_num, dtype=bool)
+        is_old_spectrum[append_spec_idx] = False
+
+        # Merge the precursor m/z.
+        merged_precursor_mz_array = np.empty(total_spectra_num, dtype=np.float32)
+        merged_precursor_mz_array[append_spec_idx] = precursor_mz_array
+        merged_precursor_mz_array[is_old_spectrum] = self.precursor_mz_array
+
+        self.precursor_mz_array = merged_precursor_mz_array
+        self.metadata = self.metadata.insert(metadata, append_spec_idx)
+        return append_spec_idx
+
+    def _append_precursor_mz_and_metadata(self, precursor_mz_array, metadata):
+        """
+        Add the precursor m/z and the metadata of the new spectra after the existing spectra, and insert the new spectra into the precursor order.
+
+        :param precursor_mz_array:  The precursor m/z of the new spectra.
+        :param metadata:    The MetadataStore of the new spectra.
+        :return:    The spectrum index of each new spectrum in the merged library.
+        """
+        existing_spectra_num = len(self.precursor_mz_array)
+        append_spec_idx = np.arange(existing_spectra_num, existing_spectra_num + len(precursor_mz_array))
+
+        # The new spectra are placed after the existing spectra with the same precursor m/z.
+        new_order = np.argsort(precursor_mz_array, kind="stable")
+        insert_loc = np.searchsorted(self.precursor_mz_array[self.precursor_order], precursor_mz_array[new_order], side="right")
+        self.precursor_order = np.insert(self.precursor_order, insert_loc, append_spec_idx[new_order]).astype(np.uint32)
+
+        self.precursor_mz_array = np.concatenate([self.precursor_mz_array, precursor_mz_array])
+        self.metadata = self.metadata.insert(metadata, append_spec_idx)
+        return append_spec_idx
+
+    def delete_spectra(self, all_spec_idx, max_deleted_fraction=0.2):
+        """
+        Delete the spectra from the library. To replace a spectrum, delete it and add the new one with `build_index(append=True)`.
+
+        The deleted spectra are marked in a deletion bitmap, which is saved with the index. They are skipped when searching
+        and never returned by `get_topn_matches`, but their peaks stay in the index until the library is compacted.
+
+        :param all_spec_idx:    The index of the spectra to delete.
+        :param max_deleted_fraction:    When the fraction of the deleted spectra in the library is larger than this value, the library will
+                                        be compacted by `compact()`, which changes the index of the remaining spectra. Default is 0.2.
+                                        Set it to None to never compact the library automatically.
+        :return:    True if the library is compacted, otherwise False.
+        """
+        self.entropy_search.delete_spectra(all_spec_idx)
+        if max_deleted_fraction is not None and self.entropy_search.deleted_spectra_num > max_deleted_fraction * self.entropy_search.total_spectra_num:
+            self.compact()
+            return True
+        return False
+
+    def compact(self):
+        """
+        Remove the deleted spectra from the library physically. The remaining spectra are renumbered in order,
+        the library is identical to the one built from the remaining spectra.
+
+        :return:    None
+        """
+        is_kept_spectrum = self.entropy_search.compact()
+        self.metadata = self.metadata.take(np.flatnonzero(is_kept_spectrum))
+        self.precursor_mz_array = self.precursor_mz_array[is_kept_spectrum]
+        if self.precursor_order is not None:
+            new_spec_idx = np.cumsum(is_kept_spectrum, dtype=np.int64) - 1
+            self.precursor_order = new_spec_idx[self.precursor_order[is_kept_spectrum[self.precursor_order]]].astype(np.uint32)
+        for name in self.filters:
+            self.filters[name] = np.packbits(self._get_filter(name, len(is_kept_spectrum))[is_kept_spectrum])
+        if self.candidate_index is not None:
+            self.candidate_index.remove_spectra(is_kept_spectrum)
+
+    def add_filter(self, name, condition):
+        """
+        Save a filter of the library, which can be used as the `spectra_mask` in the search functions by its name.
+
+        The filter is saved as a bitset with the library. It is kept when the library is compacted, and the spectra added by
+        `build_index(append=True)` are not included in the filter, call this function again to update the filter.
+
+        :param name:    The name of the filter.
+        :param condition:   A function which takes the metadata of a spectrum and returns True if the spectrum is in the filter,
+                            e.g. `lambda spec: spec["ion_mode"] == "P"`, or a boolean array with the length of the number of spectra,
+                            e.g. `entropy_search.metadata.select("ion_mode", "==", "P")`, which is much faster than the function.
+        :return:    The number of spectra in the filter.
+        """
+        if callable(condition):
+            all_metadata = self.metadata.get_metadata(np.arange(len(self.precursor_mz_array)))
+            is_in_filter = np.array([bool(condition(metadata)) for metadata in all_metadata], dtype=bool)
+        else:
+            is_in_filter = np.asarray(condition, dtype=bool)
+            if is_in_filter.shape != (len(self.precursor_mz_array),):
+                raise ValueError("The length of the filter should be the same as the number of spectra.")
+        self.filters[name] = np.packbits(is_in_filter)
+        return int(np.sum(is_in_filter))
+
+    def remove_filter(self, name):
+        """
+        Remove a saved filter.
+
+        :param name:    The name of the filter.
+        :return:    None
+        """
+        del self.filters[name]
+
+    def _get_filter(self, name, spectra_num):
+        return np.unpackbits(self.filters[name], count=spectra_num).view(bool)
+
+    def _get_spectra_mask(self, spectra_mask):
+        """
+        Convert the spectra mask to a boolean array with the length of the number of spectra.
+
+        :param spectra_mask:    None, a boolean array, a bitset packed by `np.packbits`, or the name of a saved filter.
+        :return:    None or a boolean array.
+        """
+        if spectra_mask is None:
+            return None
+        spectra_num = len(self.precursor_mz_array)
+        if isinstance(spectra_mask, str):
+            if spectra_mask not in self.filters:
+                raise KeyError(f"The filter {spectra_mask} does not exist.")
+            return self._get_filter(spectra_mask, spectra_num)
+
+        spectra_mask = np.asarray(spectra_mask)
+        if spectra_mask.dtype == bool and spectra_mask.shape == (spectra_num,):
+            return spectra_mask
+        elif spectra_mask.dtype == np.uint8 and spectra_mask.shape == ((spectra_num + 7) // 8,):
+            return np.unpackbits(spectra_mask, count=spectra_num).view(bool)
+        else:
+            raise ValueError("The spectra mask should be a boolean array or a packed bitset with the length of the number of spectra.")
+
     def __getitem__(self, index):
         """
         Get the MS/MS metadate by the index.
 
         :param index:   The index of the MS/MS spectrum.
-        :return:    The MS/MS spectrum in the format of {"precursor_mz": precursor_mz, "peaks": peaks}.
+        :return:    The metadata of the MS/MS spectrum in the format of {"precursor_mz": precursor_mz, ...}, the peaks are not included.
         """
         if self.metadata is not None:
-            spectrum = pickle.loads(self.metadata[self.metadata_loc[index] : self.metadata_loc[index + 1]].tobytes())
+            spectrum = self.metadata[index]
         else:
             spectrum = {"precursor_mz": self.precursor_mz_array[index]}
         return spectrum
 
-    def get_topn_matches(self, similarity_array, topn=3, min_similarity=0.01):
+    def get_topn_matches(self, similarity_array, topn=3, min_similarity=0.01, spectra_mask=None):
         """
         Get the topn MS/MS spectra with the highest entropy similarity.
 
         :param similarity_array:  The entropy similarity of the MS/MS spectra.
         :param topn:    The number of MS/MS spectra to return, if None, all the MS/MS spectra will be returned.
         :param min_similarity:  The minimum similarity of the MS/MS spectra to return, if None, all the MS/MS spectra will be returned.
+        :param spectra_mask:    Only return the spectra in the mask, same as the `spectra_mask` in the search functions. Default is None.
         :return:    The topn MS/MS spectra with the highest entropy similarity.
         """
-        if topn is None:
-            topn = len(similarity_array)
+        topn_indices = self._get_topn_indices(similarity_array, topn, min_similarity, spectra_mask)
+        result = self.metadata.get_metadata(topn_indices)
+        for item, similarity in zip(result, similarity_array[topn_indices]):
+            item["entropy_similarity"] = similarity
+        return result
+
+    def get_topn_results(self, similarity_array, topn=3, min_similarity=0.01, spectra_mask=None, matched_peak_number=None, metadata_fields=None):
+        """
+        Get the topn MS/MS spectra with the highest entropy similarity as arrays, which is much faster than `get_topn_matches`
+        when only a few metadata fields are needed.
+
+        :param similarity_array:  The entropy similarity of the MS/MS spectra.
+        :param topn:    The number of MS/MS spectra to return, if None, all the MS/MS spectra will be returned.
+        :param min_similarity:  The minimum similarity of the MS/MS spectra to return, if None, all the MS/MS spectra will be returned.
+        :param spectra_mask:    Only return the spectra in the mask, same as the `spectra_mask` in the search functions. Default is None.
+        :param matched_peak_number:  The number of matched peaks of the MS/MS spectra, returned by the search functions
+                                     with `output_matched_peak_number=True`. Default is None.
+        :param metadata_fields:  A list of the metadata fields to return, e.g. ["id", "precursor_mz"]. Default is None.
+        :return:    A dictionary of numpy arrays sorted by the similarity in descending order, the arrays are:
+                    "spec_idx" for the index of the spectra, "entropy_similarity" for the similarity, "matched_peak_number"
+                    if `matched_peak_number` is provided, and one array for each of the `metadata_fields`.
+        """
+        topn_indices = self._get_topn_indices(similarity_array, topn, min_similarity, spectra_mask)
+        result = {"spec_idx": topn_indices, "entropy_similarity": similarity_array[topn_indices]}
+        if matched_peak_number is not None:
+            result["matched_peak_number"] = matched_peak_number[topn_indices]
+        if metadata_fields:
+            result.update(self.metadata.gather(topn_indices, columns=metadata_fields))
+        return result
+
+    def _get_topn_indices(self, similarity_array, topn, min_similarity, spectra_mask):
+        """
+        Get the index of the topn spectra with the highest similarity, the spectra with the same similarity are sorted by their index.
+        The deleted spectra and the spectra not in the spectra mask are skipped.
+        """
         if min_similarity is None:
             min_similarity = 0.0
 
-        # Get the topn indices
-        topn_indices = np.argsort(similarity_array)[::-1][:topn]
+        # Only the spectra passing the filters are partitioned.
+        is_candidate = similarity_array >= min_similarity
+        if self.entropy_search.deleted_spectra_num > 0:
+            is_candidate &= ~self.entropy_search.deleted_spectra
+        spectra_mask = self._get_spectra_mask(spectra_mask)
+        if spectra_mask is not None:
+            is_candidate &= spectra_mask
+        candidate_indices = np.flatnonzero(is_candidate)
+        candidate_similarity = similarity_array[candidate_indices]
 
-        result = []
-        for index in topn_indices:
-            if similarity_array[index] < min_similarity:
-                break
-            item = self[index]
-            item["entropy_similarity"] = similarity_array[index]
-            result.append(item)
-        return result
+        if topn is not None and topn < len(candidate_indices):
+            if topn <= 0:
+                return candidate_indices[:0]
+            # The similarity of the topn-th spectrum, keep the spectra with the smallest index when there are ties.
+            kth_similarity = np.partition(candidate_similarity, len(candidate_similarity) - topn)[len(candidate_similarity) - topn]
+            is_topn = candidate_similarity > kth_similarity
+            is_topn[np.flatnonzero(candidate_similarity == kth_similarity)[: topn - np.count_nonzero(is_topn)]] = True
+            candidate_indices = candidate_indices[is_topn]
+            candidate_similarity = candidate_similarity[is_topn]
+
+        return candidate_indices[np.lexsort((candidate_indices, -candidate_similarity))]
 
     def write(self, path_data=None):
         """
@@ -364,8 +986,16 @@ class FlashEntropySearch:
         path_data.mkdir(parents=True, exist_ok=True)
 
         self.precursor_mz_array.tofile(str(path_data / "precursor_mz.npy"))
-        self.metadata.tofile(str(path_data / "metadata.npy"))
-        self.metadata_loc.tofile(str(path_data / "metadata_loc.npy"))
+        if self.precursor_order is not None:
+            self.precursor_order.tofile(str(path_data / "precursor_order.npy"))
+        elif (path_data / "precursor_order.npy").exists():
+            (path_data / "precursor_order.npy").unlink()
+        self.metadata.write(path_data / "metadata")
+        self._write_filters(path_data / "filters")
+        if self.candidate_index is not None:
+            self.candidate_index.write(path_data / "candidate_index")
+        elif (path_data / "candidate_index").exists():
+            shutil.rmtree(path_data / "candidate_index")
 
         self.entropy_search.write(path_data)
 
@@ -383,15 +1013,43 @@ class FlashEntropySearch:
 
         if self.low_memory:
             self.precursor_mz_array = np.memmap(path_data / "precursor_mz.npy", dtype=np.float32, mode="r")
-            self.metadata = np.memmap(path_data / "metadata.npy", dtype=np.uint8, mode="r")
-            self.metadata_loc = np.memmap(path_data / "metadata_loc.npy", dtype=np.uint64, mode="r")
         else:
             self.precursor_mz_array = np.fromfile(str(path_data / "precursor_mz.npy"), dtype=np.float32)
-            self.metadata = np.fromfile(str(path_data / "metadata.npy"), dtype=np.uint8)
-            self.metadata_loc = np.fromfile(str(path_data / "metadata_loc.npy"), dtype=np.uint64)
+        self.precursor_order = None
+        if (path_data / "precursor_order.npy").exists():
+            self.precursor_order = np.fromfile(str(path_data / "precursor_order.npy"), dtype=np.uint32)
+        self.metadata = MetadataStore()
+        if (path_data / "metadata").is_dir():
+            self.metadata.read(path_data / "metadata", use_memmap=bool(self.low_memory))
+        else:
+            # The library written by the previous version, the metadata of each spectrum is pickled.
+            metadata = np.fromfile(str(path_data / "metadata.npy"), dtype=np.uint8)
+            metadata_loc = np.fromfile(str(path_data / "metadata_loc.npy"), dtype=np.uint64)
+            self.metadata = MetadataStore(
+                [_get_metadata(pickle.loads(metadata[metadata_loc[i] : metadata_loc[i + 1]].tobytes())) for i in range(len(metadata_loc) - 1)]
+            )
+        self._read_filters(path_data / "filters")
+        self.candidate_index = None
+        if (path_data / "candidate_index").is_dir():
+            self.candidate_index = MinHashCandidateIndex()
+            self.candidate_index.read(path_data / "candidate_index", use_memmap=bool(self.low_memory))
 
         return self.entropy_search.read(path_data)
 
+    def _write_filters(self, path_filters):
+        path_filters.mkdir(parents=True, exist_ok=True)
+        for file_filter in path_filters.glob("*.npy"):
+            if file_filter.stem not in self.filters:
+                file_filter.unlink()
+        for name, filter_bitset in self.filters.items():
+            filter_bitset.tofile(str(path_filters / f"{name}.npy"))
+
+    def _read_filters(self, path_filters):
+        self.filters = {}
+        if path_filters.exists():
+            for file_filter in sorted(path_filters.glob("*.npy")):
+                self.filters[file_filter.stem] = np.fromfile(str(file_filter), dtype=np.uint8)
+
     def save_memory_for_multiprocessing(self):
         """
         Save the memory for multiprocessing. This function will move the numpy array in the index to shared memory in order to save memory.
@@ -402,3 +1060,76 @@ class FlashEntropySearch:
         :return:    None
         """
         self.entropy_search.save_memory_for_multiprocessing()
+
+
+def _clean_spectra_shard(parameters):
+    """
+    Clean one shard of spectra and extract their metadata, used by the worker processes of `FlashEntropySearch.build_index`.
+
+    :return:    A tuple of (all_peaks, all_metadata). all_peaks is the cleaned peaks of every spectrum in the shard,
+                all_metadata is the metadata of the non-empty spectra.
+    """
+    all_spectra_list, clean_spectra, clean_parameters = parameters
+    entropy_search = FlashEntropySearch()
+    all_peaks, all_metadata = [], []
+    for spec in all_spectra_list:
+        if clean_spectra:
+            spec["peaks"] = entropy_search.clean_spectrum_for_search(peaks=spec["peaks"], precursor_mz=spec["precursor_mz"], **clean_parameters)
+        all_peaks.append(spec["peaks"])
+        if len(spec["peaks"]) > 0:
+            all_metadata.append(_get_metadata(spec))
+    return all_peaks, all_metadata
+
+
+def _get_fragment_order(all_spectra_list, mz_bin_width=1.0):
+    """
+    Order the spectra by the m/z bins of their two most intense peaks, then by the precursor m/z.
+    The spectra sharing the same intense fragment ions are placed next to each other.
+
+    :return:    The order of the spectra.
+    """
+    all_first_bin = np.zeros(len(all_spectra_list), dtype=np.int64)
+    all_second_bin = np.zeros(len(all_spectra_list), dtype=np.int64)
+    for spec_idx, spec in enumerate(all_spectra_list):
+        peaks = np.asarray(spec["peaks"])
+        if len(peaks) == 0:
+            continue
+        order = np.argsort(-peaks[:, 1], kind="stable")[:2]
+        all_first_bin[spec_idx] = int(peaks[order[0], 0] / mz_bin_width)
+        all_second_bin[spec_idx] = int(peaks[order[-1], 0] / mz_bin_width)
+    precursor_mz_array = np.array([spec["precursor_mz"] for spec in all_spectra_list], dtype=np.float32)
+    return np.lexsort((precursor_mz_array, all_second_bin, all_first_bin))
+
+
+def _get_metadata(spec):
+    """
+    Get the metadata of a spectrum, which is all the keys except "peaks".
+    """
+    return {key: value for key, value in spec.items() if key != "peaks"}
+
+
+def _get_float32_bound(value, side):
+    """
+    Convert the bound of np.searchsorted on a float32 array to float32 without changing the result: the smallest float32 not less than
+    the value for side="left", and the largest float32 not larger than the value for side="right".
+    """
+    bound = np.float32(value)
+    if side == "left" and float(bound) < value:
+        bound = np.nextafter(bound, np.float32(np.inf))
+    elif side == "right" and float(bound) > value:
+        bound = np.nextafter(bound, np.float32(-np.inf))
+    return bound
+
+
+def _searchsorted_with_order(array, order, value, side):
+    """
+    Find the location of the value in array[order] by binary search, without gathering the sorted array.
+    """
+    low, high = 0, len(order)
+    while low < high:
+        middle = (low + high) // 2
+        if array[order[middle]] < value or (side == "right" and array[order[middle]] == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
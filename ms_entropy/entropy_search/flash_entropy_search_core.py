@@ -3,9 +3,14 @@ import json
 import numpy as np
 from pathlib import Path
 from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
 from ..spectra import apply_weight_to_intensity
-from .fast_flash_entropy_search import entropy_similarity_search_identity
+from .fast_flash_entropy_search import (
+    entropy_similarity_search_identity,
+    entropy_similarity_search_with_mask,
+    entropy_similarity_accumulate_partitioned,
+)
 
 
 class FlashEntropySearchCore:
@@ -15,6 +20,7 @@ class FlashEntropySearchCore:
         max_ms2_tolerance_in_da=0.024,
         mz_index_step=0.0001,
         intensity_weight="entropy",  # "entropy" or None
+        score_partition_size=0,
     ) -> None:
         """
         Initialize the EntropySearch class.
@@ -25,8 +31,15 @@ class FlashEntropySearchCore:
                                 The smaller the step size, the faster the search, but the larger the index size and longer the index building time.
         :param intensity_weight: The weight of the intensity, can be "entropy" or None. If set to "entropy", the intensity will be weighted by the entropy.
                                 If set to None, the intensity will not be weighted, which is equivalent to the unweighted entropy similarity.
+        :param score_partition_size:    The number of spectra in each partition of the similarity array, rounded down to a power of 2. Default is 0.
+                                        If set, the matched peaks of the query are bucketed by partition first, then accumulated partition by partition,
+                                        which avoids the cache misses of scattering into a large similarity array. The result is identical.
+                                        Set it to about 1 << 20 for libraries with tens of millions of spectra, set it to 0 to disable it.
         """
         self.mz_index_step = mz_index_step
+        self.score_partition_size = score_partition_size
+        # The in-memory layout of the postings, "separate" or "packed", see `build_index`.
+        self.posting_layout = "separate"
         self._init_for_multiprocessing = False
         self.max_ms2_tolerance_in_da = max_ms2_tolerance_in_da
         self.intensity_weight = intensity_weight
@@ -34,6 +47,8 @@ class FlashEntropySearchCore:
         self.total_spectra_num = 0
         self.total_peaks_num = 0
         self.index = []
+        # The deletion bitmap, the deleted spectra are skipped when searching until the index is compacted.
+        self._set_deleted_spectra(np.zeros(0, dtype=bool))
 
         if path_data:
             self.path_data = Path(path_data)
@@ -74,6 +89,10 @@ class FlashEntropySearchCore:
         search_spectra_idx_min=0,
         search_spectra_idx_max=0,
         output_matched_peak_number=False,
+        spectra_mask=None,
+        min_similarity=None,
+        topn=None,
+        ms2_tolerance_in_ppm=None,
     ):
         """
         Perform identity-, open- or neutral loss search on the MS/MS spectra library.
@@ -84,21 +103,44 @@ class FlashEntropySearchCore:
         :param precursor_mz:    The precursor m/z of the query MS/MS spectrum, required for neutral loss search.
         :param peaks:   The peaks of the query MS/MS spectrum. The peaks need to be precleaned by "clean_spectrum" function.
         :param ms2_tolerance_in_da: The MS2 tolerance used when searching the MS/MS spectra, in Dalton. Default is 0.02.
+                                    It can also be a list of tolerances, then the query is searched with all of them in one pass on the cpu, and
+                                    the result is a 2D array with one row for each tolerance, in the same order. `min_similarity`, `topn`,
+                                    and `ms2_tolerance_in_ppm` are not used in this case.
         :param search_type: The search type, can be 0, 1 or 2.
                             Set it to 0 for searching the whole MS/MS spectra library.
-                            Set it to 1 for searching a range of the MS/MS spectra library,
-        :param search_spectra_idx_min:  The minimum index of the MS/MS spectra to search, required when search_type is 1.
-        :param search_spectra_idx_max:  The maximum index of the MS/MS spectra to search, required when search_type is 1.
+                            Set it to 1 for searching a range of the MS/MS spectra library, the spectra out of the range are skipped by the
+                            search kernel, which is fast for a narrow range, e.g. the identity search.
+                            Set it to 2 for searching a wide range of the MS/MS spectra library, the matched peaks are filtered by the range
+                            before they are scored, which is fast when a large part of the library is in the range, e.g. the analog search.
+        :param search_spectra_idx_min:  The minimum index of the MS/MS spectra to search, required when search_type is 1 or 2.
+        :param search_spectra_idx_max:  The maximum index of the MS/MS spectra to search, required when search_type is 1 or 2.
         :param output_matched_peak_number: Whether to output the number of matched peaks. Only supported when target is "cpu".
                                             If set to True, the function will return a tuple of (entropy_similarity, matched_peak_number).
+        :param spectra_mask:    A boolean array with the length of the number of spectra, only the spectra with True are searched,
+                                the other spectra are skipped by the search kernel and their similarity is 0. Default is None, search all spectra.
+        :param min_similarity:  Only the spectra with similarity no less than this value are needed. Default is None.
+        :param topn:    Only the topn spectra with the highest similarity are needed. Default is None.
+                        When `min_similarity` or `topn` is set, the search on the whole library with the cpu is pruned: the query peaks are
+                        searched by their maximum possible contribution, and once the remaining peaks can not bring a new spectrum above
+                        the threshold, only the spectra which can still reach the threshold are scored. The similarity of these spectra is exact,
+                        the similarity of the other spectra is set to 0.
+        :param ms2_tolerance_in_ppm:    The MS2 tolerance in ppm. Default is None. If set to a positive value, it is used instead of ms2_tolerance_in_da,
+                                        the tolerance of a query peak at m/z x is x * ms2_tolerance_in_ppm * 1e-6 Da, and it can not be larger than
+                                        max_ms2_tolerance_in_da for any query peak. For neutral loss search, the m/z of the fragment ion is used.
         """
         if not self.index:
             return np.zeros(0, dtype=np.float32)
         if len(peaks) == 0:
-            return np.zeros(self.total_spectra_num, dtype=np.float32)
+            return np.zeros(np.shape(ms2_tolerance_in_da) + (self.total_spectra_num,), dtype=np.float32)
 
         # Check peaks
-        assert ms2_tolerance_in_da <= self.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        if np.ndim(ms2_tolerance_in_da) > 0:
+            assert target == "cpu", "Searching with multiple MS2 tolerances is only supported on the cpu."
+            all_ms2_tolerance_in_da = np.asarray(ms2_tolerance_in_da, dtype=np.float32)
+            all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], float(np.max(all_ms2_tolerance_in_da)), None, self.max_ms2_tolerance_in_da)
+        else:
+            all_ms2_tolerance_in_da = None
+            all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
         assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
         assert (
             peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
@@ -116,6 +158,7 @@ class FlashEntropySearchCore:
         ) = self.index
         # Prepare the query spectrum
         peaks = self._preprocess_peaks(peaks)
+        search_mask = self._get_search_mask(spectra_mask)
 
         # Prepare the library
         if method == "open":
@@ -130,11 +173,34 @@ class FlashEntropySearchCore:
             library_spec_idx = all_nl_spec_idx
             peaks[:, 0] = precursor_mz - peaks[:, 0]
 
+        if all_ms2_tolerance_in_da is not None:
+            return self._search_with_multiple_tolerances(
+                peaks,
+                all_ms2_tolerance_in_da,
+                library_mz_idx_start,
+                library_mz,
+                library_peaks_intensity,
+                library_spec_idx,
+                search_type,
+                search_spectra_idx_min,
+                search_spectra_idx_max,
+                search_mask,
+                output_matched_peak_number,
+            )
+
+        if target == "cpu" and search_type == 0 and not output_matched_peak_number and (min_similarity or topn):
+            return self._search_with_pruning(
+                peaks, all_ms2_tolerance, library_mz, library_peaks_intensity, library_spec_idx, search_mask, min_similarity, topn
+            )
+
         # Start searching
         if target == "cpu":
             entropy_similarity = np.zeros(self.total_spectra_num, dtype=np.float32)
             if output_matched_peak_number:
                 matched_peak_number = np.zeros(self.total_spectra_num, dtype=np.uint16)
+            # The matched peaks collected for the partitioned accumulation.
+            is_partitioned = search_type == 0 and self.score_partition_size > 0
+            all_modified_idx, all_modified_value = [], []
         else:
             import cupy as cp
 
@@ -147,12 +213,37 @@ class FlashEntropySearchCore:
             entropy_similarity = cp.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Go through all the peaks in the spectrum
-        for mz_query, intensity_query in peaks:
+        for (mz_query, intensity_query), ms2_tolerance in zip(peaks, all_ms2_tolerance):
             # Determine the mz index range
-            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance_in_da, library_mz, library_mz_idx_start, "left")
-            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance_in_da, library_mz, library_mz_idx_start, "right")
+            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance, library_mz, library_mz_idx_start, "left")
+            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance, library_mz, library_mz_idx_start, "right")
 
-            if target == "cpu" and search_type == 0:
+            if target == "cpu" and is_partitioned:
+                intensity_library = library_peaks_intensity[product_mz_idx_min:product_mz_idx_max]
+                modified_idx = library_spec_idx[product_mz_idx_min:product_mz_idx_max]
+                if output_matched_peak_number:
+                    matched_peak_number[modified_idx] += 1
+                if search_mask is not None:
+                    is_searched = search_mask[modified_idx] != 0
+                    intensity_library, modified_idx = intensity_library[is_searched], modified_idx[is_searched]
+                all_modified_idx.append(modified_idx)
+                all_modified_value.append(self._score_peaks_with_cpu(intensity_query, intensity_library))
+            elif target == "cpu" and search_mask is not None:
+                # Skip the deleted and the masked spectra.
+                entropy_similarity_search_with_mask(
+                    product_mz_idx_min,
+                    product_mz_idx_max,
+                    intensity_query,
+                    entropy_similarity,
+                    library_peaks_intensity,
+                    library_spec_idx,
+                    search_spectra_idx_min if search_type != 0 else 0,
+                    search_spectra_idx_max if search_type != 0 else self.total_spectra_num,
+                    search_mask,
+                )
+                if output_matched_peak_number:
+                    matched_peak_number[library_spec_idx[product_mz_idx_min:product_mz_idx_max]] += 1
+            elif target == "cpu" and search_type == 0:
                 intensity_library = library_peaks_intensity[product_mz_idx_min:product_mz_idx_max]
                 modified_idx = library_spec_idx[product_mz_idx_min:product_mz_idx_max]
                 entropy_similarity[modified_idx] += self._score_peaks_with_cpu(intensity_query, intensity_library)
@@ -171,6 +262,14 @@ class FlashEntropySearchCore:
                 )
                 if output_matched_peak_number:
                     matched_peak_number[library_spec_idx[product_mz_idx_min:product_mz_idx_max]] += 1
+            elif target == "cpu" and search_type == 2:
+                intensity_library = library_peaks_intensity[product_mz_idx_min:product_mz_idx_max]
+                modified_idx = library_spec_idx[product_mz_idx_min:product_mz_idx_max]
+                in_range_idx = np.flatnonzero((modified_idx >= search_spectra_idx_min) & (modified_idx < search_spectra_idx_max))
+                intensity_library, modified_idx = intensity_library[in_range_idx], modified_idx[in_range_idx]
+                entropy_similarity[modified_idx] += self._score_peaks_with_cpu(intensity_query, intensity_library)
+                if output_matched_peak_number:
+                    matched_peak_number[modified_idx] += 1
             elif target == "gpu":
                 intensity_library = cp.array(library_peaks_intensity[product_mz_idx_min:product_mz_idx_max])
                 modified_value = entropy_transform(intensity_library, intensity_query)
@@ -178,21 +277,38 @@ class FlashEntropySearchCore:
                 entropy_similarity.scatter_add(modified_idx, modified_value)
 
         if target == "cpu":
+            if is_partitioned and all_modified_idx:
+                entropy_similarity_accumulate_partitioned(
+                    np.concatenate(all_modified_idx),
+                    np.concatenate(all_modified_value),
+                    entropy_similarity,
+                    max(int(self.score_partition_size).bit_length() - 1, 0),
+                )
             if output_matched_peak_number:
-                if search_type == 1:
+                if search_type != 0:
                     matched_peak_number[:search_spectra_idx_min] = 0
                     matched_peak_number[search_spectra_idx_max:] = 0
-                return entropy_similarity, matched_peak_number
+                return entropy_similarity, self._apply_search_mask(matched_peak_number, search_mask)
             else:
                 return entropy_similarity
         elif target == "gpu":
             entropy_similarity = entropy_similarity.get()
-            if search_type == 1:
+            if search_type != 0:
                 entropy_similarity[:search_spectra_idx_min] = 0
                 entropy_similarity[search_spectra_idx_max:] = 0
-            return entropy_similarity
+            return self._apply_search_mask(entropy_similarity, search_mask)
 
-    def search_hybrid(self, target="cpu", precursor_mz=None, peaks=None, ms2_tolerance_in_da=0.02):
+    def search_hybrid(
+        self,
+        target="cpu",
+        precursor_mz=None,
+        peaks=None,
+        ms2_tolerance_in_da=0.02,
+        spectra_mask=None,
+        ms2_tolerance_in_ppm=None,
+        search_spectra_idx_min=0,
+        search_spectra_idx_max=None,
+    ):
         """
         Perform the hybrid search for the MS/MS spectra.
 
@@ -200,6 +316,13 @@ class FlashEntropySearchCore:
         :param precursor_mz: The precursor m/z of the MS/MS spectra.
         :param peaks: The peaks of the MS/MS spectra, needs to be cleaned with the "clean_spectrum" function.
         :param ms2_tolerance_in_da: The MS/MS tolerance in Da.
+        :param spectra_mask:    A boolean array with the length of the number of spectra, only the spectra with True are searched.
+        :param ms2_tolerance_in_ppm:    The MS/MS tolerance in ppm, used instead of ms2_tolerance_in_da when it is positive, see `search`.
+                                        The tolerance of both the fragment ion and the neutral loss of a query peak is computed from its m/z.
+        :param search_spectra_idx_min:  The minimum index of the MS/MS spectra to search. Default is 0.
+        :param search_spectra_idx_max:  The maximum index of the MS/MS spectra to search. Only the spectra in the range
+                                        [search_spectra_idx_min, search_spectra_idx_max) are searched, the others are skipped on the cpu
+                                        and their similarity is 0. Default is None, search to the end.
         """
         if not self.index:
             return np.zeros(0, dtype=np.float32)
@@ -207,7 +330,7 @@ class FlashEntropySearchCore:
             return np.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Check peaks
-        assert ms2_tolerance_in_da <= self.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
         assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
         assert (
             peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
@@ -225,14 +348,19 @@ class FlashEntropySearchCore:
         ) = self.index
         # Prepare the query spectrum
         peaks = self._preprocess_peaks(peaks)
+        search_mask = self._get_search_mask(spectra_mask)
+        if search_spectra_idx_max is None:
+            search_spectra_idx_max = self.total_spectra_num
+        is_range_limited = search_spectra_idx_min > 0 or search_spectra_idx_max < self.total_spectra_num
 
         # Go through all peak in the spectrum and determine the mz index range
         product_peak_match_idx_min = np.zeros(peaks.shape[0], dtype=np.uint64)
         product_peak_match_idx_max = np.zeros(peaks.shape[0], dtype=np.uint64)
         for peak_idx, (mz_query, _) in enumerate(peaks):
             # Determine the mz index range
-            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "left")
-            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "right")
+            ms2_tolerance = all_ms2_tolerance[peak_idx]
+            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "left")
+            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "right")
 
             product_peak_match_idx_min[peak_idx] = product_mz_idx_min
             product_peak_match_idx_max[peak_idx] = product_mz_idx_max
@@ -248,23 +376,34 @@ class FlashEntropySearchCore:
 
                 # Calculate the entropy similarity for this matched peak
                 modified_idx_product = all_ions_spec_idx[product_mz_idx_min:product_mz_idx_max]
-                modified_value_product = self._score_peaks_with_cpu(intensity, all_ions_intensity[product_mz_idx_min:product_mz_idx_max])
+                intensity_product = all_ions_intensity[product_mz_idx_min:product_mz_idx_max]
+                if is_range_limited:
+                    # Only score the spectra in the searched range
+                    in_range_idx = np.flatnonzero((modified_idx_product >= search_spectra_idx_min) & (modified_idx_product < search_spectra_idx_max))
+                    modified_idx_product, intensity_product = modified_idx_product[in_range_idx], intensity_product[in_range_idx]
+                modified_value_product = self._score_peaks_with_cpu(intensity, intensity_product)
 
                 entropy_similarity[modified_idx_product] += modified_value_product
 
                 ###############################################################
                 # Match the neutral loss ions
                 mz_nl = precursor_mz - mz
+                ms2_tolerance = all_ms2_tolerance[peak_idx]
                 # Determine the mz index range
-                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "left")
-                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "right")
+                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "left")
+                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "right")
 
                 # Calculate the entropy similarity for this matched peak
                 modified_idx_nl = all_nl_spec_idx[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
-                modified_value_nl = self._score_peaks_with_cpu(intensity, all_nl_intensity[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max])
+                intensity_nl = all_nl_intensity[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
+                nl_matched_product_ion_idx = all_ions_idx_for_nl[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
+                if is_range_limited:
+                    in_range_idx = np.flatnonzero((modified_idx_nl >= search_spectra_idx_min) & (modified_idx_nl < search_spectra_idx_max))
+                    modified_idx_nl, intensity_nl = modified_idx_nl[in_range_idx], intensity_nl[in_range_idx]
+                    nl_matched_product_ion_idx = nl_matched_product_ion_idx[in_range_idx]
+                modified_value_nl = self._score_peaks_with_cpu(intensity, intensity_nl)
 
                 # Check if the neutral loss ion is already matched to other query peak as a product ion
-                nl_matched_product_ion_idx = all_ions_idx_for_nl[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
                 s1 = np.searchsorted(product_peak_match_idx_min, nl_matched_product_ion_idx, side="right")
                 s2 = np.searchsorted(product_peak_match_idx_max - 1, nl_matched_product_ion_idx, side="left")
                 modified_value_nl[s1 > s2] = 0
@@ -274,7 +413,7 @@ class FlashEntropySearchCore:
                 modified_value_nl[duplicate_idx_in_nl] = 0
 
                 entropy_similarity[modified_idx_nl] += modified_value_nl
-            return entropy_similarity
+            return self._apply_search_mask(entropy_similarity, search_mask)
 
         elif target == "gpu":
             import cupy as cp
@@ -308,9 +447,10 @@ class FlashEntropySearchCore:
                 ###############################################################
                 # Match the neutral loss ions
                 mz_nl = precursor_mz - mz
+                ms2_tolerance = all_ms2_tolerance[peak_idx]
                 # Determine the mz index range
-                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "left")
-                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "right")
+                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "left")
+                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "right")
 
                 # Calculate the entropy similarity for this matched peak
                 modified_idx_nl = all_nl_spec_idx[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
@@ -333,10 +473,157 @@ class FlashEntropySearchCore:
             entropy_similarity = cp.zeros(self.total_spectra_num, dtype=np.float32)
             for modified_idx, modified_value in entropy_similarity_modification_list:
                 entropy_similarity.scatter_add(cp.array(modified_idx), cp.array(modified_value))
-            return entropy_similarity.get()
+            entropy_similarity = entropy_similarity.get()
+            entropy_similarity[:search_spectra_idx_min] = 0
+            entropy_similarity[search_spectra_idx_max:] = 0
+            return self._apply_search_mask(entropy_similarity, search_mask)
         else:
             raise ValueError("target should be cpu or gpu")
 
+    def search_all(
+        self,
+        precursor_mz=None,
+        peaks=None,
+        ms2_tolerance_in_da=0.02,
+        methods=("identity", "open", "neutral_loss", "hybrid"),
+        identity_spec_idx=None,
+        spectra_mask=None,
+        ms2_tolerance_in_ppm=None,
+    ):
+        """
+        Perform the identity, open, neutral loss and hybrid search for the MS/MS spectra in one traversal on the cpu.
+
+        The query peaks are preprocessed once, the windows of the product ions and the neutral losses are located once, and each matched
+        peak is scored once. The open and identity search share the scores of the product ions, the neutral loss and hybrid search share the
+        scores of the neutral losses, and the hybrid search adds the neutral loss scores which are not matched as product ions to the open search.
+
+        When precursor_mz is an array of precursor hypotheses (e.g. different adducts, or the precursors co-isolated in a chimeric spectrum),
+        the product ions are matched and scored once for all hypotheses, only the neutral losses are matched for each hypothesis.
+
+        :param precursor_mz: The precursor m/z of the MS/MS spectra, required for neutral loss and hybrid search.
+                             It can be a float, or a 1D array of precursor hypotheses.
+        :param peaks: The peaks of the MS/MS spectra, needs to be cleaned with the "clean_spectrum" function.
+        :param ms2_tolerance_in_da: The MS/MS tolerance in Da.
+        :param methods: The search methods to perform, a subset of "identity", "open", "neutral_loss" and "hybrid".
+        :param identity_spec_idx:   The index of the spectra searched by the identity search, required for identity search.
+                                    When precursor_mz is an array, a list with the index of the spectra for each hypothesis.
+        :param spectra_mask:    A boolean array with the length of the number of spectra, only the spectra with True are searched.
+        :param ms2_tolerance_in_ppm:    The MS/MS tolerance in ppm, used instead of ms2_tolerance_in_da when it is positive, see `search`.
+
+        :return:    A dictionary with the search methods as keys, and the entropy similarity arrays as values.
+                    When precursor_mz is an array, the identity, neutral loss and hybrid similarity are 2D arrays with one row for each hypothesis.
+        """
+        methods = set(methods)
+        if not self.index:
+            return {method: np.zeros(0, dtype=np.float32) for method in methods}
+        is_multiple_precursors = np.ndim(precursor_mz) > 0
+        if is_multiple_precursors:
+            all_precursor_mz = np.asarray(precursor_mz, dtype=np.float64).tolist()
+            all_identity_spec_idx = identity_spec_idx
+        else:
+            all_precursor_mz = [precursor_mz]
+            all_identity_spec_idx = [identity_spec_idx]
+        if len(peaks) == 0:
+            result_shape = {method: np.shape(precursor_mz) + (self.total_spectra_num,) for method in methods}
+            result_shape["open"] = (self.total_spectra_num,)
+            return {method: np.zeros(result_shape[method], dtype=np.float32) for method in methods}
+
+        # Check peaks
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
+        assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
+        assert (
+            peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
+        ), "The peaks array should be sorted by m/z, and the m/z difference between two adjacent peaks should be larger than 2 * max_ms2_tolerance_in_da."
+        (
+            all_ions_mz_idx_start,
+            all_ions_mz,
+            all_ions_intensity,
+            all_ions_spec_idx,
+            all_nl_mass_idx_start,
+            all_nl_mass,
+            all_nl_intensity,
+            all_nl_spec_idx,
+            all_ions_idx_for_nl,
+        ) = self.index
+        # Prepare the query spectrum
+        peaks = self._preprocess_peaks(peaks)
+        search_mask = self._get_search_mask(spectra_mask)
+        is_product_ion_needed = not methods.isdisjoint({"identity", "open", "hybrid"})
+        is_neutral_loss_needed = not methods.isdisjoint({"neutral_loss", "hybrid"})
+
+        # Go through all peak in the spectrum and determine the mz index range
+        product_peak_match_idx_min = np.zeros(peaks.shape[0], dtype=np.uint64)
+        product_peak_match_idx_max = np.zeros(peaks.shape[0], dtype=np.uint64)
+        if is_product_ion_needed:
+            for peak_idx, (mz_query, _) in enumerate(peaks):
+                ms2_tolerance = all_ms2_tolerance[peak_idx]
+                product_peak_match_idx_min[peak_idx] = self._find_location_from_array_with_index(
+                    mz_query - ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "left"
+                )
+                product_peak_match_idx_max[peak_idx] = self._find_location_from_array_with_index(
+                    mz_query + ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "right"
+                )
+
+        open_similarity = np.zeros(self.total_spectra_num, dtype=np.float32)
+        hypothesis_num = len(all_precursor_mz)
+        nl_similarity = np.zeros((hypothesis_num, self.total_spectra_num), dtype=np.float32) if "neutral_loss" in methods else None
+        # The similarity of the neutral loss ions which are not matched as product ions.
+        hybrid_nl_similarity = np.zeros((hypothesis_num, self.total_spectra_num), dtype=np.float32) if "hybrid" in methods else None
+        # The last query peak (counted from 1) matched to a product ion of each spectrum, replaces the sort in `_remove_duplicate_with_cpu`.
+        product_peak_stamp = np.zeros(self.total_spectra_num, dtype=np.uint32) if "hybrid" in methods else None
+        for peak_idx, (mz, intensity) in enumerate(peaks):
+            ###############################################################
+            # Match the original product ion
+            product_mz_idx_min = product_peak_match_idx_min[peak_idx]
+            product_mz_idx_max = product_peak_match_idx_max[peak_idx]
+            modified_idx_product = all_ions_spec_idx[product_mz_idx_min:product_mz_idx_max]
+            if is_product_ion_needed:
+                open_similarity[modified_idx_product] += self._score_peaks_with_cpu(intensity, all_ions_intensity[product_mz_idx_min:product_mz_idx_max])
+            if product_peak_stamp is not None:
+                product_peak_stamp[modified_idx_product] = peak_idx + 1
+            if not is_neutral_loss_needed:
+                continue
+
+            ###############################################################
+            # Match the neutral loss ions, the product ions above are shared by all precursor hypotheses
+            ms2_tolerance = all_ms2_tolerance[peak_idx]
+            for hypothesis_idx, precursor_mz in enumerate(all_precursor_mz):
+                mz_nl = precursor_mz - mz
+                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "left")
+                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "right")
+                modified_idx_nl = all_nl_spec_idx[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
+                modified_value_nl = self._score_peaks_with_cpu(intensity, all_nl_intensity[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max])
+                if nl_similarity is not None:
+                    nl_similarity[hypothesis_idx][modified_idx_nl] += modified_value_nl
+
+                if hybrid_nl_similarity is not None:
+                    # Check if the neutral loss ion is already matched to other query peak as a product ion
+                    nl_matched_product_ion_idx = all_ions_idx_for_nl[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
+                    s1 = np.searchsorted(product_peak_match_idx_min, nl_matched_product_ion_idx, side="right")
+                    s2 = np.searchsorted(product_peak_match_idx_max - 1, nl_matched_product_ion_idx, side="left")
+                    modified_value_nl[s1 > s2] = 0
+
+                    # Check if this query peak is already matched to a product ion in the same library spectrum
+                    modified_value_nl[product_peak_stamp[modified_idx_nl] == peak_idx + 1] = 0
+                    hybrid_nl_similarity[hypothesis_idx][modified_idx_nl] += modified_value_nl
+
+        result = {}
+        if "identity" in methods:
+            result["identity"] = np.zeros((hypothesis_num, self.total_spectra_num), dtype=np.float32)
+            for hypothesis_idx, spec_idx in enumerate(all_identity_spec_idx):
+                result["identity"][hypothesis_idx][spec_idx] = open_similarity[spec_idx]
+        if "neutral_loss" in methods:
+            result["neutral_loss"] = nl_similarity
+        if "hybrid" in methods:
+            result["hybrid"] = np.add(hybrid_nl_similarity, open_similarity, out=hybrid_nl_similarity)
+        if not is_multiple_precursors:
+            result = {method: similarity[0] for method, similarity in result.items()}
+        if "open" in methods:
+            result["open"] = open_similarity
+        for similarity in result.values():
+            self._apply_search_mask(similarity, search_mask)
+        return result
+
     def _remove_duplicate_with_cpu(self, array_1, array_2, max_element):
         if len(array_1) + len(array_2) < 4_000_000:
             # When len(array_1) + len(array_2) < 4_000_000, this method is faster than array method
@@ -372,7 +659,15 @@ class FlashEntropySearchCore:
             duplicate_idx = cp.where(note[array_2] == 1)[0]
             return duplicate_idx
 
-    def build_index(self, all_spectra_list: list, max_indexed_mz: float = 1500.00005, append: bool = False):
+    def build_index(
+        self,
+        all_spectra_list: list,
+        max_indexed_mz: float = 1500.00005,
+        append: bool = False,
+        n_jobs: int = 1,
+        append_spec_idx=None,
+        posting_layout=None,
+    ):
         """
         Build the index for the MS/MS spectra library.
 
@@ -383,13 +678,32 @@ class FlashEntropySearchCore:
         :param all_spectra_list:    A list of dictionaries in the format of {"precursor_mz": precursor_mz, "peaks": peaks},
                                     the spectra in the list need to be sorted by the precursor m/z.
         :param max_indexed_mz: The maximum m/z value that will be indexed. Default is 1500.00005.
-        :param append:  Not implemented yet.
+        :param append:  If True, the spectra are merged into the existing index instead of replacing it. The new postings are merged into
+                        the existing arrays in one linear pass, the index is identical to the one built from all spectra at once.
+                        The max_indexed_mz should be the same as the one used to build the existing index.
+        :param n_jobs:  The number of processes used to collect the peaks and the number of threads used to sort them. Default is 1.
+                        Set it to None or -1 to use all CPU cores. The index built is identical to the one built with n_jobs=1,
+                        but the peak memory usage is about two times larger when n_jobs > 1.
+        :param append_spec_idx: Only used when append is True. The spectrum index of each new spectrum in the merged library, must be increasing.
+                                The existing spectra are renumbered in order to fill the remaining indexes.
+                                Default is None, which means the new spectra are placed after the existing spectra.
+        :param posting_layout:  The in-memory layout of the postings, can be "separate" or "packed". Default is None, keep the current layout.
+                                "separate" stores the intensity and the spec_idx of the postings in two arrays.
+                                "packed" interleaves them into 8-byte records, so scoring a window of postings streams one array instead of two.
+                                The m/z arrays and the files written are the same in both layouts, so the layout can be changed when reading the index.
+                                The "packed" layout is only used when the index is in memory.
         """
+        n_jobs = _get_n_jobs(n_jobs)
+        if posting_layout is not None:
+            self._select_posting_layout(posting_layout)
 
         # Get the total number of spectra and peaks
         total_peaks_num = int(np.sum([spectrum["peaks"].shape[0] for spectrum in all_spectra_list]))
         total_spectra_num = len(all_spectra_list)
+        append = append and len(self.index) > 0
         if append:
+            if append_spec_idx is None:
+                append_spec_idx = np.arange(self.total_spectra_num, self.total_spectra_num + total_spectra_num)
             self.total_spectra_num += total_spectra_num
             self.total_peaks_num += total_peaks_num
         else:
@@ -401,26 +715,65 @@ class FlashEntropySearchCore:
         assert self.total_peaks_num < 2**63 - 1, "The total peaks number is too big."
 
         ############## Step 1: Collect the precursor m/z and peaks information. ##############
-        peak_data = self._merge_all_spectra_to_peak_data(all_spectra_list, total_peaks_num)
+        if n_jobs > 1 and total_spectra_num > n_jobs:
+            peak_data = self._merge_all_spectra_to_peak_data_in_parallel(all_spectra_list, total_peaks_num, n_jobs)
+        else:
+            peak_data = self._merge_all_spectra_to_peak_data(all_spectra_list, total_peaks_num)
 
         ############## Step 2: Build the index by sort with product ions. ##############
-        self.index = self._generate_index_from_peak_data(peak_data, max_indexed_mz, append=append)
+        if append:
+            peak_data["spec_idx"] = np.asarray(append_spec_idx, dtype=np.uint32)[peak_data["spec_idx"]]
+            index = self._merge_peak_data_into_index(peak_data, max_indexed_mz, append_spec_idx, n_jobs=n_jobs)
+            # The existing spectra keep their deletion marks.
+            deleted_spectra = np.zeros(self.total_spectra_num, dtype=bool)
+            is_old_spectrum = np.ones(self.total_spectra_num, dtype=bool)
+            is_old_spectrum[append_spec_idx] = False
+            deleted_spectra[is_old_spectrum] = self.deleted_spectra
+            self._set_deleted_spectra(deleted_spectra)
+        else:
+            index = self._generate_index_from_peak_data(peak_data, max_indexed_mz, append=append, n_jobs=n_jobs)
+            self._set_deleted_spectra(np.zeros(self.total_spectra_num, dtype=bool))
+        self.index = self._save_built_index(index)
         return self.index
 
+    def _merge_all_spectra_to_peak_data_in_parallel(self, all_spectra_list, total_peaks_num, n_jobs):
+        """
+        Same as `_merge_all_spectra_to_peak_data`, but the spectra are split into shards and each shard is processed in a separate process.
+        """
+        shard_num = min(len(all_spectra_list), n_jobs * 4)
+        shard_loc = np.linspace(0, len(all_spectra_list), shard_num + 1).astype(np.int64)
+        parameters = {
+            "max_ms2_tolerance_in_da": self.max_ms2_tolerance_in_da,
+            "mz_index_step": self.mz_index_step,
+            "intensity_weight": self.intensity_weight,
+        }
+        with multiprocessing.Pool(n_jobs) as pool:
+            all_shards = pool.map(
+                _merge_spectra_shard_to_peak_data, [(parameters, all_spectra_list[shard_loc[i] : shard_loc[i + 1]]) for i in range(shard_num)]
+            )
+
+        # Put the shards together, the spectrum index in each shard starts from 0.
+        peak_data = {name: np.empty(total_peaks_num, dtype=all_shards[0][name].dtype) for name in all_shards[0]}
+        peak_idx = 0
+        for spec_idx_start, shard in zip(shard_loc, all_shards):
+            peak_slice = slice(peak_idx, peak_idx + shard["spec_idx"].shape[0])
+            for name in peak_data:
+                peak_data[name][peak_slice] = shard[name]
+            peak_data["spec_idx"][peak_slice] += np.uint32(spec_idx_start)
+            peak_idx = peak_slice.stop
+        assert peak_idx == total_peaks_num, "The number of the peaks in the shards is not the same as the total peaks number."
+        return peak_data
+
     def _merge_all_spectra_to_peak_data(self, all_spectra_list, total_peaks_num):
-        dtype_peak_data = np.dtype(
-            [
-                ("ion_mz", np.float32),  # The m/z of the fragment ion.
-                ("nl_mass", np.float32),  # The neutral loss mass of the fragment ion.
-                ("intensity", np.float32),  # The intensity of the fragment ion.
-                ("spec_idx", np.uint32),  # The index of the MS/MS spectra.
-                ("peak_idx", np.uint64),
-            ],
-            align=True,
-        )  # The index of the fragment ion.
-
-        # Initialize the peak data array.
-        peak_data = np.zeros(total_peaks_num, dtype=dtype_peak_data)
+        """
+        Collect the peaks of all spectra. The peak data is stored in columns, each column is a contiguous array.
+        """
+        peak_data = {
+            "ion_mz": np.zeros(total_peaks_num, dtype=np.float32),  # The m/z of the fragment ion.
+            "nl_mass": np.zeros(total_peaks_num, dtype=np.float32),  # The neutral loss mass of the fragment ion.
+            "intensity": np.zeros(total_peaks_num, dtype=np.float32),  # The intensity of the fragment ion.
+            "spec_idx": np.zeros(total_peaks_num, dtype=np.uint32),  # The index of the MS/MS spectra.
+        }
         peak_idx = 0
 
         # Adding the precursor m/z and peaks information to the peak data array.
@@ -438,50 +791,59 @@ class FlashEntropySearchCore:
             # Preprocess the peaks array.
             peaks = self._preprocess_peaks(peaks)
 
+            peak_slice = slice(peak_idx, peak_idx + peaks.shape[0])
             # Assign the product ion m/z
-            peak_data_item = peak_data[peak_idx : (peak_idx + peaks.shape[0])]
-            peak_data_item["ion_mz"] = peaks[:, 0]
+            peak_data["ion_mz"][peak_slice] = peaks[:, 0]
             # Assign the neutral loss mass
-            peak_data_item["nl_mass"] = precursor_mz - peaks[:, 0]
+            peak_data["nl_mass"][peak_slice] = precursor_mz - peaks[:, 0]
             # Assign the intensity
-            peak_data_item["intensity"] = peaks[:, 1]
+            peak_data["intensity"][peak_slice] = peaks[:, 1]
             # Assign the spectrum index
-            peak_data_item["spec_idx"] = idx
+            peak_data["spec_idx"][peak_slice] = idx
             # Set the peak index
             peak_idx += peaks.shape[0]
         return peak_data
 
-    def _generate_index_from_peak_data(self, peak_data, max_indexed_mz, append):
-        # Sort with precursor m/z.
-        peak_data.sort(order="ion_mz")
+    def _generate_index_from_peak_data(self, peak_data, max_indexed_mz, append, n_jobs=1):
+        """
+        Build the index from the columns of the peak data.
 
-        # Record the m/z, intensity, and spectrum index information for product ions.
-        all_ions_mz = np.copy(peak_data["ion_mz"])
-        all_ions_intensity = np.copy(peak_data["intensity"])
-        all_ions_spec_idx = np.copy(peak_data["spec_idx"])
+        Instead of sorting the records, the permutation which sorts the peaks by the fragment ion m/z is calculated once, and the
+        index arrays are gathered by it directly into the buffers returned by `_allocate_index_array`. The columns of the peak data
+        are released as soon as they are gathered, so the peak memory usage is close to the size of the final index.
+        """
+        # Sort with precursor m/z, the ties are broken by the other columns.
+        ions_order = _argsort_peak_data(peak_data, ["ion_mz", "nl_mass", "intensity", "spec_idx"], n_jobs)
 
-        # Assign the index of the product ions.
-        peak_data["peak_idx"] = np.arange(0, self.total_peaks_num, dtype=np.uint64)
+        # Record the m/z, intensity, and spectrum index information for product ions.
+        all_ions_mz = self._gather_index_array("all_ions_mz", peak_data.pop("ion_mz"), ions_order)
+        all_ions_intensity = self._gather_index_array("all_ions_intensity", peak_data.pop("intensity"), ions_order)
+        all_ions_spec_idx = self._gather_index_array("all_ions_spec_idx", peak_data.pop("spec_idx"), ions_order)
+        nl_mass_in_ions_order = peak_data.pop("nl_mass")[ions_order]
+        del ions_order
 
         # Build index for fast access to the ion's m/z.
         max_mz = min(np.max(all_ions_mz), max_indexed_mz)
         search_array = np.arange(0.0, max_mz, self.mz_index_step)
-        all_ions_mz_idx_start = np.searchsorted(all_ions_mz, search_array, side="left").astype(np.int64)
+        all_ions_mz_idx_start = self._gather_index_array("all_ions_mz_idx_start", _generate_idx_start(all_ions_mz, search_array))
 
         ############## Step 3: Build the index by sort with neutral loss mass. ##############
-        # Sort with the neutral loss mass.
-        peak_data.sort(order="nl_mass")
+        # Sort with the neutral loss mass. The peaks are already sorted by the product ion m/z, so the stable sort by the neutral loss mass
+        # breaks the ties in the same way as sorting by all columns, and the permutation is the index of the product ions.
+        nl_order = _argsort_peak_data({"nl_mass": nl_mass_in_ions_order}, ["nl_mass"], n_jobs)
 
         # Record the m/z, intensity, spectrum index, and product ions index information for neutral loss ions.
-        all_nl_mass = peak_data["nl_mass"]
-        all_nl_intensity = peak_data["intensity"]
-        all_nl_spec_idx = peak_data["spec_idx"]
-        all_ions_idx_for_nl = peak_data["peak_idx"]
+        all_nl_mass = self._gather_index_array("all_nl_mass", nl_mass_in_ions_order, nl_order)
+        del nl_mass_in_ions_order
+        all_nl_intensity = self._gather_index_array("all_nl_intensity", all_ions_intensity, nl_order)
+        all_nl_spec_idx = self._gather_index_array("all_nl_spec_idx", all_ions_spec_idx, nl_order)
+        all_ions_idx_for_nl = self._gather_index_array("all_ions_idx_for_nl", nl_order.view(np.uint64))
+        del nl_order
 
         # Build the index for fast access to the neutral loss mass.
         max_mz = min(np.max(all_nl_mass), max_indexed_mz)
         search_array = np.arange(0.0, max_mz, self.mz_index_step)
-        all_nl_mass_idx_start = np.searchsorted(all_nl_mass, search_array, side="left").astype(np.int64)
+        all_nl_mass_idx_start = self._gather_index_array("all_nl_mass_idx_start", _generate_idx_start(all_nl_mass, search_array))
 
         ############## Step 4: Save the index. ##############
         index = [
@@ -497,6 +859,303 @@ class FlashEntropySearchCore:
         ]
         return index
 
+    def _merge_peak_data_into_index(self, peak_data, max_indexed_mz, append_spec_idx, n_jobs=1):
+        """
+        Merge the peak data of the new spectra into the existing index.
+
+        The new postings are sorted in the same way as `_generate_index_from_peak_data`, then the location of each new posting in the
+        merged arrays is found by a binary search in the existing arrays, which costs O(m log n) for m new postings. The existing postings
+        keep their relative order, so the merged arrays are written in one linear pass. The start tables are patched by adding the counts
+        of the new postings, as the start location is the number of postings smaller than the value.
+
+        :param peak_data:   The columns of the peak data of the new spectra, the spec_idx is already the index in the merged library.
+        :param append_spec_idx: The spectrum index of each new spectrum in the merged library.
+        """
+        (
+            old_ions_mz_idx_start,
+            old_ions_mz,
+            old_ions_intensity,
+            old_ions_spec_idx,
+            old_nl_mass_idx_start,
+            old_nl_mass,
+            old_nl_intensity,
+            old_nl_spec_idx,
+            old_ions_idx_for_nl,
+        ) = self.index
+        total_peaks_num = old_ions_mz.shape[0] + peak_data["ion_mz"].shape[0]
+
+        # The spectrum index of the existing spectra in the merged library.
+        is_old_spectrum = np.ones(self.total_spectra_num, dtype=bool)
+        is_old_spectrum[append_spec_idx] = False
+        old_spec_idx_map = np.flatnonzero(is_old_spectrum).astype(np.uint32)
+        del is_old_spectrum
+
+        # Sort the new postings with the product ion m/z.
+        ions_order = _argsort_peak_data(peak_data, ["ion_mz", "nl_mass", "intensity", "spec_idx"], n_jobs)
+        new_ions_mz = peak_data["ion_mz"][ions_order]
+        new_nl_mass = peak_data["nl_mass"][ions_order]
+        new_intensity = peak_data["intensity"][ions_order]
+        new_spec_idx = peak_data["spec_idx"][ions_order]
+        del ions_order
+
+        ############## Step 1: Merge the product ions. ##############
+        old_ions_spec_idx = old_spec_idx_map[old_ions_spec_idx]
+        old_nl_mass_in_ions_order = np.empty(old_ions_mz.shape[0], dtype=np.float32)
+        old_nl_mass_in_ions_order[old_ions_idx_for_nl] = old_nl_mass
+        new_ions_loc = np.arange(new_ions_mz.shape[0], dtype=np.int64) + _count_smaller_keys(
+            [old_ions_mz, old_nl_mass_in_ions_order, old_ions_intensity, old_ions_spec_idx], [new_ions_mz, new_nl_mass, new_intensity, new_spec_idx]
+        )
+        del old_nl_mass_in_ions_order
+        is_new_peak = np.zeros(total_peaks_num, dtype=bool)
+        is_new_peak[new_ions_loc] = True
+        old_ions_loc = np.flatnonzero(~is_new_peak)
+        del is_new_peak
+
+        all_ions_mz = self._merge_index_array("all_ions_mz", old_ions_mz, old_ions_loc, new_ions_mz, new_ions_loc)
+        all_ions_intensity = self._merge_index_array("all_ions_intensity", old_ions_intensity, old_ions_loc, new_intensity, new_ions_loc)
+        all_ions_spec_idx = self._merge_index_array("all_ions_spec_idx", old_ions_spec_idx, old_ions_loc, new_spec_idx, new_ions_loc)
+        del old_ions_spec_idx
+
+        max_mz = min(all_ions_mz[-1], max_indexed_mz)
+        search_array = np.arange(0.0, max_mz, self.mz_index_step)
+        all_ions_mz_idx_start = self._gather_index_array(
+            "all_ions_mz_idx_start", _patch_idx_start(old_ions_mz_idx_start, old_ions_mz, new_ions_mz, search_array)
+        )
+
+        ############## Step 2: Merge the neutral loss ions. ##############
+        # The new postings are in the order of the product ions, so the stable sort by the neutral loss mass breaks the ties by the
+        # location of the product ions, same as the existing postings.
+        nl_order = _argsort_peak_data({"nl_mass": new_nl_mass}, ["nl_mass"], n_jobs)
+        new_nl_mass, new_intensity, new_spec_idx = new_nl_mass[nl_order], new_intensity[nl_order], new_spec_idx[nl_order]
+        new_ions_idx_for_nl = new_ions_loc[nl_order].view(np.uint64)
+        del nl_order
+
+        old_ions_idx_for_nl = old_ions_loc[old_ions_idx_for_nl].view(np.uint64)
+        del old_ions_loc
+        new_nl_loc = np.arange(new_nl_mass.shape[0], dtype=np.int64) + _count_smaller_keys(
+            [old_nl_mass, old_ions_idx_for_nl], [new_nl_mass, new_ions_idx_for_nl]
+        )
+        is_new_peak = np.zeros(total_peaks_num, dtype=bool)
+        is_new_peak[new_nl_loc] = True
+        old_nl_loc = np.flatnonzero(~is_new_peak)
+        del is_new_peak
+
+        all_nl_mass = self._merge_index_array("all_nl_mass", old_nl_mass, old_nl_loc, new_nl_mass, new_nl_loc)
+        all_nl_intensity = self._merge_index_array("all_nl_intensity", old_nl_intensity, old_nl_loc, new_intensity, new_nl_loc)
+        all_nl_spec_idx = self._merge_index_array("all_nl_spec_idx", old_spec_idx_map[old_nl_spec_idx], old_nl_loc, new_spec_idx, new_nl_loc)
+        all_ions_idx_for_nl = self._merge_index_array("all_ions_idx_for_nl", old_ions_idx_for_nl, old_nl_loc, new_ions_idx_for_nl, new_nl_loc)
+        del old_ions_idx_for_nl, old_nl_loc
+
+        max_mz = min(all_nl_mass[-1], max_indexed_mz)
+        search_array = np.arange(0.0, max_mz, self.mz_index_step)
+        all_nl_mass_idx_start = self._gather_index_array(
+            "all_nl_mass_idx_start", _patch_idx_start(old_nl_mass_idx_start, old_nl_mass, new_nl_mass, search_array)
+        )
+
+        index = [
+            all_ions_mz_idx_start,
+            all_ions_mz,
+            all_ions_intensity,
+            all_ions_spec_idx,
+            all_nl_mass_idx_start,
+            all_nl_mass,
+            all_nl_intensity,
+            all_nl_spec_idx,
+            all_ions_idx_for_nl,
+        ]
+        return index
+
+    def delete_spectra(self, all_spec_idx):
+        """
+        Mark the spectra as deleted. The deleted spectra are skipped when searching, their similarity is always 0.
+        The postings of the deleted spectra stay in the index until `compact` is called.
+
+        :param all_spec_idx:    The index of the spectra to delete.
+        """
+        deleted_spectra = np.array(self.deleted_spectra, dtype=bool)
+        deleted_spectra[all_spec_idx] = True
+        self._set_deleted_spectra(deleted_spectra)
+
+    def compact(self):
+        """
+        Physically remove the postings of the deleted spectra from the index. The remaining spectra are renumbered in order,
+        the index is identical to the one built from the remaining spectra.
+
+        :return:    The mask of the remaining spectra in the index before compaction.
+        """
+        is_kept_spectrum = ~self.deleted_spectra
+        if self.deleted_spectra_num == 0:
+            return is_kept_spectrum
+        index = self._remove_spectra_from_index(is_kept_spectrum)
+        self.total_spectra_num = int(np.count_nonzero(is_kept_spectrum))
+        self.total_peaks_num = int(index[1].shape[0])
+        self._set_deleted_spectra(np.zeros(self.total_spectra_num, dtype=bool))
+        self.index = self._save_built_index(index)
+        return is_kept_spectrum
+
+    def _remove_spectra_from_index(self, is_kept_spectrum):
+        """
+        Remove the postings of the spectra not in is_kept_spectrum from the index, the remaining spectra are renumbered in order.
+
+        :param is_kept_spectrum:    The mask of the spectra to keep.
+        :return:    The new index.
+        """
+        (
+            old_ions_mz_idx_start,
+            old_ions_mz,
+            old_ions_intensity,
+            old_ions_spec_idx,
+            old_nl_mass_idx_start,
+            old_nl_mass,
+            old_nl_intensity,
+            old_nl_spec_idx,
+            old_ions_idx_for_nl,
+        ) = self.index
+        new_spec_idx_map = (np.cumsum(is_kept_spectrum) - 1).astype(np.uint32)
+
+        # Remove the product ions.
+        is_kept_peak = is_kept_spectrum[old_ions_spec_idx]
+        new_ions_loc = np.cumsum(is_kept_peak) - 1
+        all_ions_mz = self._gather_index_array("all_ions_mz", old_ions_mz[is_kept_peak])
+        all_ions_intensity = self._gather_index_array("all_ions_intensity", old_ions_intensity[is_kept_peak])
+        all_ions_spec_idx = self._gather_index_array("all_ions_spec_idx", new_spec_idx_map[old_ions_spec_idx[is_kept_peak]])
+        all_ions_mz_idx_start = self._gather_index_array(
+            "all_ions_mz_idx_start", _remove_from_idx_start(old_ions_mz_idx_start, old_ions_mz[~is_kept_peak], all_ions_mz, self.mz_index_step)
+        )
+
+        # Remove the neutral loss ions.
+        is_kept_peak = is_kept_spectrum[old_nl_spec_idx]
+        all_nl_mass = self._gather_index_array("all_nl_mass", old_nl_mass[is_kept_peak])
+        all_nl_intensity = self._gather_index_array("all_nl_intensity", old_nl_intensity[is_kept_peak])
+        all_nl_spec_idx = self._gather_index_array("all_nl_spec_idx", new_spec_idx_map[old_nl_spec_idx[is_kept_peak]])
+        all_ions_idx_for_nl = self._gather_index_array("all_ions_idx_for_nl", new_ions_loc[old_ions_idx_for_nl[is_kept_peak]].view(np.uint64))
+        all_nl_mass_idx_start = self._gather_index_array(
+            "all_nl_mass_idx_start", _remove_from_idx_start(old_nl_mass_idx_start, old_nl_mass[~is_kept_peak], all_nl_mass, self.mz_index_step)
+        )
+        del is_kept_peak, new_ions_loc
+
+        index = [
+            all_ions_mz_idx_start,
+            all_ions_mz,
+            all_ions_intensity,
+            all_ions_spec_idx,
+            all_nl_mass_idx_start,
+            all_nl_mass,
+            all_nl_intensity,
+            all_nl_spec_idx,
+            all_ions_idx_for_nl,
+        ]
+        return index
+
+    def _set_deleted_spectra(self, deleted_spectra):
+        self.deleted_spectra = deleted_spectra
+        self.deleted_spectra_num = int(np.count_nonzero(deleted_spectra))
+        # The mask used by the search kernel, 1 for the spectra to search.
+        self._search_mask = np.logical_not(deleted_spectra).view(np.uint8)
+
+    def _get_search_mask(self, spectra_mask):
+        """
+        Combine the spectra mask with the deletion bitmap.
+
+        :return:    A np.uint8 array, 1 for the spectra to search, or None when all spectra are searched.
+        """
+        if spectra_mask is None:
+            return self._search_mask if self.deleted_spectra_num > 0 else None
+        spectra_mask = np.asarray(spectra_mask, dtype=bool)
+        assert spectra_mask.shape == (self.total_spectra_num,), "The length of the spectra mask should be the same as the number of spectra."
+        return np.logical_and(spectra_mask, self._search_mask.view(bool)).view(np.uint8)
+
+    def _apply_search_mask(self, similarity_array, search_mask):
+        """
+        Set the result of the spectra not in the search mask to 0, used when they are not skipped by the search kernel.
+        """
+        if search_mask is not None:
+            similarity_array[..., search_mask == 0] = 0
+        return similarity_array
+
+    def _read_deleted_spectra(self, path_data):
+        """
+        Read the deletion bitmap, if the file does not exist, no spectrum is deleted.
+        """
+        path_file = Path(path_data) / "deleted_spectra.npy"
+        if path_file.exists():
+            deleted_spectra = np.unpackbits(np.fromfile(path_file, dtype=np.uint8), count=self.total_spectra_num).astype(bool)
+        else:
+            deleted_spectra = np.zeros(self.total_spectra_num, dtype=bool)
+        self._set_deleted_spectra(deleted_spectra)
+
+    def _write_deleted_spectra(self, path_data):
+        """
+        Write the deletion bitmap, one bit for each spectrum.
+        """
+        np.packbits(self.deleted_spectra).tofile(str(Path(path_data) / "deleted_spectra.npy"))
+
+    def _save_built_index(self, index):
+        """
+        Called after the index is built or merged, the subclasses can save the index here. The ownership of the index arrays is
+        passed in, the caller should not keep other references to them.
+        """
+        return self._set_posting_layout(index)
+
+    def set_posting_layout(self, posting_layout):
+        """
+        Change the in-memory layout of the postings of the index, can be "separate" or "packed", see `build_index`.
+        The layout is saved by `write`, so it is kept when the index is read again.
+        """
+        self._select_posting_layout(posting_layout)
+        if self.index:
+            self.index = self._set_posting_layout(self.index)
+
+    def _select_posting_layout(self, posting_layout):
+        """
+        Set the layout used for the index built or read later, the subclasses which can not use the layout can keep the current one.
+        """
+        _check_posting_layout(posting_layout)
+        self.posting_layout = posting_layout
+
+    def _set_posting_layout(self, index):
+        """
+        Store the intensity and the spec_idx of the postings as two field views of one record array when the layout is "packed",
+        or as two arrays when the layout is "separate". The rest of the code uses the views as the separate arrays.
+        """
+        for intensity_idx in (2, 6):
+            intensity, spec_idx = index[intensity_idx], index[intensity_idx + 1]
+            is_packed = _is_packed_postings(intensity)
+            if self.posting_layout == "packed" and not is_packed:
+                postings = np.empty(intensity.shape[0], dtype=_PACKED_POSTING_DTYPE)
+                postings["intensity"] = intensity
+                postings["spec_idx"] = spec_idx
+                index[intensity_idx], index[intensity_idx + 1] = postings["intensity"], postings["spec_idx"]
+            elif self.posting_layout == "separate" and is_packed:
+                index[intensity_idx], index[intensity_idx + 1] = np.ascontiguousarray(intensity), np.ascontiguousarray(spec_idx)
+        return index
+
+    def _merge_index_array(self, name, old_array, old_loc, new_array, new_loc):
+        """
+        Write the existing array and the new array into the buffer allocated for the index array `name`, at the locations old_loc and new_loc.
+        """
+        index_array = self._allocate_index_array(name, old_array.shape[0] + new_array.shape[0])
+        index_array[old_loc] = old_array
+        index_array[new_loc] = new_array
+        return index_array
+
+    def _allocate_index_array(self, name, length):
+        """
+        Allocate the buffer for one index array, the subclasses can return a memory-mapped file instead.
+        """
+        return np.empty(length, dtype=self.index_dtypes[name])
+
+    def _gather_index_array(self, name, array, order=None):
+        """
+        Write array[order] (or the array itself when order is None) into the buffer allocated for the index array `name`.
+        """
+        index_array = self._allocate_index_array(name, array.shape[0] if order is None else order.shape[0])
+        if order is None:
+            index_array[:] = array
+        else:
+            np.take(array, order, out=index_array)
+        return index_array
+
     def _preprocess_peaks(self, peaks):
         """
         Preprocess the peaks.
@@ -515,6 +1174,157 @@ class FlashEntropySearchCore:
         modified_value = intensity_mix * np.log2(intensity_mix) - intensity_library * np.log2(intensity_library) - intensity_query * np.log2(intensity_query)
         return modified_value
 
+    def _search_with_multiple_tolerances(
+        self,
+        peaks,
+        all_ms2_tolerance_in_da,
+        library_mz_idx_start,
+        library_mz,
+        library_peaks_intensity,
+        library_spec_idx,
+        search_type,
+        search_spectra_idx_min,
+        search_spectra_idx_max,
+        search_mask,
+        output_matched_peak_number,
+    ):
+        """
+        Search the query peaks with several MS2 tolerances in one pass on the cpu.
+
+        The window of the largest tolerance is scanned once for each query peak. Each matched library peak is scored once and
+        assigned to the smallest tolerance whose window contains it, the window bounds are the same as in the search with a single
+        tolerance. As the windows are nested, the similarity of a tolerance is the cumulative sum over this and the smaller tolerances.
+
+        :return:    A 2D array with one row of entropy similarity for each tolerance, in the order of `all_ms2_tolerance_in_da`.
+                    If `output_matched_peak_number` is True, a tuple of (entropy_similarity, matched_peak_number), both are 2D arrays.
+        """
+        tolerance_order = np.argsort(all_ms2_tolerance_in_da, kind="stable")
+        all_sorted_tolerance = all_ms2_tolerance_in_da[tolerance_order]
+        tolerance_num, spectra_num = len(all_sorted_tolerance), self.total_spectra_num
+        max_ms2_tolerance = all_sorted_tolerance[-1]
+
+        # The result of each tolerance is stored in one row of a flat array.
+        entropy_similarity = np.zeros(tolerance_num * spectra_num, dtype=np.float32)
+        if output_matched_peak_number:
+            matched_peak_number = np.zeros(tolerance_num * spectra_num, dtype=np.uint16)
+        for mz_query, intensity_query in peaks:
+            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - max_ms2_tolerance, library_mz, library_mz_idx_start, "left")
+            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + max_ms2_tolerance, library_mz, library_mz_idx_start, "right")
+            matched_mz = library_mz[product_mz_idx_min:product_mz_idx_max]
+            intensity_library = library_peaks_intensity[product_mz_idx_min:product_mz_idx_max]
+            modified_idx = library_spec_idx[product_mz_idx_min:product_mz_idx_max]
+            if search_type != 0:
+                is_in_range = (modified_idx >= search_spectra_idx_min) & (modified_idx < search_spectra_idx_max)
+                matched_mz, intensity_library, modified_idx = matched_mz[is_in_range], intensity_library[is_in_range], modified_idx[is_in_range]
+
+            # A matched peak is out of the window of a tolerance when it is below the lower bound or above the upper bound,
+            # the lower bounds decrease and the upper bounds increase with the tolerance.
+            all_mz_min = mz_query - all_sorted_tolerance
+            all_mz_max = mz_query + all_sorted_tolerance
+            tolerance_idx = np.maximum(
+                tolerance_num - np.searchsorted(all_mz_min[::-1], matched_mz, side="right"),
+                np.searchsorted(all_mz_max, matched_mz, side="left"),
+            )
+            modified_idx = tolerance_idx * spectra_num + modified_idx
+            entropy_similarity[modified_idx] += self._score_peaks_with_cpu(intensity_query, intensity_library)
+            if output_matched_peak_number:
+                matched_peak_number[modified_idx] += 1
+
+        entropy_similarity = _accumulate_rows(entropy_similarity.reshape(tolerance_num, spectra_num), tolerance_order, search_mask)
+        if output_matched_peak_number:
+            matched_peak_number = _accumulate_rows(matched_peak_number.reshape(tolerance_num, spectra_num), tolerance_order, search_mask)
+            return entropy_similarity, matched_peak_number
+        return entropy_similarity
+
+    def _search_with_pruning(
+        self, peaks, all_ms2_tolerance, library_mz, library_peaks_intensity, library_spec_idx, search_mask, min_similarity, topn
+    ):
+        """
+        Search the whole library, only the spectra which can reach the threshold are scored exactly (MaxScore pruning).
+
+        The contribution of a query peak with intensity a to a spectrum is at most f(a, 0.5), as the library intensity is at most 0.5,
+        and 0 when no library peak is in its m/z window. The query peaks are searched in the decreasing order of this bound.
+        The contribution of the remaining peaks is bounded by the sum of their bounds, and by A * h(0.5 / A), where A is their total intensity
+        and h(c) = (1 + c) * log2(1 + c) - c * log2(c), which is the maximum when the library intensity (0.5 in total) is spread in proportion
+        to the query intensity.
+        Once the remaining bound is below the threshold, a spectrum not matched yet can not reach the threshold, so the remaining peaks only
+        score the candidate spectra, and the candidates are dropped once their current similarity plus the remaining bound is below the threshold.
+        For topn search, the threshold is raised to the topn-th highest similarity found so far, which is checked each time the remaining
+        bound drops by 30%, and after each peak once only the candidates are scored. The spectra matched so far are recorded,
+        so the threshold and the candidates are found from them instead of the whole library.
+        """
+        min_similarity = min_similarity or 0.0
+        # The slack for the accumulation error of float32.
+        tolerance = 1e-5
+
+        # The m/z window and the upper bound of the contribution of each query peak.
+        all_idx_min = np.searchsorted(library_mz, peaks[:, 0] - all_ms2_tolerance, side="left")
+        all_idx_max = np.searchsorted(library_mz, peaks[:, 0] + all_ms2_tolerance, side="right")
+        all_upper_bound = self._score_peaks_with_cpu(peaks[:, 1].astype(np.float64), 0.5)
+        all_upper_bound[all_idx_max <= all_idx_min] = 0
+        peak_order = np.argsort(-all_upper_bound, kind="stable")
+        # The upper bound of the contribution of the peaks searched after each peak.
+        all_remaining_bound = np.cumsum(all_upper_bound[peak_order][::-1])[::-1] - all_upper_bound[peak_order]
+        all_remaining_intensity = np.cumsum(peaks[peak_order, 1][::-1].astype(np.float64))[::-1] - peaks[peak_order, 1]
+        is_remaining = all_remaining_intensity > 0
+        library_to_query_ratio = 0.5 / all_remaining_intensity[is_remaining]
+        all_remaining_bound[is_remaining] = np.minimum(
+            all_remaining_bound[is_remaining],
+            all_remaining_intensity[is_remaining]
+            * ((1 + library_to_query_ratio) * np.log2(1 + library_to_query_ratio) - library_to_query_ratio * np.log2(library_to_query_ratio)),
+        )
+
+        entropy_similarity = np.zeros(self.total_spectra_num, dtype=np.float32)
+        # The spectra matched by the peaks searched before all candidates are found, a spectrum is recorded when it is first matched.
+        all_matched_idx = []
+        threshold = min_similarity
+        bound_to_check_topn = np.inf
+        candidate_idx = None
+        for peak_idx, remaining_bound in zip(peak_order, all_remaining_bound):
+            idx_min, idx_max = all_idx_min[peak_idx], all_idx_max[peak_idx]
+            if idx_max <= idx_min:
+                continue
+            modified_idx = library_spec_idx[idx_min:idx_max]
+            intensity_library = library_peaks_intensity[idx_min:idx_max]
+            if candidate_idx is not None:
+                is_kept = is_candidate[modified_idx]
+            elif search_mask is not None:
+                is_kept = search_mask[modified_idx].view(bool)
+            else:
+                is_kept = None
+            if is_kept is not None:
+                modified_idx = modified_idx[is_kept]
+                intensity_library = intensity_library[is_kept]
+            if candidate_idx is None:
+                all_matched_idx.append(modified_idx[entropy_similarity[modified_idx] == 0])
+            if len(modified_idx) > 0:
+                entropy_similarity[modified_idx] += self._score_peaks_with_cpu(peaks[peak_idx, 1], intensity_library)
+
+            if candidate_idx is None:
+                if topn and remaining_bound < bound_to_check_topn:
+                    all_matched_idx = [np.concatenate(all_matched_idx)]
+                    threshold = max(threshold, _get_kth_largest(entropy_similarity[all_matched_idx[0]], topn))
+                    bound_to_check_topn = remaining_bound * 0.7
+                if remaining_bound + tolerance < threshold:
+                    # The spectra not matched yet can not reach the threshold.
+                    matched_idx = np.concatenate(all_matched_idx)
+                    candidate_idx = matched_idx[entropy_similarity[matched_idx] + (remaining_bound + tolerance) >= threshold]
+                    is_candidate = np.zeros(self.total_spectra_num, dtype=bool)
+                    is_candidate[candidate_idx] = True
+            else:
+                if topn:
+                    threshold = max(threshold, _get_kth_largest(entropy_similarity[candidate_idx], topn))
+                is_still_candidate = entropy_similarity[candidate_idx] + (remaining_bound + tolerance) >= threshold
+                is_candidate[candidate_idx[~is_still_candidate]] = False
+                candidate_idx = candidate_idx[is_still_candidate]
+                if len(candidate_idx) == 0:
+                    break
+
+        if candidate_idx is not None:
+            # Only the similarity of the candidates is exact, the other spectra are scored only before the candidates are found.
+            entropy_similarity[matched_idx[~is_candidate[matched_idx]]] = 0
+        return entropy_similarity
+
     def _score_peaks_gpu(self, entropy_transform, intensity_query, intensity_library):
         return entropy_transform(intensity_library, intensity_query)
 
@@ -544,7 +1354,12 @@ class FlashEntropySearchCore:
             return
 
         for i, array in enumerate(self.index):
-            self.index[i] = _convert_numpy_array_to_shared_memory(array)
+            if i in (2, 6) and _is_packed_postings(array):
+                # Move the record array, then view its fields again.
+                postings = _convert_numpy_array_to_shared_memory(array.base.view(np.uint64)).view(_PACKED_POSTING_DTYPE)
+                self.index[i], self.index[i + 1] = postings["intensity"], postings["spec_idx"]
+            elif not (i in (3, 7) and _is_packed_postings(self.index[i - 1])):
+                self.index[i] = _convert_numpy_array_to_shared_memory(array)
         self._init_for_multiprocessing = True
 
     def read(self, path_data=None):
@@ -566,6 +1381,9 @@ class FlashEntropySearchCore:
             self.total_spectra_num = information["total_spectra_num"]
             self.total_peaks_num = information["total_peaks_num"]
             self.max_ms2_tolerance_in_da = information["max_ms2_tolerance_in_da"]
+            self.posting_layout = information.get("posting_layout", self.posting_layout)
+            self.index = self._set_posting_layout(self.index)
+            self._read_deleted_spectra(path_data)
             return True
         except:
             return False
@@ -586,9 +1404,58 @@ class FlashEntropySearchCore:
             "total_spectra_num": int(self.total_spectra_num),
             "total_peaks_num": int(self.total_peaks_num),
             "max_ms2_tolerance_in_da": float(self.max_ms2_tolerance_in_da),
+            "posting_layout": self.posting_layout,
         }
         with open(path_data / "information.json", "w") as f:
             json.dump(information, f)
+        self._write_deleted_spectra(path_data)
+
+
+# The record of the "packed" posting layout.
+_PACKED_POSTING_DTYPE = np.dtype([("intensity", np.float32), ("spec_idx", np.uint32)])
+
+
+def _get_ms2_tolerance_array(all_mz, ms2_tolerance_in_da, ms2_tolerance_in_ppm, max_ms2_tolerance_in_da):
+    """
+    Get the MS2 tolerance in Da of each query peak. When ms2_tolerance_in_ppm is positive, the tolerance of the peak at m/z x is
+    x * ms2_tolerance_in_ppm * 1e-6, otherwise it is ms2_tolerance_in_da. The tolerance is float32, as the m/z of the peaks.
+    """
+    if ms2_tolerance_in_ppm is not None and ms2_tolerance_in_ppm > 0:
+        all_ms2_tolerance = (np.asarray(all_mz, dtype=np.float64) * (ms2_tolerance_in_ppm * 1e-6)).astype(np.float32)
+        assert (
+            len(all_ms2_tolerance) == 0 or np.max(all_ms2_tolerance) <= max_ms2_tolerance_in_da
+        ), f"The MS2 tolerance is larger than the maximum MS2 tolerance, use ms2_tolerance_in_ppm <= {max_ms2_tolerance_in_da * 1e6 / np.max(all_mz):.1f} for this query."
+    else:
+        assert ms2_tolerance_in_da <= max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        all_ms2_tolerance = np.full(len(all_mz), ms2_tolerance_in_da, dtype=np.float32)
+    return all_ms2_tolerance
+
+
+def _accumulate_rows(array, row_order, search_mask):
+    """
+    Replace each row of the 2D array by the sum of itself and the rows before it, then put the rows back to the original order
+    given by `row_order` and set the columns not in the search mask to 0. The rows are added one by one, as a cumulative sum
+    along the first axis reads the array with a large stride.
+    """
+    for row_idx in range(1, array.shape[0]):
+        np.add(array[row_idx], array[row_idx - 1], out=array[row_idx])
+    if np.any(row_order != np.arange(len(row_order))):
+        array = array[np.argsort(row_order)]
+    if search_mask is not None:
+        array[:, search_mask == 0] = 0
+    return array
+
+
+def _is_packed_postings(intensity):
+    """
+    Whether the intensity array of the postings is a field view of a record array of the "packed" layout.
+    """
+    return isinstance(intensity.base, np.ndarray) and intensity.base.dtype == _PACKED_POSTING_DTYPE
+
+
+def _check_posting_layout(posting_layout):
+    if posting_layout not in ("separate", "packed"):
+        raise ValueError(f"Unknown posting layout: {posting_layout}. Use 'separate' or 'packed'.")
 
 
 def _convert_numpy_array_to_shared_memory(np_array, array_c_type=None):
@@ -608,3 +1475,232 @@ def _convert_numpy_array_to_shared_memory(np_array, array_c_type=None):
     np_array_new = np.frombuffer(base, dtype=np_array.dtype).reshape(dim)
     np_array_new[:] = np_array
     return np_array_new
+
+
+def _get_n_jobs(n_jobs):
+    """
+    Convert the n_jobs parameter to the number of workers, None or a value smaller than 1 means using all CPU cores.
+    """
+    if n_jobs is None or n_jobs < 1:
+        return multiprocessing.cpu_count()
+    return int(n_jobs)
+
+
+def _merge_spectra_shard_to_peak_data(parameters):
+    """
+    Collect the peaks of one shard of spectra, used by the worker processes. The spectrum index starts from 0 in each shard.
+    """
+    core_parameters, all_spectra_list = parameters
+    entropy_search = FlashEntropySearchCore(**core_parameters)
+    total_peaks_num = int(np.sum([spectrum["peaks"].shape[0] for spectrum in all_spectra_list]))
+    return entropy_search._merge_all_spectra_to_peak_data(all_spectra_list, total_peaks_num)
+
+
+def _argsort_peak_data(peak_data, all_fields, n_jobs=1):
+    """
+    Get the permutation which sorts the peak data by the fields in `all_fields`, the first field is the most significant one.
+    The sort is stable, the peak data can be a structured array or a dictionary of columns.
+
+    When n_jobs > 1, the value range of the first field is split into n_jobs parts by the splitters sampled from the data. The peaks are
+    distributed to the parts by a stable counting sort, and each part is sorted by `_radix_argsort` in a separate thread
+    (numpy releases the GIL while sorting). The peaks with the same value of the first field are always in the same part.
+
+    :return:    The permutation as a np.int64 array.
+    """
+    all_keys = [peak_data[field] for field in all_fields]
+    total_peaks_num = all_keys[0].shape[0]
+    if n_jobs <= 1 or total_peaks_num < n_jobs * 2:
+        return _radix_argsort(all_keys)
+
+    # Choose the splitters from the samples of the first field.
+    all_samples = np.sort(all_keys[0][np.linspace(0, total_peaks_num - 1, n_jobs * 64).astype(np.int64)])
+    splitters = all_samples[np.linspace(0, all_samples.shape[0] - 1, n_jobs + 1).astype(np.int64)[1:-1]]
+
+    # Distribute the peaks to the parts.
+    part_id = np.searchsorted(splitters, all_keys[0], side="right").astype(np.uint16)
+    part_loc = np.concatenate(([0], np.cumsum(np.bincount(part_id, minlength=n_jobs))))
+    sorted_idx = np.argsort(part_id, kind="stable")
+    del part_id
+
+    def sort_part(i):
+        part_idx = sorted_idx[part_loc[i] : part_loc[i + 1]]
+        part_idx[:] = part_idx[_radix_argsort([key[part_idx] for key in all_keys])]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(sort_part, range(n_jobs)))
+    return sorted_idx
+
+
+def _radix_sort_peak_data(peak_data, order):
+    """
+    Sort the peak data in place by the field `order`, the result is identical to `peak_data.sort(order=order)`:
+    the ties are broken by the other fields in the order in which they come up in the dtype.
+    """
+    if peak_data.shape[0] < 2:
+        return peak_data
+    all_fields = [order] + [name for name in peak_data.dtype.names if name != order]
+    sorted_idx = _radix_argsort([peak_data[field] for field in all_fields])
+    peak_data[:] = peak_data[sorted_idx]
+    return peak_data
+
+
+def _radix_argsort(all_keys):
+    """
+    Get the permutation which stably sorts the arrays in `all_keys` lexicographically, the first array is the most significant one.
+
+    The structured array sort compares the records field by field, which is slow. Here the keys are converted to unsigned
+    integer keys with the same order, and sorted by a least significant digit radix sort with 16-bit digits,
+    each pass is a stable counting sort (np.argsort with kind="stable" uses the radix sort for 16-bit integers).
+    The digits which are already in order are skipped, e.g. the spectrum index of the peaks collected spectrum by spectrum.
+    """
+    sorted_idx = np.arange(all_keys[0].shape[0], dtype=np.int64)
+    is_identity = True
+    for key in reversed(all_keys):
+        key = _convert_to_sortable_key(key)
+        if not is_identity:
+            key = key[sorted_idx]
+        for shift in range(0, key.dtype.itemsize * 8, 16):
+            digit = ((key >> key.dtype.type(shift)) & key.dtype.type(0xFFFF)).astype(np.uint16)
+            if np.all(digit[1:] >= digit[:-1]):
+                continue
+            digit_sorted_idx = np.argsort(digit, kind="stable")
+            key = key[digit_sorted_idx]
+            sorted_idx = digit_sorted_idx if is_identity else sorted_idx[digit_sorted_idx]
+            is_identity = False
+    return sorted_idx
+
+
+def _convert_to_sortable_key(array):
+    """
+    Convert a float or integer array to an unsigned integer array with the same order.
+    """
+    if array.dtype.kind == "u":
+        return array
+    if array.dtype.kind == "i":
+        key_type = np.dtype("u{}".format(array.dtype.itemsize)).type
+        return array.view(key_type) ^ key_type(1 << (array.dtype.itemsize * 8 - 1))
+    if array.dtype.kind == "f":
+        # Adding 0.0 converts -0.0 to 0.0.
+        key_type = np.dtype("u{}".format(array.dtype.itemsize)).type
+        key = (array + array.dtype.type(0.0)).view(key_type)
+        sign_bit = key_type(1 << (array.dtype.itemsize * 8 - 1))
+        # For the negative values, flip all bits, for the positive values, set the sign bit.
+        return np.where(key & sign_bit, ~key, key | sign_bit)
+    raise ValueError("Unsupported dtype for sorting: {}".format(array.dtype))
+
+
+def _generate_idx_start(all_mass, search_array, chunk_size=10_000_000):
+    """
+    Generate the start location of each value of the search_array in the sorted mass array. The result is identical to
+    `np.searchsorted(all_mass, search_array, side="left")`, but the mass array does not need to be sorted.
+
+    The search_array should be evenly spaced and start from 0, like `np.arange(0.0, max_mz, mz_index_step)`.
+    Instead of binary searching each value, every mass is put into a bin by a counting pass: the bin of a mass is the number of
+    the values in the search_array which are not larger than it, and the start location of a value is the cumulative count of the
+    bins before it. This costs O(n + m) instead of O(m log n).
+
+    :param all_mass:    The mass array.
+    :param search_array:    The evenly spaced search array starting from 0.
+    :param chunk_size:  The number of masses processed at once, to limit the memory usage.
+    :return:    The start location of each value in the search_array, with dtype np.int64.
+    """
+    bins_num = search_array.shape[0]
+    if bins_num == 0:
+        return np.zeros(0, dtype=np.int64)
+    step = search_array[1] - search_array[0] if bins_num > 1 else 1.0
+
+    bin_count = np.zeros(bins_num + 1, dtype=np.int64)
+    for chunk_start in range(0, all_mass.shape[0], chunk_size):
+        # The values are compared in float64, same as np.searchsorted.
+        mass = all_mass[chunk_start : chunk_start + chunk_size].astype(np.float64)
+        mass_bin = np.floor(mass / step) + 1
+        mass_bin = np.clip(np.nan_to_num(mass_bin, nan=bins_num), 0, bins_num).astype(np.int64)
+
+        # Correct the bins affected by the rounding error.
+        while True:
+            to_decrease = (mass_bin > 0) & (search_array[np.maximum(mass_bin - 1, 0)] > mass)
+            if not np.any(to_decrease):
+                break
+            mass_bin[to_decrease] -= 1
+        while True:
+            to_increase = (mass_bin < bins_num) & (search_array[np.minimum(mass_bin, bins_num - 1)] <= mass)
+            if not np.any(to_increase):
+                break
+            mass_bin[to_increase] += 1
+
+        bin_count += np.bincount(mass_bin, minlength=bins_num + 1)
+
+    return np.cumsum(bin_count)[:bins_num]
+
+
+def _count_smaller_keys(all_sorted_keys, all_query_keys):
+    """
+    For each query, count the number of the sorted items which are smaller than it. The items and the queries are compared
+    lexicographically by the arrays in all_sorted_keys and all_query_keys, the first array is the most significant one.
+
+    It is a vectorized binary search: the range of the items equal to the query in the previous keys is narrowed key by key.
+
+    :param all_sorted_keys: A list of arrays, the items are sorted lexicographically by them.
+    :param all_query_keys:  A list of arrays with the same length as all_sorted_keys.
+    :return:    The number of the smaller items for each query, with dtype np.int64.
+    """
+    query_num = all_query_keys[0].shape[0]
+    range_start = np.zeros(query_num, dtype=np.int64)
+    range_end = np.full(query_num, all_sorted_keys[0].shape[0], dtype=np.int64)
+    for i, (sorted_key, query_key) in enumerate(zip(all_sorted_keys, all_query_keys)):
+        # The first item in the range which is not smaller than the query.
+        lower_bound = _binary_search_in_range(sorted_key, query_key, range_start, range_end, np.less)
+        if i == len(all_sorted_keys) - 1:
+            return lower_bound
+        # The first item in the range which is larger than the query.
+        upper_bound = _binary_search_in_range(sorted_key, query_key, range_start, range_end, np.less_equal)
+        range_start, range_end = lower_bound, upper_bound
+    return range_start
+
+
+def _binary_search_in_range(sorted_key, query_key, range_start, range_end, compare):
+    """
+    For each query, find the first location in [range_start, range_end) where compare(sorted_key[loc], query_key) is False.
+    """
+    low, high = range_start.copy(), range_end.copy()
+    while True:
+        is_searching = low < high
+        if not np.any(is_searching):
+            return low
+        middle = (low + high) // 2
+        go_right = is_searching & compare(sorted_key[np.minimum(middle, sorted_key.shape[0] - 1)], query_key)
+        low = np.where(go_right, middle + 1, low)
+        high = np.where(is_searching & ~go_right, middle, high)
+
+
+def _patch_idx_start(old_idx_start, old_mass, new_mass, search_array):
+    """
+    Get the start table of the merged mass array from the start table of the existing mass array: the start location is the number of
+    masses smaller than the value, so the counts of the new masses are added to it. The search_array can be longer than the existing table.
+    """
+    old_idx_start = np.concatenate(
+        (old_idx_start[: search_array.shape[0]], np.searchsorted(old_mass, search_array[old_idx_start.shape[0] :], side="left"))
+    ).astype(np.int64)
+    return old_idx_start + _generate_idx_start(new_mass, search_array)
+
+
+def _remove_from_idx_start(old_idx_start, removed_mass, all_mass, mz_index_step):
+    """
+    Get the start table after removing some masses from the sorted mass array, by subtracting the counts of the removed masses.
+    The table is shortened in the same way as building it from the remaining masses, as its length depends on the maximum mass.
+    """
+    # Same as the search array used to build the table, np.arange(0.0, max_mz, mz_index_step).
+    search_array = np.arange(old_idx_start.shape[0], dtype=np.float64) * mz_index_step
+    idx_start = old_idx_start - _generate_idx_start(removed_mass, search_array)
+    if all_mass.shape[0] > 0:
+        idx_start = idx_start[: np.arange(0.0, all_mass[-1], mz_index_step).shape[0]]
+    return idx_start.astype(np.int64)
+
+
+def _get_kth_largest(array, k):
+    """
+    Get the kth largest value of the array, 0 if the array has less than k values.
+    """
+    if array.shape[0] < k:
+        return 0.0
+    return float(np.partition(array, array.shape[0] - k)[array.shape[0] - k])
@@ -5,6 +5,8 @@ from pathlib import Path
 from functools import reduce
 import multiprocessing
 from ..spectra import apply_weight_to_intensity
+from .flash_entropy_search_core import _radix_sort_peak_data, _generate_idx_start, _get_ms2_tolerance_array
+from .fast_flash_entropy_search import entropy_similarity_accumulate_partitioned, entropy_similarity_search_with_mask
 
 
 class FlashEntropySearchCoreForDynamicIndexing:
@@ -14,6 +16,7 @@ class FlashEntropySearchCoreForDynamicIndexing:
         max_ms2_tolerance_in_da=0.024,
         mz_index_step=0.0001,
         intensity_weight="entropy",  # "entropy" or None
+        score_partition_size=0,
     ) -> None:
         """
         Initialize the EntropySearch class.
@@ -24,8 +27,11 @@ class FlashEntropySearchCoreForDynamicIndexing:
                                 The smaller the step size, the faster the search, but the larger the index size and longer the index building time.
         :param intensity_weight: The weight of the intensity, can be "entropy" or None. If set to "entropy", the intensity will be weighted by the entropy.
                                 If set to None, the intensity will not be weighted, which is equivalent to the unweighted entropy similarity.
+        :param score_partition_size:    The number of spectra in each partition of the similarity array, rounded down to a power of 2. Default is 0.
+                                        If set, the matched peaks are accumulated partition by partition, see `FlashEntropySearchCore`.
         """
         self.mz_index_step = mz_index_step
+        self.score_partition_size = score_partition_size
         self._init_for_multiprocessing = False
         self.max_ms2_tolerance_in_da = max_ms2_tolerance_in_da
         self.intensity_weight = intensity_weight
@@ -44,6 +50,8 @@ class FlashEntropySearchCoreForDynamicIndexing:
         peaks=None,
         ms2_tolerance_in_da=0.02,
         output_matched_peak_number=False,
+        ms2_tolerance_in_ppm=None,
+        spectra_mask=None,
     ):
         """
         Perform identity-, open- or neutral loss search on the MS/MS spectra library.
@@ -56,6 +64,10 @@ class FlashEntropySearchCoreForDynamicIndexing:
         :param ms2_tolerance_in_da: The MS2 tolerance used when searching the MS/MS spectra, in Dalton. Default is 0.02.
         :param output_matched_peak_number: Whether to output the number of matched peaks. Only supported when target is "cpu".
                                             If set to True, the function will return a tuple of (entropy_similarity, matched_peak_number).
+        :param ms2_tolerance_in_ppm:    The MS2 tolerance in ppm. If set to a positive value, it is used instead of ms2_tolerance_in_da,
+                                        and the tolerance of a query peak at m/z x is x * ms2_tolerance_in_ppm * 1e-6 Da.
+        :param spectra_mask:    A boolean array with the length of the number of spectra, only the spectra with True are searched,
+                                the other spectra are skipped before they are scored and their similarity is 0. Default is None, search all spectra.
         """
         if not self.index:
             return np.zeros(0, dtype=np.float32)
@@ -63,13 +75,18 @@ class FlashEntropySearchCoreForDynamicIndexing:
             return np.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Check peaks
-        assert ms2_tolerance_in_da <= self.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
         assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
         assert (
             peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
         ), "The peaks array should be sorted by m/z, and the m/z difference between two adjacent peaks should be larger than 2 * max_ms2_tolerance_in_da."
         # Prepare the query spectrum
         peaks = self._preprocess_peaks(peaks)
+        search_mask = None
+        if spectra_mask is not None:
+            search_mask = np.ascontiguousarray(spectra_mask, dtype=bool)
+            assert search_mask.shape == (self.total_spectra_num,), "The length of the spectra mask should be the same as the number of spectra."
+            search_mask = search_mask.view(np.uint8)
 
         # Prepare the library
         if method == "open":
@@ -85,6 +102,7 @@ class FlashEntropySearchCoreForDynamicIndexing:
             entropy_similarity = np.zeros(self.total_spectra_num, dtype=np.float32)
             if output_matched_peak_number:
                 matched_peak_number = np.zeros(self.total_spectra_num, dtype=np.uint16)
+            all_modified_idx, all_modified_value = [], []
         else:
             import cupy as cp
 
@@ -97,17 +115,39 @@ class FlashEntropySearchCoreForDynamicIndexing:
             entropy_similarity = cp.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Go through all the peaks in the spectrum
-        for mz_query, intensity_query in peaks:
+        for (mz_query, intensity_query), ms2_tolerance in zip(peaks, all_ms2_tolerance):
             # Determine the mz index range
-            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance_in_da, library_mz, library_mz_idx_start, "left")
-            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance_in_da, library_mz, library_mz_idx_start, "right")
-
-            if target == "cpu":
+            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance, library_mz, library_mz_idx_start, "left")
+            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance, library_mz, library_mz_idx_start, "right")
+
+            if target == "cpu" and search_mask is not None and self.score_partition_size <= 0:
+                # Only score the spectra in the mask.
+                entropy_similarity_search_with_mask(
+                    product_mz_idx_min,
+                    product_mz_idx_max,
+                    intensity_query,
+                    entropy_similarity,
+                    library_peaks_intensity,
+                    library_spec_idx,
+                    0,
+                    self.total_spectra_num,
+                    search_mask,
+                )
+                if output_matched_peak_number:
+                    matched_peak_number[library_spec_idx[product_mz_idx_min:product_mz_idx_max]] += 1
+            elif target == "cpu":
                 intensity_library = library_peaks_intensity[product_mz_idx_min:product_mz_idx_max]
                 modified_idx = library_spec_idx[product_mz_idx_min:product_mz_idx_max]
-                entropy_similarity[modified_idx] += self._score_peaks_with_cpu(intensity_query, intensity_library)
                 if output_matched_peak_number:
                     matched_peak_number[modified_idx] += 1
+                if search_mask is not None:
+                    is_searched = search_mask[modified_idx] != 0
+                    intensity_library, modified_idx = intensity_library[is_searched], modified_idx[is_searched]
+                if self.score_partition_size > 0:
+                    all_modified_idx.append(modified_idx)
+                    all_modified_value.append(self._score_peaks_with_cpu(intensity_query, intensity_library))
+                else:
+                    entropy_similarity[modified_idx] += self._score_peaks_with_cpu(intensity_query, intensity_library)
             elif target == "gpu":
                 intensity_library = cp.array(library_peaks_intensity[product_mz_idx_min:product_mz_idx_max])
                 modified_value = entropy_transform(intensity_library, intensity_query)
@@ -115,15 +155,26 @@ class FlashEntropySearchCoreForDynamicIndexing:
                 entropy_similarity.scatter_add(modified_idx, modified_value)
 
         if target == "cpu":
+            if all_modified_idx:
+                entropy_similarity_accumulate_partitioned(
+                    np.concatenate(all_modified_idx),
+                    np.concatenate(all_modified_value),
+                    entropy_similarity,
+                    max(int(self.score_partition_size).bit_length() - 1, 0),
+                )
             if output_matched_peak_number:
+                if search_mask is not None:
+                    matched_peak_number[search_mask == 0] = 0
                 return entropy_similarity, matched_peak_number
             else:
                 return entropy_similarity
         elif target == "gpu":
             entropy_similarity = entropy_similarity.get()
+            if search_mask is not None:
+                entropy_similarity[search_mask == 0] = 0
             return entropy_similarity
 
-    def search_hybrid(self, target="cpu", precursor_mz=None, peaks=None, ms2_tolerance_in_da=0.02):
+    def search_hybrid(self, target="cpu", precursor_mz=None, peaks=None, ms2_tolerance_in_da=0.02, ms2_tolerance_in_ppm=None):
         """
         Perform the hybrid search for the MS/MS spectra.
 
@@ -131,6 +182,7 @@ class FlashEntropySearchCoreForDynamicIndexing:
         :param precursor_mz: The precursor m/z of the MS/MS spectra.
         :param peaks: The peaks of the MS/MS spectra, needs to be cleaned with the "clean_spectrum" function.
         :param ms2_tolerance_in_da: The MS/MS tolerance in Da.
+        :param ms2_tolerance_in_ppm:    The MS/MS tolerance in ppm, used instead of ms2_tolerance_in_da when it is positive.
         """
         if not self.index:
             return np.zeros(0, dtype=np.float32)
@@ -138,7 +190,7 @@ class FlashEntropySearchCoreForDynamicIndexing:
             return np.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Check peaks
-        assert ms2_tolerance_in_da <= self.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
         assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
         assert (
             peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
@@ -150,15 +202,16 @@ class FlashEntropySearchCoreForDynamicIndexing:
         peaks = self._preprocess_peaks(peaks)
 
         # Go through all peak in the spectrum and determine the mz index range
-        product_peak_match_mz_min = peaks[:, 0] - ms2_tolerance_in_da
-        product_peak_match_mz_max = peaks[:, 0] + ms2_tolerance_in_da
+        product_peak_match_mz_min = peaks[:, 0] - all_ms2_tolerance
+        product_peak_match_mz_max = peaks[:, 0] + all_ms2_tolerance
 
         product_peak_match_idx_min = np.zeros(peaks.shape[0], dtype=np.uint64)
         product_peak_match_idx_max = np.zeros(peaks.shape[0], dtype=np.uint64)
         for peak_idx, (mz_query, _) in enumerate(peaks):
             # Determine the mz index range
-            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "left")
-            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "right")
+            ms2_tolerance = all_ms2_tolerance[peak_idx]
+            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "left")
+            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "right")
 
             product_peak_match_idx_min[peak_idx] = product_mz_idx_min
             product_peak_match_idx_max[peak_idx] = product_mz_idx_max
@@ -181,9 +234,10 @@ class FlashEntropySearchCoreForDynamicIndexing:
                 ###############################################################
                 # Match the neutral loss ions
                 mz_nl = precursor_mz - mz
+                ms2_tolerance = all_ms2_tolerance[peak_idx]
                 # Determine the mz index range
-                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "left")
-                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "right")
+                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "left")
+                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "right")
 
                 # Calculate the entropy similarity for this matched peak
                 modified_idx_nl = all_nl_spec_idx[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
@@ -234,9 +288,10 @@ class FlashEntropySearchCoreForDynamicIndexing:
                 ###############################################################
                 # Match the neutral loss ions
                 mz_nl = precursor_mz - mz
+                ms2_tolerance = all_ms2_tolerance[peak_idx]
                 # Determine the mz index range
-                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "left")
-                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "right")
+                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "left")
+                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "right")
 
                 # Calculate the entropy similarity for this matched peak
                 modified_idx_nl = all_nl_spec_idx[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
@@ -376,12 +431,12 @@ class FlashEntropySearchCoreForDynamicIndexing:
         # Build index for fast access to the ion's m/z.
         max_mz = min(np.max(all_ions_mz), max_indexed_mz)
         search_array = np.arange(0.0, max_mz, self.mz_index_step)
-        mass_idx_start = np.searchsorted(all_ions_mz, search_array, side="left").astype(np.int64)
+        mass_idx_start = _generate_idx_start(all_ions_mz, search_array)
         return mass_idx_start
 
     def _generate_index_from_peak_data(self, peak_data, max_indexed_mz, index_for_neutral_loss):
         # Sort with precursor m/z.
-        peak_data.sort(order="ion_mz")
+        _radix_sort_peak_data(peak_data, "ion_mz")
 
         # Record the m/z, intensity, and spectrum index information for product ions.
         all_ions_mz = np.copy(peak_data["ion_mz"])
@@ -400,7 +455,7 @@ class FlashEntropySearchCoreForDynamicIndexing:
         ############## Step 3: Build the index by sort with neutral loss mass. ##############
         if index_for_neutral_loss:
             # Sort with the neutral loss mass.
-            peak_data.sort(order="nl_mass")
+            _radix_sort_peak_data(peak_data, "nl_mass")
 
             # Build the index for fast access to the neutral loss mass.
             all_nl_mass_idx_start = self._generate_index(peak_data["nl_mass"], max_indexed_mz)
@@ -2,11 +2,11 @@
 import json
 import numpy as np
 from pathlib import Path
-from .flash_entropy_search_core import FlashEntropySearchCore
+from .flash_entropy_search_core import FlashEntropySearchCore, _get_ms2_tolerance_array, _check_posting_layout
 
 
 class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
-    def __init__(self, path_data, max_ms2_tolerance_in_da=0.024, mz_index_step=0.0001, intensity_weight="entropy") -> None:
+    def __init__(self, path_data, max_ms2_tolerance_in_da=0.024, mz_index_step=0.0001, intensity_weight="entropy", score_partition_size=0) -> None:
         """
         Initialize the EntropySearch class.
         This class use file.read function to read the data from the file, which is suitable for very low memory usage.
@@ -17,8 +17,14 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
         :param intensity_weight:    The weight for the intensity in the entropy calculation, can be "entropy" or None. Default is "entropy".
             - None: The intensity will not be weighted, then the unweighted similarity will be calculated.
             - "entropy": The intensity will be weighted by the entropy, then the entropy similarity will be calculated.
+        :param score_partition_size:    The number of spectra in each partition of the similarity array, 0 to disable the partitioned accumulation.
         """
-        super().__init__(max_ms2_tolerance_in_da=max_ms2_tolerance_in_da, mz_index_step=mz_index_step, intensity_weight=intensity_weight)
+        super().__init__(
+            max_ms2_tolerance_in_da=max_ms2_tolerance_in_da,
+            mz_index_step=mz_index_step,
+            intensity_weight=intensity_weight,
+            score_partition_size=score_partition_size,
+        )
         self.path_data = Path(str(path_data))
         self.path_data.mkdir(parents=True, exist_ok=True)
         self.index_file = []
@@ -27,52 +33,29 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
         for file in self.index_file:
             file.close()
 
-    def _generate_index_from_peak_data(self, peak_data, max_indexed_mz, append):
-        total_peaks_num = peak_data.shape[0]
-
-        # Sort with precursor m/z.
-        peak_data.sort(order="ion_mz")
-
-        # Record the m/z, intensity, and spectrum index information for product ions.
-        (peak_data["ion_mz"]).tofile(self.path_data / "all_ions_mz.npy")
-        (peak_data["intensity"]).tofile(self.path_data / "all_ions_intensity.npy")
-        (peak_data["spec_idx"]).tofile(self.path_data / "all_ions_spec_idx.npy")
-
-        # all_ions_mz = self._convert_view_to_array(peak_data.view(np.float32).reshape(total_peaks_num, -1)[:, 0], np.float32, "all_ions_mz")
-        # all_ions_intensity = self._convert_view_to_array(peak_data.view(np.float32).reshape(total_peaks_num, -1)[:, 2], np.float32, "all_ions_intensity")
-        # all_ions_spec_idx = self._convert_view_to_array(peak_data.view(np.uint32).reshape(total_peaks_num, -1)[:, 3], np.uint32, "all_ions_spec_idx")
-
-        # Assign the index of the product ions.
-        peak_data["peak_idx"] = np.arange(0, self.total_peaks_num, dtype=np.uint64)
-
-        # Build index for fast access to the ion's m/z.
-        all_ions_mz = np.memmap(self.path_data / "all_ions_mz.npy", dtype=np.float32, mode="r", shape=(total_peaks_num,))
-        max_mz = min(np.max(all_ions_mz), max_indexed_mz)
-        search_array = np.arange(0.0, max_mz, self.mz_index_step)
-        all_ions_mz_idx_start = np.searchsorted(all_ions_mz, search_array, side="left").astype(np.int64)
-        all_ions_mz_idx_start.tofile(self.path_data / "all_ions_mz_idx_start.npy")
-
-        ############## Step 3: Build the index by sort with neutral loss mass. ##############
-        # Sort with the neutral loss mass.
-        peak_data.sort(order="nl_mass")
-
-        # Record the m/z, intensity, spectrum index, and product ions index information for neutral loss ions.
-        (peak_data["nl_mass"]).tofile(self.path_data / "all_nl_mass.npy")
-        (peak_data["intensity"]).tofile(self.path_data / "all_nl_intensity.npy")
-        (peak_data["spec_idx"]).tofile(self.path_data / "all_nl_spec_idx.npy")
-        (peak_data["peak_idx"]).tofile(self.path_data / "all_ions_idx_for_nl.npy")
-
-        # all_nl_mass = self._convert_view_to_array(peak_data.view(np.float32).reshape(total_peaks_num, -1)[:, 1], np.float32, "all_nl_mass")
-        # all_nl_intensity = self._convert_view_to_array(peak_data.view(np.float32).reshape(total_peaks_num, -1)[:, 2], np.float32, "all_nl_intensity")
-        # all_nl_spec_idx = self._convert_view_to_array(peak_data.view(np.uint32).reshape(total_peaks_num, -1)[:, 3], np.uint32, "all_nl_spec_idx")
-        # all_ions_idx_for_nl = self._convert_view_to_array(peak_data.view(np.uint64).reshape(total_peaks_num, -1)[:, 2], np.uint64, "all_ions_idx_for_nl")
-
-        # Build the index for fast access to the neutral loss mass.
-        all_nl_mass = np.memmap(self.path_data / "all_nl_mass.npy", dtype=np.float32, mode="r", shape=(total_peaks_num,))
-        max_mz = min(np.max(all_nl_mass), max_indexed_mz)
-        search_array = np.arange(0.0, max_mz, self.mz_index_step)
-        all_nl_mass_idx_start = np.searchsorted(all_nl_mass, search_array, side="left").astype(np.int64)
-        all_nl_mass_idx_start.tofile(self.path_data / "all_nl_mass_idx_start.npy")
+    def _allocate_index_array(self, name, length):
+        """
+        Allocate the index array as a memory-mapped file in the path_data. A temporary file is used, as the existing index files
+        are still read when merging new spectra into the index.
+        """
+        return np.memmap(self.path_data / f"{name}.npy.tmp", dtype=self.index_dtypes[name], mode="w+", shape=(length,))
+
+    def _select_posting_layout(self, posting_layout):
+        # The postings are read from the memory-mapped files, they are always stored as separate arrays.
+        _check_posting_layout(posting_layout)
+
+    def _save_built_index(self, index):
+        # The index arrays are gathered into the files directly, see `_allocate_index_array`.
+        # Empty the list passed in by the caller, so the memory maps of the temporary files and the existing files are closed before
+        # the files are replaced, a mapped file can not be replaced on Windows.
+        while index:
+            index.pop().flush()
+        self.index = []
+        for file in self.index_file:
+            file.close()
+        self.index_file = []
+        for name in self.index_names:
+            (self.path_data / f"{name}.npy.tmp").replace(self.path_data / f"{name}.npy")
 
         ############## Step 4: Save the index. ##############
         self.write()
@@ -100,6 +83,7 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
             self.total_spectra_num = information["total_spectra_num"]
             self.total_peaks_num = information["total_peaks_num"]
             self.max_ms2_tolerance_in_da = information["max_ms2_tolerance_in_da"]
+            self._read_deleted_spectra(self.path_data)
             return True
         except:
             return False
@@ -116,10 +100,22 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
             "total_spectra_num": int(self.total_spectra_num),
             "total_peaks_num": int(self.total_peaks_num),
             "max_ms2_tolerance_in_da": float(self.max_ms2_tolerance_in_da),
+            "posting_layout": self.posting_layout,
         }
         json.dump(information, open(self.path_data / "information.json", "w"))
-
-    def search_hybrid(self, target="cpu", precursor_mz=None, peaks=None, ms2_tolerance_in_da=0.02):
+        self._write_deleted_spectra(self.path_data)
+
+    def search_hybrid(
+        self,
+        target="cpu",
+        precursor_mz=None,
+        peaks=None,
+        ms2_tolerance_in_da=0.02,
+        spectra_mask=None,
+        ms2_tolerance_in_ppm=None,
+        search_spectra_idx_min=0,
+        search_spectra_idx_max=None,
+    ):
         """
         Perform the hybrid search for the MS/MS spectra.
 
@@ -127,6 +123,11 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
         :param precursor_mz: The precursor m/z of the MS/MS spectra.
         :param peaks: The peaks of the MS/MS spectra, needs to be cleaned with the "clean_spectrum" function.
         :param ms2_tolerance_in_da: The MS/MS tolerance in Da.
+        :param spectra_mask:    A boolean array with the length of the number of spectra, only the spectra with True are searched.
+        :param ms2_tolerance_in_ppm:    The MS/MS tolerance in ppm, used instead of ms2_tolerance_in_da when it is positive.
+        :param search_spectra_idx_min:  The minimum index of the MS/MS spectra to search. Default is 0.
+        :param search_spectra_idx_max:  The maximum index of the MS/MS spectra to search, the similarity of the spectra out of
+                                        [search_spectra_idx_min, search_spectra_idx_max) is 0. Default is None, search to the end.
         """
         if not self.index:
             return np.zeros(0, dtype=np.float32)
@@ -134,7 +135,7 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
             return np.zeros(self.total_spectra_num, dtype=np.float32)
 
         # Check peaks
-        assert ms2_tolerance_in_da <= self.max_ms2_tolerance_in_da, "The MS2 tolerance is larger than the maximum MS2 tolerance."
+        all_ms2_tolerance = _get_ms2_tolerance_array(peaks[:, 0], ms2_tolerance_in_da, ms2_tolerance_in_ppm, self.max_ms2_tolerance_in_da)
         assert abs(np.sum(peaks[:, 1]) - 1) < 1e-4, "The peaks are not normalized to sum to 1."
         assert (
             peaks.shape[0] <= 1 or np.min(peaks[1:, 0] - peaks[:-1, 0]) > self.max_ms2_tolerance_in_da * 2
@@ -163,14 +164,16 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
         ) = self.index_file
         # Prepare the query spectrum
         peaks = self._preprocess_peaks(peaks)
+        search_mask = self._get_search_mask(spectra_mask)
 
         # Go through all peak in the spectrum and determine the mz index range
         product_peak_match_idx_min = np.zeros(peaks.shape[0], dtype=np.uint64)
         product_peak_match_idx_max = np.zeros(peaks.shape[0], dtype=np.uint64)
         for peak_idx, (mz_query, _) in enumerate(peaks):
             # Determine the mz index range
-            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "left")
-            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance_in_da, all_ions_mz, all_ions_mz_idx_start, "right")
+            ms2_tolerance = all_ms2_tolerance[peak_idx]
+            product_mz_idx_min = self._find_location_from_array_with_index(mz_query - ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "left")
+            product_mz_idx_max = self._find_location_from_array_with_index(mz_query + ms2_tolerance, all_ions_mz, all_ions_mz_idx_start, "right")
 
             product_peak_match_idx_min[peak_idx] = product_mz_idx_min
             product_peak_match_idx_max[peak_idx] = product_mz_idx_max
@@ -197,9 +200,10 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
                 ###############################################################
                 # Match the neutral loss ions
                 mz_nl = precursor_mz - mz
+                ms2_tolerance = all_ms2_tolerance[peak_idx]
                 # Determine the mz index range
-                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "left")
-                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "right")
+                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "left")
+                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "right")
 
                 # Calculate the entropy similarity for this matched peak
                 # modified_idx_nl = all_nl_spec_idx[neutral_loss_mz_idx_min:neutral_loss_mz_idx_max]
@@ -219,7 +223,10 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
                 modified_value_nl[duplicate_idx_in_nl] = 0
 
                 entropy_similarity[modified_idx_nl] += modified_value_nl
-            return entropy_similarity
+            entropy_similarity[:search_spectra_idx_min] = 0
+            if search_spectra_idx_max is not None:
+                entropy_similarity[search_spectra_idx_max:] = 0
+            return self._apply_search_mask(entropy_similarity, search_mask)
 
         elif target == "gpu":
             import cupy as cp
@@ -255,9 +262,10 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
                 ###############################################################
                 # Match the neutral loss ions
                 mz_nl = precursor_mz - mz
+                ms2_tolerance = all_ms2_tolerance[peak_idx]
                 # Determine the mz index range
-                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "left")
-                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance_in_da, all_nl_mass, all_nl_mass_idx_start, "right")
+                neutral_loss_mz_idx_min = self._find_location_from_array_with_index(mz_nl - ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "left")
+                neutral_loss_mz_idx_max = self._find_location_from_array_with_index(mz_nl + ms2_tolerance, all_nl_mass, all_nl_mass_idx_start, "right")
                 # print(product_mz_idx_max - product_mz_idx_min, neutral_loss_mz_idx_max - neutral_loss_mz_idx_min)
 
                 # Calculate the entropy similarity for this matched peak
@@ -291,7 +299,11 @@ class FlashEntropySearchCoreLowMemory(FlashEntropySearchCore):
             entropy_similarity = cp.zeros(self.total_spectra_num, dtype=np.float16)
             for modified_idx, modified_value in entropy_similarity_modification_list:
                 entropy_similarity.scatter_add(cp.array(modified_idx), cp.array(modified_value))
-            return entropy_similarity.get()
+            entropy_similarity = entropy_similarity.get()
+            entropy_similarity[:search_spectra_idx_min] = 0
+            if search_spectra_idx_max is not None:
+                entropy_similarity[search_spectra_idx_max:] = 0
+            return self._apply_search_mask(entropy_similarity, search_mask)
         else:
             raise ValueError("target should be cpu or gpu")
 
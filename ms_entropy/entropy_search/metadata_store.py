@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+import numpy as np
+import pickle
+from pathlib import Path
+
+# The comparison operators supported by `MetadataStore.select`.
+_OPERATORS = {
+    "==": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "in": np.isin,
+}
+# The arrays of each kind of column.
+_COLUMN_ARRAYS = {
+    "number": ("values",),
+    "string": ("codes", "dictionary", "dictionary_loc"),
+    "object": ("data", "data_loc"),
+}
+
+
+class MetadataStore:
+    def __init__(self, all_metadata=None):
+        """
+        A columnar store for the metadata of the spectra, one column for each key of the metadata.
+
+        The values of each column are stored in numpy arrays:
+
+            - Numbers and booleans are stored in a fixed-width column;
+
+            - Strings are stored as the codes to a sorted dictionary of the unique strings;
+
+            - Other values are stored as pickles, one for each spectrum.
+
+        The missing values are recorded in a boolean array for each column, the metadata of a spectrum only contains its own keys.
+
+        :param all_metadata:    A list of dictionaries, the metadata of each spectrum.
+        """
+        self.spectra_num = 0
+        # The name of the column to a dictionary of the kind of the column, the present array and the arrays of the column.
+        self.columns = {}
+        # The decoded dictionary of the string columns.
+        self._dictionary_cache = {}
+
+        if all_metadata is not None:
+            self.spectra_num = len(all_metadata)
+            all_column_values = {}
+            for spec_idx, metadata in enumerate(all_metadata):
+                for name, value in metadata.items():
+                    all_spec_idx, all_values = all_column_values.setdefault(name, ([], []))
+                    all_spec_idx.append(spec_idx)
+                    all_values.append(value)
+            for name, (all_spec_idx, all_values) in all_column_values.items():
+                self.columns[name] = _build_column(np.array(all_spec_idx, dtype=np.int64), all_values, self.spectra_num)
+
+    def __len__(self):
+        return self.spectra_num
+
+    def __getitem__(self, spec_idx):
+        """
+        Get the metadata of one spectrum.
+
+        :param spec_idx:    The index of the spectrum.
+        :return:    A dictionary of the metadata.
+        """
+        return self.get_metadata([spec_idx])[0]
+
+    def get_metadata(self, all_spec_idx):
+        """
+        Get the metadata of the spectra as dictionaries.
+
+        :param all_spec_idx:    The index of the spectra.
+        :return:    A list of dictionaries, the metadata of each spectrum.
+        """
+        all_spec_idx = np.asarray(all_spec_idx, dtype=np.int64)
+        all_metadata = [{} for _ in range(len(all_spec_idx))]
+        for name, values in self.gather(all_spec_idx).items():
+            is_present = self._get_present(name, all_spec_idx)
+            for metadata, value, present in zip(all_metadata, values.tolist(), is_present):
+                if present:
+                    metadata[name] = value
+        return all_metadata
+
+    def gather(self, all_spec_idx, columns=None):
+        """
+        Get the values of the columns for the spectra.
+
+        :param all_spec_idx:    The index of the spectra.
+        :param columns:     The name of the columns to get. Default is None, get all columns.
+        :return:    A dictionary of the name of the column to a numpy array of the values. The numbers are returned in a typed array,
+                    the other values are returned in an object array. When some values are missing, the array is an object array with None for
+                    the missing values.
+        """
+        all_spec_idx = np.asarray(all_spec_idx, dtype=np.int64)
+        if columns is None:
+            columns = list(self.columns)
+
+        result = {}
+        for name in columns:
+            column = self.columns[name]
+            if column["kind"] == "number":
+                values = np.asarray(column["values"][all_spec_idx])
+            elif column["kind"] == "string":
+                values = self._get_dictionary(name)[column["codes"][all_spec_idx]]
+            else:
+                data, data_loc = column["data"], column["data_loc"]
+                values = np.empty(len(all_spec_idx), dtype=object)
+                for i, spec_idx in enumerate(all_spec_idx):
+                    if data_loc[spec_idx + 1] > data_loc[spec_idx]:
+                        values[i] = pickle.loads(data[data_loc[spec_idx] : data_loc[spec_idx + 1]].tobytes())
+
+            is_present = self._get_present(name, all_spec_idx)
+            if not np.all(is_present):
+                values = values.astype(object)
+                values[~is_present] = None
+            result[name] = values
+        return result
+
+    def select(self, name, operator, value):
+        """
+        Select the spectra by the value of a column, the comparison is vectorized over all spectra.
+
+        For string columns, the value is compared with each unique string once, e.g. `select("ion_mode", "==", "P")`.
+
+        :param name:    The name of the column.
+        :param operator:    The comparison operator, can be "==", "!=", "<", "<=", ">", ">=", or "in".
+        :param value:   The value to compare with, a list of values for the "in" operator.
+        :return:    A boolean array with the length of the number of spectra. The spectra without this column are always False.
+        """
+        if operator not in _OPERATORS:
+            raise ValueError(f"The operator should be one of {list(_OPERATORS)}.")
+        if name not in self.columns:
+            return np.zeros(self.spectra_num, dtype=bool)
+
+        column = self.columns[name]
+        if column["kind"] == "number":
+            is_selected = _OPERATORS[operator](column["values"], value)
+        elif column["kind"] == "string":
+            # Compare the unique strings, then map the result to the spectra.
+            is_selected = np.asarray(_OPERATORS[operator](self._get_dictionary(name), value), dtype=bool)
+            if len(is_selected) > 0:
+                is_selected = is_selected[column["codes"]]
+            else:
+                is_selected = np.zeros(self.spectra_num, dtype=bool)
+        else:
+            is_selected = _OPERATORS[operator](self.gather(np.arange(self.spectra_num), [name])[name], value)
+        return np.logical_and(is_selected, self._get_present(name))
+
+    def take(self, all_spec_idx):
+        """
+        Create a new store with the metadata of the spectra.
+
+        :param all_spec_idx:    The index of the spectra, the spectra in the new store are in this order.
+        :return:    A new MetadataStore.
+        """
+        all_spec_idx = np.asarray(all_spec_idx, dtype=np.int64)
+        metadata_store = MetadataStore()
+        metadata_store.spectra_num = len(all_spec_idx)
+        metadata_store._dictionary_cache = dict(self._dictionary_cache)
+        for name, column in self.columns.items():
+            new_column = {"kind": column["kind"], "present": None if column["present"] is None else column["present"][all_spec_idx]}
+            if column["kind"] == "number":
+                new_column["values"] = column["values"][all_spec_idx]
+            elif column["kind"] == "string":
+                new_column["codes"] = column["codes"][all_spec_idx]
+                new_column["dictionary"] = column["dictionary"]
+                new_column["dictionary_loc"] = column["dictionary_loc"]
+            else:
+                new_column["data"], new_column["data_loc"] = _take_blob(column["data"], column["data_loc"], all_spec_idx)
+            metadata_store.columns[name] = new_column
+        return metadata_store
+
+    def insert(self, metadata_store, all_spec_idx):
+        """
+        Create a new store with the metadata of this store and the other store merged.
+
+        :param metadata_store:  The other MetadataStore.
+        :param all_spec_idx:    The index of the spectra of the other store in the merged store, the spectra of this store fill the rest in order.
+        :return:    A new MetadataStore.
+        """
+        all_spec_idx = np.asarray(all_spec_idx, dtype=np.int64)
+        total_spectra_num = self.spectra_num + metadata_store.spectra_num
+        is_old_spectrum = np.ones(total_spectra_num, dtype=bool)
+        is_old_spectrum[all_spec_idx] = False
+
+        # Concatenate the two stores, then reorder the spectra.
+        concatenated_store = MetadataStore()
+        concatenated_store.spectra_num = total_spectra_num
+        for name in list(self.columns) + [name for name in metadata_store.columns if name not in self.columns]:
+            concatenated_store.columns[name] = _concatenate_column(self, metadata_store, name)
+        order = np.empty(total_spectra_num, dtype=np.int64)
+        order[is_old_spectrum] = np.arange(self.spectra_num)
+        order[all_spec_idx] = np.arange(self.spectra_num, total_spectra_num)
+        return concatenated_store.take(order)
+
+    def write(self, path_data):
+        """
+        Write the metadata store to a directory.
+
+        :param path_data:   The path of the directory.
+        :return:    None
+        """
+        path_data = Path(path_data)
+        path_data.mkdir(parents=True, exist_ok=True)
+        all_column_info = []
+        for column_idx, (name, column) in enumerate(self.columns.items()):
+            all_array_names = _COLUMN_ARRAYS[column["kind"]] + (() if column["present"] is None else ("present",))
+            all_column_info.append((name, column["kind"], {array_name: column[array_name].dtype.str for array_name in all_array_names}))
+            for array_name in all_array_names:
+                np.asarray(column[array_name]).tofile(str(path_data / f"{column_idx}_{array_name}.npy"))
+        with open(path_data / "columns.pkl", "wb") as f:
+            pickle.dump((self.spectra_num, all_column_info), f)
+
+    def read(self, path_data, use_memmap=False):
+        """
+        Read the metadata store from a directory.
+
+        :param path_data:   The path of the directory.
+        :param use_memmap:  If True, the arrays will be memory-mapped instead of loaded into memory.
+        :return:    None
+        """
+        path_data = Path(path_data)
+        with open(path_data / "columns.pkl", "rb") as f:
+            self.spectra_num, all_column_info = pickle.load(f)
+        self.columns = {}
+        self._dictionary_cache = {}
+        for column_idx, (name, kind, all_array_dtypes) in enumerate(all_column_info):
+            column = {"kind": kind, "present": None}
+            for array_name, dtype in all_array_dtypes.items():
+                column[array_name] = _read_array(path_data / f"{column_idx}_{array_name}.npy", np.dtype(dtype), use_memmap)
+            self.columns[name] = column
+
+    def _get_present(self, name, all_spec_idx=None):
+        present = self.columns[name]["present"]
+        if present is None:
+            return np.ones(self.spectra_num if all_spec_idx is None else len(all_spec_idx), dtype=bool)
+        return np.asarray(present if all_spec_idx is None else present[all_spec_idx])
+
+    def _get_dictionary(self, name):
+        if name not in self._dictionary_cache:
+            column = self.columns[name]
+            self._dictionary_cache[name] = _decode_strings(column["dictionary"], column["dictionary_loc"])
+        return self._dictionary_cache[name]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_dictionary_cache"] = {}
+        return state
+
+
+def _build_column(all_spec_idx, all_values, spectra_num):
+    """
+    Build a column from the values of the spectra which have this column.
+    """
+    column = {"present": None}
+    if len(all_spec_idx) < spectra_num:
+        column["present"] = np.zeros(spectra_num, dtype=bool)
+        column["present"][all_spec_idx] = True
+
+    if all(isinstance(value, str) for value in all_values):
+        dictionary, codes = np.unique(np.array(all_values, dtype=object), return_inverse=True)
+        column["kind"] = "string"
+        column["codes"] = np.zeros(spectra_num, dtype=np.uint32)
+        column["codes"][all_spec_idx] = codes.ravel()
+        column["dictionary"], column["dictionary_loc"] = _encode_strings(dictionary)
+        return column
+
+    is_bool = [isinstance(value, (bool, np.bool_)) for value in all_values]
+    if all(isinstance(value, (bool, int, float, np.bool_, np.integer, np.floating)) for value in all_values) and (all(is_bool) or not any(is_bool)):
+        values = np.array(all_values)
+        if values.dtype.kind in "biuf":
+            column["kind"] = "number"
+            column["values"] = np.zeros(spectra_num, dtype=values.dtype)
+            column["values"][all_spec_idx] = values
+            return column
+
+    # Fall back to pickle the values one by one.
+    column["kind"] = "object"
+    column["data"], column["data_loc"] = _encode_objects(all_spec_idx, all_values, spectra_num)
+    return column
+
+
+def _concatenate_column(metadata_store_1, metadata_store_2, name):
+    """
+    Concatenate the column of two stores, the column is missing for the spectra of the store without this column.
+    """
+    all_columns = [metadata_store.columns.get(name) for metadata_store in (metadata_store_1, metadata_store_2)]
+    all_kinds = {column["kind"] for column in all_columns if column is not None}
+    if "number" in all_kinds:
+        all_dtypes = [column["values"].dtype for column in all_columns if column is not None]
+        if len(all_kinds) == 1 and len({dtype.kind == "b" for dtype in all_dtypes}) == 1:
+            dtype = np.result_type(*all_dtypes)
+        else:
+            all_kinds = {"object"}
+
+    all_metadata_stores = (metadata_store_1, metadata_store_2)
+    present = np.concatenate(
+        [
+            metadata_store._get_present(name) if column is not None else np.zeros(metadata_store.spectra_num, dtype=bool)
+            for metadata_store, column in zip(all_metadata_stores, all_columns)
+        ]
+    )
+    new_column = {"present": None if np.all(present) else present}
+    if all_kinds == {"number"}:
+        new_column["kind"] = "number"
+        new_column["values"] = np.concatenate(
+            [
+                column["values"] if column is not None else np.zeros(metadata_store.spectra_num, dtype=dtype)
+                for metadata_store, column in zip(all_metadata_stores, all_columns)
+            ]
+        ).astype(dtype, copy=False)
+    elif all_kinds == {"string"}:
+        # Merge the dictionaries, and remap the codes to the merged dictionary.
+        all_dictionaries = [
+            metadata_store._get_dictionary(name) if column is not None else np.zeros(0, dtype=object)
+            for metadata_store, column in zip(all_metadata_stores, all_columns)
+        ]
+        dictionary = np.unique(np.concatenate(all_dictionaries))
+        all_codes = []
+        for metadata_store, column, old_dictionary in zip(all_metadata_stores, all_columns, all_dictionaries):
+            if column is None or len(old_dictionary) == 0:
+                all_codes.append(np.zeros(metadata_store.spectra_num, dtype=np.uint32))
+            else:
+                all_codes.append(np.searchsorted(dictionary, old_dictionary).astype(np.uint32)[column["codes"]])
+        new_column["kind"] = "string"
+        new_column["codes"] = np.concatenate(all_codes)
+        new_column["dictionary"], new_column["dictionary_loc"] = _encode_strings(dictionary)
+    else:
+        all_values = []
+        for metadata_store in all_metadata_stores:
+            if name in metadata_store.columns:
+                all_values.extend(metadata_store.gather(np.arange(metadata_store.spectra_num), [name])[name].tolist())
+            else:
+                all_values.extend([None] * metadata_store.spectra_num)
+        all_spec_idx = np.flatnonzero(present)
+        new_column["kind"] = "object"
+        new_column["data"], new_column["data_loc"] = _encode_objects(all_spec_idx, [all_values[i] for i in all_spec_idx], len(present))
+    return new_column
+
+
+def _encode_strings(all_strings):
+    all_encoded = [string.encode() for string in all_strings]
+    data_loc = np.zeros(len(all_encoded) + 1, dtype=np.uint64)
+    data_loc[1:] = np.cumsum([len(encoded) for encoded in all_encoded])
+    return np.frombuffer(b"".join(all_encoded), dtype=np.uint8).copy(), data_loc
+
+
+def _decode_strings(data, data_loc):
+    data = np.asarray(data).tobytes()
+    all_strings = np.empty(len(data_loc) - 1, dtype=object)
+    for i in range(len(all_strings)):
+        all_strings[i] = data[data_loc[i] : data_loc[i + 1]].decode()
+    return all_strings
+
+
+def _encode_objects(all_spec_idx, all_values, spectra_num):
+    all_data_len = np.zeros(spectra_num, dtype=np.uint64)
+    all_data = [pickle.dumps(value) for value in all_values]
+    all_data_len[all_spec_idx] = [len(data) for data in all_data]
+    data_loc = np.zeros(spectra_num + 1, dtype=np.uint64)
+    data_loc[1:] = np.cumsum(all_data_len)
+    return np.frombuffer(b"".join(all_data), dtype=np.uint8).copy(), data_loc
+
+
+def _take_blob(data, data_loc, all_spec_idx):
+    """
+    Gather the variable-length items of the spectra from a blob, the items are located by data_loc.
+    """
+    data_loc = np.asarray(data_loc, dtype=np.int64)
+    all_data_start = data_loc[all_spec_idx]
+    all_data_len = data_loc[all_spec_idx + 1] - all_data_start
+    new_data_loc = np.zeros(len(all_spec_idx) + 1, dtype=np.int64)
+    new_data_loc[1:] = np.cumsum(all_data_len)
+    data_idx = np.arange(new_data_loc[-1], dtype=np.int64) + np.repeat(all_data_start - new_data_loc[:-1], all_data_len)
+    return np.asarray(data)[data_idx], new_data_loc.astype(np.uint64)
+
+
+def _read_array(path_array, dtype, use_memmap):
+    if use_memmap and path_array.stat().st_size > 0:
+        return np.memmap(path_array, dtype=dtype, mode="r")
+    return np.fromfile(str(path_array), dtype=dtype)
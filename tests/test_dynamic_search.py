@@ -1,7 +1,20 @@
+import json
 import numpy as np
 import unittest
 import tempfile
-from ms_entropy import FlashEntropySearchCoreForDynamicIndexing, clean_spectrum
+from ms_entropy import FlashEntropySearchCoreForDynamicIndexing, DynamicEntropySearch, DynamicEntropySearchCore, clean_spectrum
+
+
+def _generate_random_spectral_library(spectra_num, seed=0, peaks_num=10, precursor_mz_range=(150, 300), mz_range=(50, 150)):
+    # The fragment ions are below the precursor m/z when mz_range is None.
+    random_state = np.random.RandomState(seed)
+    spectral_library = []
+    for i in range(spectra_num):
+        precursor_mz = random_state.uniform(*precursor_mz_range)
+        mz_min, mz_max = (50, precursor_mz - 2) if mz_range is None else mz_range
+        peaks = np.stack([random_state.uniform(mz_min, mz_max, peaks_num), random_state.uniform(0.1, 1, peaks_num)], axis=1).astype(np.float32)
+        spectral_library.append({"id": f"Spectrum {i}", "precursor_mz": precursor_mz, "peaks": peaks})
+    return spectral_library
 
 
 class TestFlashEntropySearchWithCpu(unittest.TestCase):
@@ -87,6 +100,256 @@ class TestFlashEntropySearchWithCpu(unittest.TestCase):
         matched_peaks[np.abs(library_precursor_mz - self.query_spectrum["precursor_mz"]) > 0.01] = 0
         np.testing.assert_almost_equal(similarity, [1.0, 0.0, 0.0, 0.0], decimal=5)
         np.testing.assert_almost_equal(matched_peaks, [4, 0, 0, 0], decimal=5)
+        # Only score the spectra with a matched precursor m/z.
+        spectra_mask = np.abs(library_precursor_mz - self.query_spectrum["precursor_mz"]) <= 0.01
+        similarity = self.flash_entropy.search(method="open", peaks=self.query_spectrum["peaks"], ms2_tolerance_in_da=0.02, spectra_mask=spectra_mask)
+        np.testing.assert_almost_equal(similarity, [1.0, 0.0, 0.0, 0.0], decimal=5)
+        for score_partition_size in [0, 2]:
+            self.flash_entropy.score_partition_size = score_partition_size
+            similarity, matched_peaks = self.flash_entropy.search(
+                method="open", peaks=self.query_spectrum["peaks"], ms2_tolerance_in_da=0.02, output_matched_peak_number=True, spectra_mask=spectra_mask
+            )
+            np.testing.assert_almost_equal(similarity, [1.0, 0.0, 0.0, 0.0], decimal=5)
+            np.testing.assert_array_equal(matched_peaks, [4, 0, 0, 0])
+        with self.assertRaises(AssertionError):
+            self.flash_entropy.search(method="open", peaks=self.query_spectrum["peaks"], ms2_tolerance_in_da=0.02, spectra_mask=spectra_mask[:2])
+
+    def test_open_search_with_partitioned_scoring(self):
+        similarity = self.flash_entropy.search(peaks=self.query_spectrum["peaks"], method="open", ms2_tolerance_in_da=0.02)
+        self.flash_entropy.score_partition_size = 2
+        similarity_partitioned = self.flash_entropy.search(peaks=self.query_spectrum["peaks"], method="open", ms2_tolerance_in_da=0.02)
+        np.testing.assert_array_equal(similarity_partitioned, similarity)
+
+
+    def test_search_with_ppm_tolerance(self):
+        # 200 ppm is 0.02 Da at m/z 100.
+        similarity = self.flash_entropy.search(peaks=self.query_spectrum["peaks"], method="open", ms2_tolerance_in_ppm=200)
+        np.testing.assert_almost_equal(similarity, [1.0, 0.22299, 0.22299, 0.44598], decimal=5)
+        similarity = self.flash_entropy.search_hybrid(
+            precursor_mz=self.query_spectrum["precursor_mz"], peaks=self.query_spectrum["peaks"], ms2_tolerance_in_ppm=200
+        )
+        np.testing.assert_almost_equal(similarity, [1.0, 0.22299, 0.66897, 0.66897], decimal=5)
+        with self.assertRaises(AssertionError):
+            self.flash_entropy.search(peaks=self.query_spectrum["peaks"], method="open", ms2_tolerance_in_ppm=300)
+
+
+class TestDynamicEntropySearchCore(unittest.TestCase):
+    def test_search_unsorted_and_sorted_blocks(self):
+        all_spectra = _generate_random_spectral_library(60, seed=3, peaks_num=20)
+        for spectrum in all_spectra:
+            spectrum["peaks"] = clean_spectrum(peaks=spectrum["peaks"], max_mz=spectrum["precursor_mz"] - 1.6, min_ms2_difference_in_da=0.05)
+        query = all_spectra[7]
+        entropy_search = DynamicEntropySearchCore(path_data=tempfile.mkdtemp(), mass_per_block=1)
+        entropy_search.build_index(all_spectra[:20])
+        sorted_len = entropy_search.index[0]["data_len"].copy()
+        # The spectra inserted by fast update are appended to the blocks unsorted, after the sorted part.
+        entropy_search.fast_add_new_spectrum_into_index(all_spectra[20:40])
+        entropy_search.fast_add_new_spectrum_into_index(all_spectra[40:])
+        np.testing.assert_array_equal(entropy_search.index[0]["sorted_len"], sorted_len)
+        self.assertTrue(np.any(entropy_search.index[0]["sorted_len"] < entropy_search.index[0]["data_len"]))
+
+        def search_all_methods():
+            return [
+                entropy_search.search(method="open", peaks=query["peaks"], ms2_tolerance_in_da=0.02),
+                entropy_search.search(method="neutral_loss", precursor_mz=query["precursor_mz"], peaks=query["peaks"], ms2_tolerance_in_da=0.02),
+                entropy_search.search_hybrid(precursor_mz=query["precursor_mz"], peaks=query["peaks"], ms2_tolerance_in_da=0.02),
+            ]
+
+        similarity_unsorted = search_all_methods()
+        entropy_search.score_partition_size = 4
+        np.testing.assert_array_equal(search_all_methods()[0], similarity_unsorted[0])
+        entropy_search.score_partition_size = 0
+        self.assertAlmostEqual(similarity_unsorted[0][7], 1.0, places=5)
+        spectra_mask = np.arange(60) % 2 == 1
+        similarity_masked = entropy_search.search(method="open", peaks=query["peaks"], ms2_tolerance_in_da=0.02, spectra_mask=spectra_mask)
+        np.testing.assert_array_equal(similarity_masked[~spectra_mask], 0)
+        np.testing.assert_almost_equal(similarity_masked[spectra_mask], similarity_unsorted[0][spectra_mask], decimal=5)
+        with self.assertRaises(AssertionError):
+            entropy_search.search(method="open", peaks=query["peaks"], ms2_tolerance_in_da=0.02, spectra_mask=spectra_mask[:20])
+
+        entropy_search.write()
+        entropy_search.convert_to_fast_search()
+        np.testing.assert_array_equal(entropy_search.index[0]["sorted_len"], entropy_search.index[0]["data_len"])
+        for similarity, similarity_expected in zip(search_all_methods(), similarity_unsorted):
+            np.testing.assert_almost_equal(similarity, similarity_expected, decimal=5)
+
+    def test_merge_unsorted_part(self):
+        all_spectra = _generate_random_spectral_library(60, seed=4, peaks_num=20)
+        for spectrum in all_spectra:
+            spectrum["peaks"] = clean_spectrum(peaks=spectrum["peaks"], max_mz=spectrum["precursor_mz"] - 1.6, min_ms2_difference_in_da=0.05)
+        query = all_spectra[45]
+        entropy_search = DynamicEntropySearchCore(path_data=tempfile.mkdtemp(), mass_per_block=1)
+        entropy_search.build_index(all_spectra[:20])
+        entropy_search.fast_add_new_spectrum_into_index(all_spectra[20:40])
+        all_data_len = [block_info["data_len"].copy() for block_info in entropy_search.index]
+        # The unsorted part of the blocks with new peaks is merged into the sorted part when spectra are added with sorting.
+        entropy_search.add_new_spectrum_into_index(all_spectra[40:])
+        for block_info, data_len in zip(entropy_search.index, all_data_len):
+            is_added = block_info["data_len"] > data_len
+            self.assertTrue(np.any(is_added))
+            np.testing.assert_array_equal(block_info["sorted_len"][is_added], block_info["data_len"][is_added])
+        entropy_search_expected = DynamicEntropySearchCore(path_data=tempfile.mkdtemp(), mass_per_block=1)
+        entropy_search_expected.build_index(all_spectra)
+        similarity, similarity_expected = [
+            search.search_hybrid(precursor_mz=query["precursor_mz"], peaks=query["peaks"], ms2_tolerance_in_da=0.02)
+            for search in [entropy_search, entropy_search_expected]
+        ]
+        np.testing.assert_almost_equal(similarity, similarity_expected, decimal=5)
+        self.assertAlmostEqual(similarity[45], 1.0, places=5)
+
+        # The index written before the length of the sorted part was tracked only has a flag for whether the block is sorted.
+        entropy_search.fast_add_new_spectrum_into_index(all_spectra[:10])
+        entropy_search.write()
+        block_info = entropy_search.index[0]
+        block_info_with_sorted_flag = np.empty(len(block_info), dtype=[("start_idx", np.uint64), ("data_len", np.uint32), ("reserved_len", np.uint32), ("is_sorted", bool)])
+        for name in ["start_idx", "data_len", "reserved_len"]:
+            block_info_with_sorted_flag[name] = block_info[name]
+        block_info_with_sorted_flag["is_sorted"] = block_info["sorted_len"] == block_info["data_len"]
+        block_info_with_sorted_flag.tofile(entropy_search.path_data / "block_ions_info.bin")
+        with open(entropy_search.path_data / "information_dynamic.json", "r") as f:
+            information = json.load(f)
+        del information["sorted_len_indexed"]
+        with open(entropy_search.path_data / "information_dynamic.json", "w") as f:
+            json.dump(information, f)
+        self.assertTrue(entropy_search.read())
+        np.testing.assert_array_equal(entropy_search.index[0]["data_len"], block_info["data_len"])
+        np.testing.assert_array_equal(entropy_search.index[0]["sorted_len"], np.where(block_info["sorted_len"] == block_info["data_len"], block_info["data_len"], 0))
+
+
+class TestDynamicEntropySearch(unittest.TestCase):
+    def test_search_after_adding_spectra(self):
+        all_spectra = _generate_random_spectral_library(30, seed=0, mz_range=None)
+        query = all_spectra[3]
+        path_test = tempfile.mkdtemp()
+        entropy_search = DynamicEntropySearch(path_data=path_test, num_per_group=40, cache_list_threshold=10)
+        for i in range(0, 20, 10):
+            entropy_search.add_new_spectra(spectra_list=all_spectra[i : i + 10])
+        entropy_search.build_index()
+        entropy_search.write()
+        similarity = entropy_search.search(precursor_mz=query["precursor_mz"], peaks=query["peaks"])
+        self.assertEqual(len(similarity["open_search"]), 20)
+
+        # The opened groups are reused by the following searches.
+        group_path = entropy_search.path_data / "0"
+        self.assertIs(entropy_search._assign_entropy_search(group_path), entropy_search._assign_entropy_search(group_path))
+
+        # And reopened after the spectra are inserted into the group.
+        entropy_search.add_new_spectra(spectra_list=all_spectra[20:])
+        entropy_search.build_index()
+        entropy_search.write()
+        similarity = entropy_search.search(precursor_mz=query["precursor_mz"], peaks=query["peaks"])
+        similarity_expected = DynamicEntropySearch(path_data=path_test).search(precursor_mz=query["precursor_mz"], peaks=query["peaks"])
+        for method in ["identity_search", "open_search", "neutral_loss_search", "hybrid_search"]:
+            self.assertEqual(len(similarity[method]), 30)
+            np.testing.assert_array_equal(similarity[method], similarity_expected[method])
+        self.assertAlmostEqual(similarity["identity_search"][3], 1.0, places=5)
+        # The identity search only scores the spectra with a matched precursor m/z.
+        library_precursor_mz = np.array([x["precursor_mz"] for x in all_spectra], dtype=np.float32)
+        similarity_expected = np.where(np.abs(library_precursor_mz - query["precursor_mz"]) <= 0.01, similarity["open_search"], 0)
+        np.testing.assert_almost_equal(similarity["identity_search"], similarity_expected, decimal=5)
+
+        # The precursor m/z of the spectra added in three batches are merged into one sorted run.
+        precursor_mz_sorted = np.fromfile(group_path / "precursor_mz_sorted.bin", dtype=np.float32)
+        precursor_mz_order = np.fromfile(group_path / "precursor_mz_order.bin", dtype=np.uint32)
+        np.testing.assert_array_equal(precursor_mz_sorted, np.sort(library_precursor_mz))
+        np.testing.assert_array_equal(library_precursor_mz[precursor_mz_order], precursor_mz_sorted)
+        peaks = clean_spectrum(peaks=query["peaks"], max_mz=query["precursor_mz"] - 1.6, min_ms2_difference_in_da=0.05)
+        similarity = entropy_search.identity_search(precursor_mz=query["precursor_mz"], peaks=peaks, ms1_tolerance_in_da=20, ms2_tolerance_in_da=0.02)
+        similarity_open = entropy_search.open_search(peaks=peaks, ms2_tolerance_in_da=0.02)
+        is_matched = np.abs(library_precursor_mz - query["precursor_mz"]) <= 20
+        self.assertGreater(np.count_nonzero(is_matched), 1)
+        similarity_expected = np.where(is_matched, similarity_open, 0)
+        np.testing.assert_almost_equal(similarity, similarity_expected, decimal=5)
+
+    def test_search_groups_in_parallel(self):
+        all_spectra = _generate_random_spectral_library(30, seed=1)
+        query = all_spectra[5]
+        entropy_search = DynamicEntropySearch(path_data=tempfile.mkdtemp(), num_per_group=8, cache_list_threshold=8)
+        entropy_search.add_new_spectra(spectra_list=all_spectra)
+        entropy_search.build_index()
+        entropy_search.write()
+        self.assertGreater(len(entropy_search.group_start), 2)
+
+        similarity = entropy_search.search(precursor_mz=query["precursor_mz"], peaks=query["peaks"])
+        similarity_parallel = entropy_search.search(precursor_mz=query["precursor_mz"], peaks=query["peaks"], n_jobs=3)
+        for method in ["identity_search", "open_search", "neutral_loss_search", "hybrid_search"]:
+            self.assertEqual(len(similarity[method]), 30)
+            np.testing.assert_array_equal(similarity_parallel[method], similarity[method])
+
+        # The topn matches merged from the groups are the topn of the whole library.
+        for method in ["open", "hybrid"]:
+            for n_jobs in [1, 3]:
+                result = entropy_search.search_topn_matches(
+                    precursor_mz=query["precursor_mz"], peaks=query["peaks"], method=method, topn=5, need_metadata=False, n_jobs=n_jobs
+                )
+                similarity_all = similarity[f"{method}_search"]
+                self.assertEqual(len(result), min(5, np.count_nonzero(similarity_all >= 0.1)))
+                np.testing.assert_array_equal([x[1] for x in result], np.sort(similarity_all)[::-1][: len(result)])
+                np.testing.assert_array_equal(similarity_all[[int(x[0]) for x in result]], [x[1] for x in result])
+        result = entropy_search.search_topn_matches(precursor_mz=query["precursor_mz"], peaks=query["peaks"], method="identity", topn=3)
+        self.assertEqual(result[0]["id"], "Spectrum 5")
+
+    def test_skip_groups_by_similarity_upper_bound(self):
+        all_spectra = _generate_random_spectral_library(40, seed=2, precursor_mz_range=(700, 800), mz_range=(0, 200))
+        for i, spectrum in enumerate(all_spectra):
+            # The spectra of the first groups have low m/z fragment ions, and the others have high m/z fragment ions.
+            spectrum["peaks"][:, 0] += 50 if i < 16 else 400
+        entropy_search = DynamicEntropySearch(path_data=tempfile.mkdtemp(), num_per_group=8, cache_list_threshold=8)
+        entropy_search.add_new_spectra(spectra_list=all_spectra)
+        entropy_search.build_index()
+        entropy_search.write()
+        group_num = len(entropy_search.group_start)
+        self.assertGreater(group_num, 3)
+
+        # The bound of a group is not lower than the similarity of any spectrum in it.
+        for query in all_spectra[3], all_spectra[30]:
+            peaks = clean_spectrum(peaks=query["peaks"], max_mz=query["precursor_mz"] - 1.6, min_ms2_difference_in_da=0.05)
+            similarity = entropy_search.search(precursor_mz=query["precursor_mz"], peaks=query["peaks"])
+            group_end = entropy_search.group_start[1:] + [len(similarity["open_search"])]
+            for method in ["identity", "open", "neutral_loss", "hybrid"]:
+                all_bound = entropy_search._get_similarity_upper_bound(method=method, precursor_mz=query["precursor_mz"], peaks=peaks, ms2_tolerance_in_da=0.02)
+                for group in range(group_num):
+                    similarity_group = similarity[f"{method}_search"][entropy_search.group_start[group] : group_end[group]]
+                    self.assertGreaterEqual(all_bound[group], np.max(similarity_group))
+
+        # The groups of high m/z fragment ions are not searched for a query of low m/z fragment ions, and the result is the same.
+        all_searched_group = []
+        search_group = entropy_search._search_group
+        entropy_search._search_group = lambda group, **kwargs: all_searched_group.append(group) or search_group(group, **kwargs)
+        query = all_spectra[3]
+        similarity = entropy_search.search(precursor_mz=query["precursor_mz"], peaks=query["peaks"], method="open")["open_search"]
+        for n_jobs in [1, 2]:
+            all_searched_group.clear()
+            result = entropy_search.search_topn_matches(
+                precursor_mz=query["precursor_mz"], peaks=query["peaks"], method="open", topn=3, need_metadata=False, n_jobs=n_jobs
+            )
+            self.assertLess(len(all_searched_group), group_num)
+            expected_idx = [idx for idx in np.argsort(-similarity, kind="stable")[:3] if similarity[idx] >= 0.1]
+            self.assertEqual([int(x[0]) for x in result], expected_idx)
+
+    def test_group_written_without_max_intensity(self):
+        all_spectra = _generate_random_spectral_library(13, seed=5, mz_range=None)
+        path_test = tempfile.mkdtemp()
+        entropy_search = DynamicEntropySearch(path_data=path_test, num_per_group=40, cache_list_threshold=10)
+        entropy_search.add_new_spectra(spectra_list=all_spectra[:10])
+        entropy_search.build_index()
+        entropy_search.write()
+        group_path = entropy_search.path_data / "0"
+        for name in ["max_intensity_ions.bin", "max_intensity_nl.bin"]:
+            (group_path / name).unlink()
+
+        # The files are not created from the new spectra only, so the similarity of the group is not bounded.
+        entropy_search = DynamicEntropySearch(path_data=path_test, num_per_group=40, cache_list_threshold=10)
+        entropy_search.add_new_spectra(spectra_list=all_spectra[10:])
+        entropy_search.build_index()
+        entropy_search.write()
+        self.assertFalse((group_path / "max_intensity_ions.bin").exists())
+        query = all_spectra[0]
+        peaks = clean_spectrum(peaks=query["peaks"], max_mz=query["precursor_mz"] - 1.6, min_ms2_difference_in_da=0.05)
+        self.assertEqual(entropy_search._get_similarity_upper_bound(method="open", peaks=peaks, ms2_tolerance_in_da=0.02), [np.inf])
+        result = entropy_search.search_topn_matches(precursor_mz=query["precursor_mz"], peaks=query["peaks"], method="open", topn=1, need_metadata=False)
+        self.assertEqual(int(result[0][0]), 0)
+        self.assertAlmostEqual(result[0][1], 1.0, places=5)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,11 @@
 import numpy as np
 import unittest
 import tempfile
-from ms_entropy import FlashEntropySearch
+import weakref
+from pathlib import Path
+from unittest import mock
+from ms_entropy import FlashEntropySearch, FlashEntropySearchCore, MetadataStore, MinHashCandidateIndex, calculate_entropy_similarity
+from ms_entropy.entropy_search.flash_entropy_search_core import _radix_sort_peak_data, _generate_idx_start
 
 
 class TestFlashEntropySearchWithCpu(unittest.TestCase):
@@ -187,6 +191,469 @@ class TestFlashEntropySearchWithCpuMediumMemory(TestFlashEntropySearchWithCpu):
         pass
 
 
+def _generate_random_spectral_library(spectra_num, seed=0):
+    random_state = np.random.RandomState(seed)
+    spectral_library = []
+    for i in range(spectra_num):
+        peaks_num = random_state.randint(1, 30)
+        precursor_mz = float(np.round(random_state.uniform(100, 1000), 2))
+        peaks = np.stack([np.round(random_state.uniform(50, precursor_mz, peaks_num), 2), random_state.uniform(0, 1, peaks_num)], axis=1)
+        spectral_library.append({"id": f"Random spectrum {i}", "precursor_mz": precursor_mz, "peaks": peaks.astype(np.float32)})
+    return spectral_library
+
+
+class TestFlashEntropySearchBuildIndex(unittest.TestCase):
+    def setUp(self):
+        self.spectral_library = _generate_random_spectral_library(300)
+        self.flash_entropy = FlashEntropySearch()
+        self.all_spectra_list = self.flash_entropy.build_index([dict(spec) for spec in self.spectral_library])
+
+    def assert_index_equal(self, flash_entropy):
+        np.testing.assert_array_equal(flash_entropy.precursor_mz_array, self.flash_entropy.precursor_mz_array)
+        all_spec_idx = np.arange(len(self.flash_entropy.precursor_mz_array))
+        self.assertEqual(flash_entropy.metadata.get_metadata(all_spec_idx), self.flash_entropy.metadata.get_metadata(all_spec_idx))
+        self.assertEqual(len(flash_entropy.entropy_search.index), len(self.flash_entropy.entropy_search.index))
+        for array, array_expected in zip(flash_entropy.entropy_search.index, self.flash_entropy.entropy_search.index):
+            np.testing.assert_array_equal(array, array_expected)
+
+    def test_build_index_with_multiple_jobs(self):
+        flash_entropy = FlashEntropySearch()
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library], n_jobs=3)
+        self.assert_index_equal(flash_entropy)
+
+    def test_build_index_with_append(self):
+        flash_entropy = FlashEntropySearch()
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library[:250]])
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library[250:280]], append=True)
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library[280:]], append=True)
+        self.assert_index_equal(flash_entropy)
+
+    def test_build_index_with_low_memory(self):
+        for low_memory in [1, 2]:
+            with tempfile.TemporaryDirectory() as path_data:
+                flash_entropy = FlashEntropySearch(path_data=path_data, low_memory=low_memory)
+                # The memory maps of the temporary files should be closed before the files are replaced, which is required on Windows.
+                all_index_array = []
+                allocate_index_array = flash_entropy.entropy_search._allocate_index_array
+                path_replace = Path.replace
+
+                def allocate(name, length):
+                    index_array = allocate_index_array(name, length)
+                    all_index_array.append(weakref.ref(index_array))
+                    return index_array
+
+                def replace(path, target):
+                    self.assertTrue(all(index_array() is None for index_array in all_index_array))
+                    return path_replace(path, target)
+
+                flash_entropy.entropy_search._allocate_index_array = allocate
+                with mock.patch.object(Path, "replace", replace):
+                    flash_entropy.build_index([dict(spec) for spec in self.spectral_library[:250]])
+                    flash_entropy.build_index([dict(spec) for spec in self.spectral_library[250:]], append=True)
+                    self.assert_index_equal(flash_entropy)
+                    flash_entropy.delete_spectra([3, 260], max_deleted_fraction=None)
+                    flash_entropy.compact()
+                self.assertEqual(len(all_index_array), 27)
+                self.assertEqual(flash_entropy.entropy_search.total_spectra_num, 298)
+                del flash_entropy
+
+    def test_build_index_with_fragment_order(self):
+        flash_entropy = FlashEntropySearch()
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library[:250]], spectra_order="fragment")
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library[250:]], append=True)
+        flash_entropy.delete_spectra([3, 260], max_deleted_fraction=None)
+        flash_entropy.compact()
+        with tempfile.TemporaryDirectory() as path_data:
+            flash_entropy.write(path_data)
+            flash_entropy = FlashEntropySearch()
+            flash_entropy.read(path_data)
+        np.testing.assert_array_equal(np.diff(flash_entropy.precursor_mz_array[flash_entropy.precursor_order]) >= 0, True)
+
+        # The same spectra are found as the library ordered by the precursor m/z.
+        all_id = flash_entropy.metadata.gather(np.arange(298), ["id"])["id"].tolist()
+        self.flash_entropy.delete_spectra([i for i, spec in enumerate(self.all_spectra_list) if spec["id"] not in all_id], max_deleted_fraction=None)
+        self.flash_entropy.compact()
+        spec_idx_in_precursor_order = [self.flash_entropy.metadata.gather(np.arange(298), ["id"])["id"].tolist().index(id) for id in all_id]
+        for spectrum in self.all_spectra_list[:20]:
+            result = flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], ms1_tolerance_in_da=5)
+            result_expected = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], ms1_tolerance_in_da=5)
+            for method in ["identity", "open", "neutral_loss", "hybrid"]:
+                np.testing.assert_array_almost_equal(result[f"{method}_search"], result_expected[f"{method}_search"][spec_idx_in_precursor_order])
+
+    def test_build_index_with_packed_postings(self):
+        flash_entropy = FlashEntropySearch()
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library[:250]], posting_layout="packed")
+        flash_entropy.build_index([dict(spec) for spec in self.spectral_library[250:]], append=True)
+        self.assertIs(flash_entropy.entropy_search.index[2].base, flash_entropy.entropy_search.index[3].base)
+        self.assert_index_equal(flash_entropy)
+
+        flash_entropy.delete_spectra([3, 260], max_deleted_fraction=None)
+        self.flash_entropy.delete_spectra([3, 260], max_deleted_fraction=None)
+        for spectrum in self.all_spectra_list[:10]:
+            result = flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"])
+            result_expected = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"])
+            for method in ["identity", "open", "neutral_loss", "hybrid"]:
+                np.testing.assert_array_equal(result[f"{method}_search"], result_expected[f"{method}_search"])
+
+        # The layout is kept after compaction, writing and reading, and can be changed.
+        flash_entropy.compact()
+        self.flash_entropy.compact()
+        with tempfile.TemporaryDirectory() as path_data:
+            flash_entropy.write(path_data)
+            flash_entropy = FlashEntropySearch()
+            flash_entropy.read(path_data)
+        self.assertEqual(flash_entropy.entropy_search.posting_layout, "packed")
+        self.assert_index_equal(flash_entropy)
+        flash_entropy.entropy_search.set_posting_layout("separate")
+        self.assertIsNone(flash_entropy.entropy_search.index[2].base)
+        self.assert_index_equal(flash_entropy)
+
+    def test_build_index_with_packed_postings_in_low_memory(self):
+        # The memory-mapped index keeps the postings in separate arrays.
+        for low_memory in [1, 2]:
+            with tempfile.TemporaryDirectory() as path_data:
+                flash_entropy = FlashEntropySearch(path_data=path_data, low_memory=low_memory)
+                flash_entropy.build_index([dict(spec) for spec in self.spectral_library], posting_layout="packed")
+                flash_entropy.entropy_search.set_posting_layout("packed")
+                self.assertEqual(flash_entropy.entropy_search.posting_layout, "separate")
+                self.assertIsInstance(flash_entropy.entropy_search.index[2], np.memmap)
+                flash_entropy.save_memory_for_multiprocessing()
+                self.assert_index_equal(flash_entropy)
+                spectrum = self.all_spectra_list[5]
+                result = flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"])
+                result_expected = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"])
+                for method in ["identity", "open", "neutral_loss", "hybrid"]:
+                    np.testing.assert_array_almost_equal(result[f"{method}_search"], result_expected[f"{method}_search"])
+                del flash_entropy
+
+    def test_delete_spectra(self):
+        all_deleted_idx = [0, 5, 6, 100, 299]
+        spectrum = self.all_spectra_list[5]
+        self.assertFalse(self.flash_entropy.delete_spectra(all_deleted_idx, max_deleted_fraction=None))
+        for method in ["identity", "open", "neutral_loss", "hybrid"]:
+            similarity = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method)[f"{method}_search"]
+            np.testing.assert_array_equal(similarity[all_deleted_idx], 0)
+        for match in self.flash_entropy.get_topn_matches(similarity, topn=None, min_similarity=None):
+            self.assertNotIn(match["id"], [self.all_spectra_list[i]["id"] for i in all_deleted_idx])
+
+        # The library after compaction is identical to the one built from the remaining spectra.
+        flash_entropy = FlashEntropySearch()
+        flash_entropy.build_index([spec for i, spec in enumerate(self.all_spectra_list) if i not in all_deleted_idx], clean_spectra=False)
+        self.flash_entropy.compact()
+        flash_entropy, self.flash_entropy = self.flash_entropy, flash_entropy
+        self.assert_index_equal(flash_entropy)
+
+    def test_delete_spectra_read_and_write(self):
+        with tempfile.TemporaryDirectory() as path_data:
+            self.flash_entropy.delete_spectra([1, 2], max_deleted_fraction=None)
+            self.flash_entropy.write(path_data)
+            flash_entropy = FlashEntropySearch()
+            flash_entropy.read(path_data)
+            np.testing.assert_array_equal(flash_entropy.entropy_search.deleted_spectra, self.flash_entropy.entropy_search.deleted_spectra)
+            self.assertTrue(flash_entropy.delete_spectra(list(range(3, 63))))
+            self.assertEqual(flash_entropy.entropy_search.total_spectra_num, 300 - 62)
+            self.assertEqual(len(flash_entropy.precursor_mz_array), 300 - 62)
+
+    def test_search_with_spectra_mask(self):
+        spectrum = self.all_spectra_list[5]
+        spectra_mask = np.arange(300) % 3 != 0
+        self.flash_entropy.delete_spectra([1], max_deleted_fraction=None)
+        for method in ["identity", "open", "neutral_loss", "hybrid"]:
+            similarity = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method)[f"{method}_search"]
+            for mask in [spectra_mask, np.packbits(spectra_mask)]:
+                similarity_masked = self.flash_entropy.search(
+                    precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method, spectra_mask=mask
+                )[f"{method}_search"]
+                np.testing.assert_array_equal(similarity_masked[~spectra_mask], 0)
+                np.testing.assert_array_almost_equal(similarity_masked[spectra_mask], similarity[spectra_mask])
+
+        # The saved filter is kept after writing and reading, and after compaction.
+        self.assertEqual(self.flash_entropy.add_filter("low_mz", lambda spec: spec["precursor_mz"] < 500), np.sum(self.flash_entropy.precursor_mz_array < 500))
+        with tempfile.TemporaryDirectory() as path_data:
+            self.flash_entropy.write(path_data)
+            flash_entropy = FlashEntropySearch()
+            flash_entropy.read(path_data)
+        similarity = flash_entropy.open_search(peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02, spectra_mask="low_mz")
+        np.testing.assert_array_equal(similarity[flash_entropy.precursor_mz_array >= 500], 0)
+        flash_entropy.delete_spectra([0, 2], max_deleted_fraction=None)
+        flash_entropy.compact()
+        np.testing.assert_array_equal(flash_entropy._get_spectra_mask("low_mz"), flash_entropy.precursor_mz_array < 500)
+        similarity = flash_entropy.open_search(peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02)
+        for match in flash_entropy.get_topn_matches(similarity, topn=None, min_similarity=None, spectra_mask="low_mz"):
+            self.assertLess(match["precursor_mz"], 500)
+
+        # The deletion state of a new core is set, so a spectra mask can be used before any spectrum is added.
+        np.testing.assert_array_equal(FlashEntropySearchCore()._get_search_mask(np.zeros(0, dtype=bool)), np.zeros(0, dtype=np.uint8))
+
+    def test_get_topn_results(self):
+        spectrum = self.all_spectra_list[5]
+        similarity, matched_peak_number = self.flash_entropy.open_search(
+            peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02, output_matched_peak_number=True
+        )
+        similarity[[10, 20, 30]] = 0.5
+        self.flash_entropy.delete_spectra([20], max_deleted_fraction=None)
+        for topn, min_similarity in [(3, 0.01), (10, 0.1), (None, None), (0, 0.01)]:
+            result = self.flash_entropy.get_topn_results(
+                similarity, topn=topn, min_similarity=min_similarity, matched_peak_number=matched_peak_number, metadata_fields=["id", "precursor_mz"]
+            )
+            all_spec_idx_expected = [i for i in sorted(range(300), key=lambda i: (-similarity[i], i)) if i != 20 and similarity[i] >= (min_similarity or 0)]
+            all_spec_idx_expected = all_spec_idx_expected[:topn]
+            np.testing.assert_array_equal(result["spec_idx"], all_spec_idx_expected)
+            np.testing.assert_array_equal(result["entropy_similarity"], similarity[all_spec_idx_expected])
+            np.testing.assert_array_equal(result["matched_peak_number"], matched_peak_number[all_spec_idx_expected])
+            self.assertEqual(result["id"].tolist(), [self.all_spectra_list[i]["id"] for i in all_spec_idx_expected])
+            np.testing.assert_array_equal(result["precursor_mz"], [self.all_spectra_list[i]["precursor_mz"] for i in all_spec_idx_expected])
+
+            all_matches = self.flash_entropy.get_topn_matches(similarity, topn=topn, min_similarity=min_similarity)
+            self.assertEqual([match["id"] for match in all_matches], result["id"].tolist())
+
+    def test_search_with_pruning(self):
+        self.flash_entropy.delete_spectra([7], max_deleted_fraction=None)
+        for spectrum in self.all_spectra_list[:20]:
+            for method in ["open", "neutral_loss"]:
+                similarity = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method)[f"{method}_search"]
+                search_function = getattr(self.flash_entropy, f"{method}_search")
+                # The similarity of the spectra above the threshold is exact.
+                similarity_pruned = search_function(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02, min_similarity=0.3)
+                is_above_threshold = similarity >= 0.3 + 1e-5
+                self.assertTrue(np.all(similarity_pruned[is_above_threshold] > 0))
+                np.testing.assert_array_almost_equal(similarity_pruned[similarity_pruned > 0], similarity[similarity_pruned > 0], decimal=5)
+                # The topn spectra are exact.
+                similarity_pruned = search_function(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02, topn=3)
+                np.testing.assert_array_almost_equal(
+                    self.flash_entropy.get_topn_results(similarity_pruned, topn=3)["entropy_similarity"],
+                    self.flash_entropy.get_topn_results(similarity, topn=3)["entropy_similarity"],
+                    decimal=5,
+                )
+                self.assertEqual(similarity_pruned[7], 0)
+
+    def test_search_with_partitioned_scoring(self):
+        for spectrum in self.all_spectra_list[:20]:
+            for method in ["open", "neutral_loss"]:
+                self.flash_entropy.entropy_search.score_partition_size = 0
+                similarity = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method)[f"{method}_search"]
+                self.flash_entropy.entropy_search.score_partition_size = 16
+                similarity_partitioned = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method)[
+                    f"{method}_search"
+                ]
+                np.testing.assert_array_equal(similarity_partitioned, similarity)
+
+        self.flash_entropy.delete_spectra([0, 5], max_deleted_fraction=None)
+        similarity = self.flash_entropy.open_search(peaks=self.all_spectra_list[5]["peaks"], ms2_tolerance_in_da=0.02, spectra_mask=np.arange(300) < 100)
+        np.testing.assert_array_equal(similarity[[0, 5]], 0)
+        np.testing.assert_array_equal(similarity[100:], 0)
+
+    def test_search_with_ppm_tolerance(self):
+        for spec_idx, spectrum in enumerate(self.all_spectra_list[:20]):
+            # Shift the peaks by 15 ppm and 30 ppm alternately, only the former are matched with a 20 ppm tolerance.
+            peaks = spectrum["peaks"].copy()
+            peaks[0::2, 0] *= 1 + 15e-6
+            peaks[1::2, 0] *= 1 + 30e-6
+            similarity = self.flash_entropy.open_search(peaks=peaks, ms2_tolerance_in_da=0.02, ms2_tolerance_in_ppm=20)
+            similarity_expected = [
+                calculate_entropy_similarity(peaks, library_spectrum["peaks"], ms2_tolerance_in_ppm=20, clean_spectra=False)
+                for library_spectrum in self.all_spectra_list
+            ]
+            np.testing.assert_array_almost_equal(similarity, similarity_expected, decimal=5)
+            for method in ["identity", "neutral_loss", "hybrid"]:
+                similarity = self.flash_entropy.search(
+                    precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method, ms2_tolerance_in_ppm=20
+                )[f"{method}_search"]
+                self.assertAlmostEqual(similarity[spec_idx], 1.0, places=5)
+
+        # The tolerance of the query peaks can not be larger than max_ms2_tolerance_in_da.
+        with self.assertRaises(AssertionError):
+            self.flash_entropy.open_search(peaks=np.array([[1000.0, 1.0]], dtype=np.float32), ms2_tolerance_in_da=0.02, ms2_tolerance_in_ppm=30)
+
+    def test_search_all_methods_in_one_traversal(self):
+        self.flash_entropy.delete_spectra([3], max_deleted_fraction=None)
+        for spectrum in self.all_spectra_list[:20]:
+            for method in ["all", ["open", "identity"], ["neutral_loss", "hybrid"]]:
+                result = self.flash_entropy.search(
+                    precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"], method=method, ms1_tolerance_in_da=5, spectra_mask=np.arange(300) < 200
+                )
+                for method_name, similarity in result.items():
+                    similarity_expected = self.flash_entropy.search(
+                        precursor_mz=spectrum["precursor_mz"],
+                        peaks=spectrum["peaks"],
+                        method=method_name.replace("_search", ""),
+                        ms1_tolerance_in_da=5,
+                        spectra_mask=np.arange(300) < 200,
+                    )[method_name]
+                    np.testing.assert_array_almost_equal(similarity, similarity_expected, decimal=5)
+
+    def test_search_with_precursor_hypotheses(self):
+        self.flash_entropy.delete_spectra([3], max_deleted_fraction=None)
+        for spectrum in self.all_spectra_list[:20]:
+            all_precursor_mz = [spectrum["precursor_mz"], spectrum["precursor_mz"] - 21.98, spectrum["precursor_mz"] + 1.5]
+            for method in ["identity_search", "neutral_loss_search", "hybrid_search"]:
+                search_function = getattr(self.flash_entropy, method)
+                similarity = search_function(
+                    precursor_mz=all_precursor_mz, peaks=spectrum["peaks"], ms1_tolerance_in_da=2, ms2_tolerance_in_da=0.02, spectra_mask=np.arange(300) < 200
+                )
+                self.assertEqual(similarity.shape, (3, 300))
+                for hypothesis_idx, precursor_mz in enumerate(all_precursor_mz):
+                    similarity_expected = search_function(
+                        precursor_mz=precursor_mz, peaks=spectrum["peaks"], ms1_tolerance_in_da=2, ms2_tolerance_in_da=0.02, spectra_mask=np.arange(300) < 200
+                    )
+                    np.testing.assert_array_almost_equal(similarity[hypothesis_idx], similarity_expected, decimal=5)
+
+    def test_search_with_max_precursor_delta(self):
+        flash_entropy_fragment_order = FlashEntropySearch()
+        all_spectra_list_fragment_order = flash_entropy_fragment_order.build_index(
+            [dict(spec) for spec in self.spectral_library], spectra_order="fragment"
+        )
+        all_libraries = [(self.flash_entropy, self.all_spectra_list), (flash_entropy_fragment_order, all_spectra_list_fragment_order)]
+        for flash_entropy, all_spectra_list in all_libraries:
+            flash_entropy.delete_spectra([3], max_deleted_fraction=None)
+            spectra_mask = np.arange(300) < 200
+            for spectrum in all_spectra_list[::15]:
+                peaks = flash_entropy.clean_spectrum_for_search(precursor_mz=spectrum["precursor_mz"], peaks=spectrum["peaks"])
+                is_in_range = np.abs(flash_entropy.precursor_mz_array - spectrum["precursor_mz"]) <= 200
+                for method in ["open_search", "hybrid_search"]:
+                    search_function = getattr(flash_entropy, method)
+                    search_parameters = dict(precursor_mz=spectrum["precursor_mz"], peaks=peaks, ms2_tolerance_in_da=0.02, spectra_mask=spectra_mask)
+                    similarity = search_function(**search_parameters)
+                    similarity_in_range = search_function(**search_parameters, max_precursor_delta=200)
+                    np.testing.assert_array_almost_equal(similarity_in_range, np.where(is_in_range, similarity, 0), decimal=5)
+
+                similarity_topn = flash_entropy.open_search(
+                    precursor_mz=spectrum["precursor_mz"], peaks=peaks, ms2_tolerance_in_da=0.02, topn=3, max_precursor_delta=200
+                )
+                similarity = flash_entropy.open_search(peaks=peaks, ms2_tolerance_in_da=0.02)
+                np.testing.assert_array_almost_equal(np.sort(similarity_topn)[-3:], np.sort(similarity[is_in_range])[-3:], decimal=5)
+
+    def test_search_with_multiple_tolerances(self):
+        self.flash_entropy.delete_spectra([3], max_deleted_fraction=None)
+        all_ms2_tolerance = [0.02, 0.005, 0.01]
+        for spectrum in self.all_spectra_list[:20]:
+            peaks = spectrum["peaks"].copy()
+            peaks[:, 0] += np.linspace(-0.02, 0.02, len(peaks), dtype=np.float32)
+            result = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=peaks, ms2_tolerance_in_da=all_ms2_tolerance)
+            for tolerance_idx, ms2_tolerance in enumerate(all_ms2_tolerance):
+                result_expected = self.flash_entropy.search(precursor_mz=spectrum["precursor_mz"], peaks=peaks, ms2_tolerance_in_da=ms2_tolerance)
+                for method, similarity_expected in result_expected.items():
+                    np.testing.assert_array_almost_equal(result[method][tolerance_idx], similarity_expected, decimal=5)
+
+        peaks = self.all_spectra_list[10]["peaks"]
+        similarity, matched_peaks = self.flash_entropy.open_search(peaks=peaks, ms2_tolerance_in_da=all_ms2_tolerance, output_matched_peak_number=True)
+        for tolerance_idx, ms2_tolerance in enumerate(all_ms2_tolerance):
+            similarity_expected, matched_peaks_expected = self.flash_entropy.open_search(
+                peaks=peaks, ms2_tolerance_in_da=ms2_tolerance, output_matched_peak_number=True
+            )
+            np.testing.assert_array_almost_equal(similarity[tolerance_idx], similarity_expected, decimal=5)
+            np.testing.assert_array_equal(matched_peaks[tolerance_idx], matched_peaks_expected)
+
+    def test_open_search_with_candidates(self):
+        self.flash_entropy.build_candidate_index()
+        self.flash_entropy.delete_spectra([3], max_deleted_fraction=None)
+        for spec_idx in [0, 3, 10, 200]:
+            spectrum = self.all_spectra_list[spec_idx]
+            similarity = self.flash_entropy.open_search(peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02)
+            similarity_approximate = self.flash_entropy.open_search_with_candidates(peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02, candidate_num=20)
+            # The candidates are scored exactly, and the spectrum itself is always a candidate.
+            self.assertLessEqual(np.count_nonzero(similarity_approximate), 20)
+            is_candidate = similarity_approximate > 0
+            np.testing.assert_array_almost_equal(similarity_approximate[is_candidate], similarity[is_candidate], decimal=5)
+            if spec_idx == 3:
+                self.assertEqual(similarity_approximate[3], 0)
+            else:
+                self.assertAlmostEqual(similarity_approximate[spec_idx], 1, places=5)
+
+        # The candidate index is saved, and updated after compaction.
+        with tempfile.TemporaryDirectory() as path_data:
+            self.flash_entropy.write(path_data)
+            flash_entropy = FlashEntropySearch(low_memory=2)
+            flash_entropy.read(path_data)
+            flash_entropy.compact()
+            spectrum = self.all_spectra_list[10]
+            similarity_approximate = flash_entropy.open_search_with_candidates(peaks=spectrum["peaks"], ms2_tolerance_in_da=0.02, candidate_num=20)
+            self.assertAlmostEqual(similarity_approximate[9], 1, places=5)
+
+    def test_update_candidate_index(self):
+        for spectra_order in ["precursor_mz", "fragment"]:
+            flash_entropy = FlashEntropySearch()
+            flash_entropy.build_index([dict(spec) for spec in self.spectral_library[:250]], spectra_order=spectra_order)
+            flash_entropy.build_candidate_index()
+            flash_entropy.build_index([dict(spec) for spec in self.spectral_library[250:]], append=True)
+            flash_entropy.delete_spectra(np.arange(0, 300, 7), max_deleted_fraction=None)
+            for is_compacted in [False, True]:
+                if is_compacted:
+                    flash_entropy.compact()
+                # The candidate index updated with the new and the removed spectra is the same as the one built from the library.
+                candidate_index = MinHashCandidateIndex()
+                candidate_index.build(*flash_entropy.entropy_search.index[1:4], flash_entropy.entropy_search.total_spectra_num)
+                self.assertEqual(flash_entropy.candidate_index.spectra_num, candidate_index.spectra_num)
+                np.testing.assert_array_equal(flash_entropy.candidate_index.band_keys, candidate_index.band_keys)
+                for spectrum in self.all_spectra_list[::25]:
+                    peaks = flash_entropy.entropy_search._preprocess_peaks(spectrum["peaks"])
+                    np.testing.assert_array_equal(flash_entropy.candidate_index.get_candidates(peaks, 300), candidate_index.get_candidates(peaks, 300))
+
+    def test_radix_sort_and_idx_start(self):
+        random_state = np.random.RandomState(1)
+        peak_data = np.zeros(5000, dtype=[("ion_mz", np.float32), ("nl_mass", np.float32), ("intensity", np.float32), ("spec_idx", np.uint32)])
+        peak_data["ion_mz"] = np.round(random_state.uniform(0, 100, peak_data.shape[0]), 1)
+        peak_data["nl_mass"] = np.round(random_state.uniform(-10, 100, peak_data.shape[0]), 1)
+        peak_data["intensity"] = random_state.randint(0, 3, peak_data.shape[0])
+        peak_data["spec_idx"] = random_state.randint(0, 100, peak_data.shape[0])
+        for order in ["ion_mz", "nl_mass"]:
+            peak_data_expected = np.sort(peak_data, order=order)
+            peak_data_sorted = _radix_sort_peak_data(peak_data.copy(), order)
+            np.testing.assert_array_equal(peak_data_sorted, peak_data_expected)
+
+            search_array = np.arange(0.0, 80.0, 0.0001)
+            np.testing.assert_array_equal(
+                _generate_idx_start(peak_data[order], search_array), np.searchsorted(peak_data_expected[order], search_array, side="left")
+            )
+
+
+class TestMetadataStore(unittest.TestCase):
+    def setUp(self):
+        self.all_metadata = [
+            {"id": "B", "precursor_mz": 150.0, "charge": 1, "is_decoy": False, "tags": ["a"]},
+            {"id": "A", "precursor_mz": 220.5, "charge": 2, "is_decoy": True},
+            {"id": "C", "precursor_mz": 250.0, "tags": None, "XXX": "YYY"},
+            {"id": "A", "precursor_mz": np.float32(350.0), "charge": 1, "is_decoy": False},
+        ]
+        self.metadata_store = MetadataStore(self.all_metadata)
+
+    def test_get_metadata(self):
+        self.assertEqual(self.metadata_store.columns["id"]["kind"], "string")
+        self.assertEqual(self.metadata_store.columns["charge"]["kind"], "number")
+        self.assertEqual(self.metadata_store.columns["tags"]["kind"], "object")
+        self.assertEqual(self.metadata_store.get_metadata(range(4)), self.all_metadata)
+        np.testing.assert_array_equal(self.metadata_store.gather([3, 1], ["precursor_mz"])["precursor_mz"], [350.0, 220.5])
+        self.assertEqual(self.metadata_store.gather([2, 1], ["charge"])["charge"].tolist(), [None, 2])
+
+    def test_select(self):
+        np.testing.assert_array_equal(self.metadata_store.select("id", "==", "A"), [False, True, False, True])
+        np.testing.assert_array_equal(self.metadata_store.select("id", "in", ["B", "C"]), [True, False, True, False])
+        np.testing.assert_array_equal(self.metadata_store.select("id", "<", "B"), [False, True, False, True])
+        np.testing.assert_array_equal(self.metadata_store.select("charge", "!=", 2), [True, False, False, True])
+        np.testing.assert_array_equal(self.metadata_store.select("precursor_mz", ">", 200), [False, True, True, True])
+        np.testing.assert_array_equal(self.metadata_store.select("XXX", "==", "YYY"), [False, False, True, False])
+        np.testing.assert_array_equal(self.metadata_store.select("not_exist", "==", 1), [False] * 4)
+
+    def test_take_and_insert(self):
+        metadata_store = self.metadata_store.take([1, 3])
+        self.assertEqual(metadata_store.get_metadata(range(2)), [self.all_metadata[1], self.all_metadata[3]])
+        all_new_metadata = [{"id": "D", "charge": 1.5, "comment": "new"}, {"id": "A", "precursor_mz": 100.0, "charge": 3}]
+        metadata_store = self.metadata_store.insert(MetadataStore(all_new_metadata), [0, 3])
+        all_metadata_expected = [all_new_metadata[0]] + self.all_metadata[:2] + [all_new_metadata[1]] + self.all_metadata[2:]
+        self.assertEqual(metadata_store.get_metadata(range(6)), all_metadata_expected)
+        np.testing.assert_array_equal(metadata_store.select("id", "==", "A"), [False, False, True, True, False, True])
+
+    def test_read_and_write(self):
+        with tempfile.TemporaryDirectory() as path_data:
+            self.metadata_store.write(path_data)
+            for use_memmap in [False, True]:
+                metadata_store = MetadataStore()
+                metadata_store.read(path_data, use_memmap=use_memmap)
+                self.assertEqual(metadata_store.get_metadata(range(4)), self.all_metadata)
+                np.testing.assert_array_equal(metadata_store.select("id", "==", "A"), [False, True, False, True])
+                del metadata_store
+
+
 # class TestFlashEntropySearchWithGpu(TestFlashEntropySearchWithCpu):
 #     def test_hybrid_search(self):
 #         similarity = self.flash_entropy.hybrid_search(precursor_mz=self.query_spectrum['precursor_mz'],